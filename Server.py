@@ -1,8 +1,8 @@
-from SimpleHttpServer import HttpServer
+from SimpleHttpServer import HttpServer, ViewCache
 
 server = HttpServer(port=80)
 
-@server.route("/")
+@server.route("/", cache=ViewCache(ttl=60))
 def index(request):
     with open("./resources/test.html") as f:
         data = f.read()
@@ -1,38 +1,129 @@
 from socket import *
-from threading import Thread
+from threading import Thread, Lock, Event, Condition, current_thread, get_ident, local
+from collections import OrderedDict, deque
+from weakref import WeakSet
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout
+import asyncio
+import atexit
+import cProfile
 import datetime
+import io
 import time
 from email.utils import formatdate, parsedate_to_datetime
-from inspect import getfullargspec
+from inspect import getfullargspec, ismethod
+from bisect import bisect_left
+from select import select
+from stat import S_ISREG
+from urllib.parse import urlsplit, quote, unquote_to_bytes, parse_qsl
+from tempfile import SpooledTemporaryFile
+import mimetypes
+import errno
+import gzip
+import zlib
+import uuid
+import random
+import shutil
+import json
+import re
+import sys
+import signal
+import traceback
+import tracemalloc
+import pstats
 import os
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+try:
+    from fcntl import ioctl
+    from termios import TIOCOUTQ # SIOCOUTQ for sockets on Linux
+except ImportError:
+    ioctl = None
+
+# sendmsg flag that holds a write back to join the next one, Linux only
+SEND_MORE = globals().get("MSG_MORE", 0)
+
 class HttpStatus():
+    Continue                = 100
     OK                      = 200
+    Partial_Content         = 206
     Not_Modified            = 304
     Bad_Request             = 400
     Forbidden               = 403
     Not_Found               = 404
+    Method_Not_Allowed      = 405
+    Request_Timeout         = 408
     Length_Required         = 411
+    Payload_Too_Large       = 413
+    URI_Too_Long            = 414
+    Unsupported_Media_Type  = 415
+    Range_Not_Satisfiable   = 416
+    Expectation_Failed      = 417
+    Request_Header_Fields_Too_Large = 431
     Internal_Server_Error   = 500
+    Not_Implemented         = 501
+    Bad_Gateway             = 502
+    Service_Unavailable     = 503
+    Gateway_Timeout         = 504
+    HTTP_Version_Not_Supported = 505
 
     CODES = [
+        100,
         200,
+        206,
         304,
         400,
         403,
         404,
+        405,
+        408,
         411,
-        500
+        413,
+        414,
+        415,
+        416,
+        417,
+        431,
+        500,
+        501,
+        502,
+        503,
+        504,
+        505
     ]
 
     _messages = {
+        Continue: "Continue",
         OK: "OK",
+        Partial_Content: "Partial Content",
         Not_Modified: "Not Modified",
         Bad_Request: "Bad Request",
         Forbidden: "Forbidden",
         Not_Found: "Not Found",
+        Method_Not_Allowed: "Method Not Allowed",
+        Request_Timeout: "Request Timeout",
         Length_Required: "Length Required",
-        Internal_Server_Error: "Internal Server Error"
+        Payload_Too_Large: "Payload Too Large",
+        URI_Too_Long: "URI Too Long",
+        Unsupported_Media_Type: "Unsupported Media Type",
+        Range_Not_Satisfiable: "Range Not Satisfiable",
+        Expectation_Failed: "Expectation Failed",
+        Request_Header_Fields_Too_Large: "Request Header Fields Too Large",
+        Internal_Server_Error: "Internal Server Error",
+        Not_Implemented: "Not Implemented",
+        Bad_Gateway: "Bad Gateway",
+        Service_Unavailable: "Service Unavailable",
+        Gateway_Timeout: "Gateway Timeout",
+        HTTP_Version_Not_Supported: "HTTP Version Not Supported"
     }
 
     @staticmethod
@@ -41,6 +132,32 @@ class HttpStatus():
             raise ValueError("Unknown status code: " + code)
         
         return HttpStatus._messages[code]
+
+    @staticmethod
+    def status_line(code, version="HTTP/1.1"):
+        """ Encoded status line, including its line break. Built once per code and version """
+        line = HttpStatus._status_lines.get((version, code))
+        if line is None:
+            line = f"{version} {code} {HttpStatus.message(code)}\r\n".encode()
+            HttpStatus._status_lines[(version, code)] = line
+
+        return line
+
+    _status_lines = {}
+
+class HttpDate():
+    """ Value of the date header. Formatted at most once per second and shared by all responses """
+    _cached = (None, None) # (second, value)
+
+    @staticmethod
+    def now():
+        second = int(time.time())
+        cached_second, value = HttpDate._cached
+        if cached_second != second:
+            value = formatdate(second, usegmt=True)
+            HttpDate._cached = (second, value)
+
+        return value
     
 class HttpMethod():
     GET         = "GET"
@@ -49,6 +166,9 @@ class HttpMethod():
     PUT         = "PUT"
     DELETE      = "DELETE"
 
+    # only the proxy answers CONNECT, so it isn't one of the METHODS routes default to
+    CONNECT     = "CONNECT"
+
     METHODS = [
         GET,
         POST,
@@ -57,100 +177,888 @@ class HttpMethod():
         DELETE
     ]
 
-class ConsoleLogger():
-    def __init__(self):
-        pass
+class AccessLog():
+    """
+    Log sink with a background writer. log() only appends a record to a bounded
+    in-memory queue; formatting and writing happen on the writer thread, in batches
+    of up to batch_size records or every flush_interval seconds. Records that arrive
+    while the queue is full are dropped and counted rather than blocking the request.
 
-    def server(self, message):
-        color_code = ""
-        color_reset = ""
-        if self._is_color_capable():
-            color_code = "\033[0;35m" # purple
-            color_reset = "\033[0m"
-        
-        log = f"{color_code}[Server]: {message}{color_reset}"
-        print(log)
+    path=None writes to stdout. With max_bytes the file is rotated to path.1 ...
+    path.<backup_count>. format is one of console, common, combined or json, and
+    sample_rate keeps that fraction of request records.
+    """
+    FORMAT_CONSOLE = "console"
+    FORMAT_COMMON = "common"
+    FORMAT_COMBINED = "combined"
+    FORMAT_JSON = "json"
 
-    def http_connection(self, status_code, request=None):
-        """
-        params
-        message: HttpRequest object
-        status_code: Http status code
-        """
+    FORMATS = [FORMAT_CONSOLE, FORMAT_COMMON, FORMAT_COMBINED, FORMAT_JSON]
+
+    _default = None
+    _default_lock = Lock()
+    _instances = WeakSet()
+
+    def __init__(self, path=None, format=FORMAT_CONSOLE, queue_size=8192, batch_size=256, flush_interval=0.5,
+                 sample_rate=1.0, max_bytes=0, backup_count=5):
+        if format not in AccessLog.FORMATS:
+            raise ValueError("Unknown log format: " + format)
+
+        self.path = path
+        self.format = format
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        # checked once, not on every line
+        self.color = path is None and format == AccessLog.FORMAT_CONSOLE and sys.stdout.isatty()
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+        self._records = deque()
+        self._wake = Event()
+        self._closed = False
+        self._writer = None
+        self._start_lock = Lock()
+
+        self._file = None
+        self._size = 0
+
+        AccessLog._instances.add(self)
+
+    @staticmethod
+    def default():
+        """ The stdout log shared by loggers that weren't given one """
+        if AccessLog._default is None:
+            with AccessLog._default_lock:
+                if AccessLog._default is None:
+                    AccessLog._default = AccessLog()
+
+        return AccessLog._default
+
+    def log(self, record):
+        """ Queues record without blocking. Returns False if it was sampled out or dropped """
+        if self.sample_rate < 1 and record[0] not in ["server", "trace", "error"] and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+
+        if len(self._records) >= self.queue_size:
+            self.dropped += 1
+            return False
+
+        if self._writer is None:
+            self.start()
+
+        self._records.append(record)
+        if len(self._records) >= self.batch_size:
+            self._wake.set()
+
+        return True
+
+    def start(self):
+        with self._start_lock:
+            if self._writer is not None:
+                return
+
+            self._writer = Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """ Writes out everything still queued and stops the writer """
+        self._closed = True
+        self._wake.set()
+        if self._writer is not None and self._writer is not current_thread():
+            self._writer.join()
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _after_fork():
+        # the writer thread doesn't survive fork, a child starts its own on its first record
+        AccessLog._default_lock = Lock()
+        for log in list(AccessLog._instances):
+            log._records = deque()
+            log._wake = Event()
+            log._writer = None
+            log._start_lock = Lock()
+            log._file = None
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+
+            while len(self._records) > 0:
+                self._write_batch()
+
+            if self._closed:
+                break
+
+    def _write_batch(self):
+        lines = []
+        while len(lines) < self.batch_size and len(self._records) > 0:
+            lines.append(self._format(self._records.popleft()))
+
+        data = "\n".join(lines) + "\n"
+        try:
+            self._write(data)
+        except OSError:
+            self.dropped += len(lines)
+            return
+
+        self.written += len(lines)
+
+    def _write(self, data):
+        if self.path is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            return
+
+        if self._file is None:
+            self._open()
+
+        size = len(data.encode())
+        if self.max_bytes > 0 and self._size > 0 and self._size + size > self.max_bytes:
+            self._rotate()
+
+        self._file.write(data)
+        self._file.flush()
+        self._size += size
+
+    def _open(self):
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+        self._open()
+
+    def _format(self, record):
+        kind, timestamp, status_code, request, client, size = record
+
+        if kind == "trace": # request is the RequestTrace of a slow or profiled request
+            if self.format == AccessLog.FORMAT_JSON:
+                return json.dumps({"time": self._iso_time(timestamp), "trace": request.as_dict()})
+
+            return f"[Trace]: {request.format()}"
+
+        if kind == "error": # request is the message and size the exception, formatted here off the request path
+            return self._format_error(timestamp, request, size)
+
+        if self.format == AccessLog.FORMAT_CONSOLE:
+            return self._format_console(kind, timestamp, status_code, request)
+
+        if kind == "server":
+            message = request
+            if self.format == AccessLog.FORMAT_JSON:
+                return json.dumps({"time": self._iso_time(timestamp), "server": message})
+
+            return f"[Server]: {message}"
+
+        method, url, version, headers = "-", "-", "-", {}
+        if request is not None:
+            method, url, version, headers = request.method, request.url, request.version, request.headers
+
+        if self.format == AccessLog.FORMAT_JSON:
+            return json.dumps({
+                "time": self._iso_time(timestamp),
+                "client": client,
+                "host": headers.get("host"),
+                "method": None if request is None else method,
+                "url": None if request is None else url,
+                "version": None if request is None else version,
+                "status": status_code,
+                "size": size,
+                "referer": headers.get("referer"),
+                "user_agent": headers.get("user-agent")
+            })
+
+        log_time = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(timestamp))
+        line = (f"{client or '-'} - - [{log_time}] \"{method} {url} {version}\" "
+                f"{status_code or '-'} {size if size is not None else '-'}")
+
+        if self.format == AccessLog.FORMAT_COMBINED:
+            line += f" \"{headers.get('referer', '-')}\" \"{headers.get('user-agent', '-')}\""
+
+        return line
+
+    def _format_error(self, timestamp, message, exception):
+        details = ""
+        if exception is not None:
+            details = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
+        if self.format == AccessLog.FORMAT_JSON:
+            return json.dumps({"time": self._iso_time(timestamp), "error": message, "exception": details or None})
+
+        color_code, color_reset = ("\033[0;31m", "\033[0m") if self.color else ("", "") # red
+        return f"{color_code}[Error]: {message}{color_reset}" + ("\n" + details.rstrip("\n") if details else "")
+
+    def _format_console(self, kind, timestamp, status_code, request):
         color_code = ""
         color_reset = ""
-        if self._is_color_capable():
+        if self.color:
             color_reset = "\033[0m"
-            if status_code == HttpStatus.OK:
+            if kind == "server":
+                color_code = "\033[0;35m" # purple
+            elif status_code is None or status_code == HttpStatus.OK:
                 color_code = "\033[1;32m" # light green
             else:
                 color_code = "\033[0;33m" # brown
-        
-        now = datetime.datetime.now()
-        
-        if request is None:
-            log = f"{color_code}[Http]: [{now}] {status_code} {HttpStatus.message(status_code)}{color_reset}"
-
-        else:
-            method = request.method
-            resource = request.url
-            version = request.version
-            headers = request.headers
 
-            log = f"{color_code}[Http]: {headers['host']} - - [{now}] \"{method} {resource} {version}\" {status_code} {HttpStatus.message(status_code)}{color_reset}"
-        
-        print(log)
+        if kind == "server":
+            return f"{color_code}[Server]: {request}{color_reset}"
 
-    def proxy_connection(self, request):
-        color_code = ""
-        color_reset = ""
-        if self._is_color_capable():
-            color_code = "\033[1;32m" # light green
-            color_reset = "\033[0m"
+        now = datetime.datetime.fromtimestamp(timestamp)
 
-        now = datetime.datetime.now()
+        if request is None:
+            return f"{color_code}[Http]: [{now}] {status_code} {HttpStatus.message(status_code)}{color_reset}"
 
         method = request.method
         resource = request.url
         version = request.version
-        headers = request.headers
+        host = request.headers.get("host", "-")
 
-        log = f"{color_code}[Http]: {headers['host']} - - [{now}] \"{method} {resource} {version}\"{color_reset}"
-        
-        print(log)
+        if kind == "proxy":
+            return f"{color_code}[Http]: {host} - - [{now}] \"{method} {resource} {version}\"{color_reset}"
+
+        return f"{color_code}[Http]: {host} - - [{now}] \"{method} {resource} {version}\" {status_code} {HttpStatus.message(status_code)}{color_reset}"
+
+    def _iso_time(self, timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).astimezone().isoformat()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=AccessLog._after_fork)
+
+class ConsoleLogger():
+    """
+    Front end used by the handlers and servers. Calls only queue a record on
+    access_log (the shared stdout log by default), nothing is formatted or written
+    on the request path.
+    """
+    def __init__(self, access_log=None):
+        if access_log is None:
+            access_log = AccessLog.default()
+
+        self.access_log = access_log
+
+    def server(self, message):
+        self.access_log.log(("server", time.time(), None, message, None, None))
+
+    def error(self, message, exception=None):
+        """ Something went wrong on the server's side, the traceback of exception is written with message """
+        self.access_log.log(("error", time.time(), None, message, None, exception))
+
+    def http_connection(self, status_code, request=None, client=None, size=None):
+        """
+        params
+        message: HttpRequest object
+        status_code: Http status code
+        client: address of the client, if known
+        size: size of the response body, if known
+        """
+        self.access_log.log(("http", time.time(), status_code, request, client, size))
+
+    def proxy_connection(self, request, client=None):
+        self.access_log.log(("proxy", time.time(), None, request, client, None))
+
+class Histogram():
+    """
+    Fixed bucket histogram of durations in seconds. The buckets are allocated up
+    front, observing a value only bumps a counter.
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """ Returns [(upper bound, observations <= bound)], ending with +Inf """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+class Metrics():
+    """
+    Request counters and per stage latency histograms for a server. A request is
+    recorded with a single lock acquisition; read them with snapshot(), or in the
+    Prometheus text format with prometheus().
+    """
+    STAGES = ["parse", "handler", "serialize", "send"]
+
+    # where a connection or request ran out of time
+    TIMEOUTS = ["idle", "header", "body", "send", "handler", "upstream"]
+
+    def __init__(self, buckets=Histogram.BUCKETS):
+        self.requests = {} # (route, method, status) -> count
+        self.connections = 0
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timeouts = dict((phase, 0) for phase in Metrics.TIMEOUTS)
+        self.histograms = dict((stage, Histogram(buckets)) for stage in Metrics.STAGES)
+
+        self._stages = [self.histograms[stage] for stage in Metrics.STAGES]
+        self._lock = Lock()
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.in_flight += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def timed_out(self, phase):
+        with self._lock:
+            self.timeouts[phase] += 1
+
+    def record_request(self, route, method, status_code, timings, bytes_in, bytes_out):
+        """ timings holds the parse, handler, serialize and send durations in seconds """
+        key = (route, method, status_code)
+
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+            for histogram, seconds in zip(self._stages, timings):
+                histogram.observe(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "connections": self.connections,
+                "in_flight": self.in_flight,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "timeouts": dict(self.timeouts),
+                "stages": dict((stage, {
+                    "buckets": histogram.cumulative(),
+                    "sum": histogram.sum,
+                    "count": histogram.count
+                }) for stage, histogram in self.histograms.items())
+            }
+
+    def prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        lines.append("# HELP simplehttp_requests_total Requests handled, by route, method and status.")
+        lines.append("# TYPE simplehttp_requests_total counter")
+        for (route, method, status_code), count in sorted(snapshot["requests"].items(), key=str):
+            labels = f'route="{self._escape(route)}",method="{self._escape(method)}",status="{status_code}"'
+            lines.append(f"simplehttp_requests_total{{{labels}}} {count}")
+
+        lines.append("# HELP simplehttp_connections_total Connections accepted.")
+        lines.append("# TYPE simplehttp_connections_total counter")
+        lines.append(f"simplehttp_connections_total {snapshot['connections']}")
 
-    def _is_color_capable(self):
-        return os.isatty(0)
+        lines.append("# HELP simplehttp_connections_in_flight Connections currently open.")
+        lines.append("# TYPE simplehttp_connections_in_flight gauge")
+        lines.append(f"simplehttp_connections_in_flight {snapshot['in_flight']}")
+
+        lines.append("# HELP simplehttp_received_bytes_total Request bytes received.")
+        lines.append("# TYPE simplehttp_received_bytes_total counter")
+        lines.append(f"simplehttp_received_bytes_total {snapshot['bytes_in']}")
+
+        lines.append("# HELP simplehttp_sent_bytes_total Response bytes sent.")
+        lines.append("# TYPE simplehttp_sent_bytes_total counter")
+        lines.append(f"simplehttp_sent_bytes_total {snapshot['bytes_out']}")
+
+        lines.append("# HELP simplehttp_timeouts_total Connections and requests that ran out of time, by phase.")
+        lines.append("# TYPE simplehttp_timeouts_total counter")
+        for phase, count in snapshot["timeouts"].items():
+            lines.append(f'simplehttp_timeouts_total{{phase="{phase}"}} {count}')
+
+        lines.append("# HELP simplehttp_stage_seconds Time spent per request in each stage.")
+        lines.append("# TYPE simplehttp_stage_seconds histogram")
+        for stage, histogram in snapshot["stages"].items():
+            for bound, count in histogram["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f'simplehttp_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+
+            lines.append(f'simplehttp_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'simplehttp_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+
+        return "\n".join(lines) + "\n"
+
+    def _escape(self, value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class RequestTrace():
+    """
+    What happened to one request, for Tracer hooks and the slow request log. stages
+    holds (name, start, end) in time.perf_counter seconds, in the order they ran:
+    parse, dispatch, view, serialize and send.
+    """
+    def __init__(self, request=None, client=None, start=None, top=10):
+        self.request = request
+        self.client = client
+        self.route = None
+        self.status_code = None
+        self.response = None # only while the after hooks run
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.stages = []
+        self.top = top
+
+        # sampled requests run their view under the profiler
+        self.sampled = False
+        self.profile = None
+        self.memory = None
+
+        # the view's stack, caught once the request was slow, and when
+        self.stack = None
+        self.stack_at = None
+
+        self.thread = None
+        self.in_view = False
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def mark(self, stage, start, end=None):
+        """ Records that stage ran from start until end, now by default. Returns end """
+        if end is None:
+            end = time.perf_counter()
+
+        self.stages.append((stage, start, end))
+        return end
+
+    def breakdown(self):
+        """ Seconds spent in each stage """
+        result = {}
+        for stage, start, end in self.stages:
+            result[stage] = result.get(stage, 0.0) + end - start
+
+        return result
+
+    def format(self):
+        method, url = "-", "-"
+        if self.request is not None:
+            method, url = self.request.method, self.request.url
+
+        lines = [f"{method} {url} {self.status_code or '-'} in {self.duration * 1000:.2f}ms, "
+                 f"route {self.route or '-'}, client {self.client or '-'}"]
+        lines.append("  " + ", ".join(f"{stage} {seconds * 1000:.2f}ms" for stage, seconds in self.breakdown().items()))
+
+        if self.stack is not None:
+            lines.append(f"  stack at {self.stack_at * 1000:.2f}ms:")
+            lines += self._indent(self.stack.format())
+
+        profile = self.profile_text()
+        if profile is not None:
+            lines.append("  profile:")
+            lines += self._indent([profile])
+
+        memory = self.memory_text()
+        if memory is not None:
+            lines.append("  memory:")
+            lines += self._indent([memory])
+
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {
+            "method": None if self.request is None else self.request.method,
+            "url": None if self.request is None else self.request.url,
+            "route": self.route,
+            "status": self.status_code,
+            "client": self.client,
+            "duration_ms": round(self.duration * 1000, 3),
+            "stages_ms": dict((stage, round(seconds * 1000, 3)) for stage, seconds in self.breakdown().items()),
+            "stack": None if self.stack is None else self.stack.format(),
+            "stack_at_ms": None if self.stack_at is None else round(self.stack_at * 1000, 3),
+            "profile": self.profile_text(),
+            "memory": self.memory_text()
+        }
+
+    def profile_text(self):
+        """ The top functions by cumulative time, if the view was profiled """
+        if self.profile is None:
+            return None
+
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        return out.getvalue().strip("\n")
+
+    def memory_text(self):
+        """ Where the memory still held after the view was allocated, if it was traced """
+        if self.memory is None:
+            return None
+
+        snapshot, peak = self.memory
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        lines = [f"peak {peak} bytes"]
+        lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:self.top]]
+        return "\n".join(lines)
+
+    def _indent(self, blocks):
+        return ["    " + line for block in blocks for line in block.rstrip("\n").split("\n")]
+
+class Tracer():
+    """
+    Per request instrumentation for a server. Hooks added with before_request run
+    once a request is routed, with its RequestTrace, and can answer it themselves by
+    returning what a view would. Hooks added with after_request get the trace once
+    the response is sent. With AsyncHttpServer hooks run on the event loop, so they
+    must not block.
+
+    Requests that take longer than threshold seconds are written to log with their
+    stage timings and the view's stack as it was when the threshold passed. Requests
+    on routes, or a sample_rate fraction of the rest, run their view under cProfile,
+    and tracemalloc with memory=True, and are logged with their top functions. One
+    request is profiled at a time, and coroutine views are only timed since others
+    run on their thread meanwhile. threshold, sample_rate and routes can be changed
+    while the server runs.
+    """
+    def __init__(self, threshold=1.0, sample_rate=0.0, routes=None, memory=False, top=10, log=None):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.routes = set(routes) if routes is not None else set()
+        self.memory = memory
+        self.top = top
+
+        if log is None:
+            log = AccessLog.default()
+
+        self.log = log
+        self.logged = 0
+        self._logger = ConsoleLogger(log)
+
+        self.timers = TimerWheel()
+
+        self._before = []
+        self._after = []
+        self._profiling = Lock()
+
+    def before_request(self, hook):
+        """ Registers hook(trace) to run before each view. Can be used as a decorator """
+        self._before.append(hook)
+        return hook
+
+    def after_request(self, hook):
+        """ Registers hook(trace) to run after each response is sent. Can be used as a decorator """
+        self._after.append(hook)
+        return hook
+
+    def begin(self, request, client=None, start=None, parsed=None):
+        trace = RequestTrace(request, client, start, self.top)
+        if parsed is not None:
+            trace.mark("parse", trace.start, parsed)
+
+        return trace
+
+    def dispatched(self, trace, route, since):
+        """ Marks the end of routing and picks whether the view is profiled """
+        trace.route = route
+        trace.mark("dispatch", since)
+        trace.sampled = route in self.routes or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def run_before(self, trace):
+        """ Runs the before hooks, returning the first result one gave """
+        for hook in self._before:
+            result = hook(trace)
+            if result is not None:
+                return result
+
+        return None
+
+    def run_view(self, trace, func, *args):
+        """ Calls func as the view stage of trace """
+        start = time.perf_counter()
+        timer = self._watch(trace)
+        try:
+            if trace.sampled and self._profiling.acquire(blocking=False):
+                try:
+                    return self._profile(trace, func, *args)
+                finally:
+                    self._profiling.release()
+
+            return func(*args)
+        finally:
+            self._unwatch(trace, timer)
+            trace.mark("view", start)
+
+    async def run_view_async(self, trace, coroutine):
+        """ Awaits coroutine as the view stage of trace """
+        start = time.perf_counter()
+        timer = self._watch(trace)
+        try:
+            return await coroutine
+        finally:
+            self._unwatch(trace, timer)
+            trace.mark("view", start)
+
+    def finish(self, trace, response=None):
+        """ Runs the after hooks, then logs trace if it was slow or profiled """
+        trace.end = time.perf_counter()
+        if response is not None:
+            trace.status_code = response.status_code
+            trace.response = response
+
+        for hook in self._after:
+            try:
+                hook(trace)
+            except Exception as e:
+                self._logger.error("after_request hook failed", e)
+
+        trace.response = None
+
+        slow = self.threshold is not None and trace.duration >= self.threshold
+        if slow or trace.profile is not None:
+            self.logged += 1
+            self.log.log(("trace", time.time(), trace.status_code, trace, trace.client, None))
+
+    def _watch(self, trace):
+        trace.thread = get_ident()
+        trace.in_view = True
+        if self.threshold is None:
+            return None
+
+        delay = max(self.threshold - (time.perf_counter() - trace.start), 0)
+        return self.timers.schedule(delay, lambda: self._sample_stack(trace))
+
+    def _unwatch(self, trace, timer):
+        trace.in_view = False
+        if timer is not None:
+            self.timers.cancel(timer)
+
+    def _sample_stack(self, trace):
+        # runs on the timer thread while the view is still going, source lines are read when formatting
+        frame = sys._current_frames().get(trace.thread)
+        if frame is None or not trace.in_view:
+            return
+
+        stack = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=self.top, lookup_lines=False)
+        stack.reverse()
+        trace.stack = stack
+        trace.stack_at = time.perf_counter() - trace.start
+
+    def _profile(self, trace, func, *args):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return func(*args) # another profiler already owns the interpreter
+
+        # tracemalloc is process wide, so allocations by requests running alongside show up too
+        memory = self.memory and not tracemalloc.is_tracing()
+        if memory:
+            tracemalloc.start()
+
+        try:
+            return func(*args)
+        finally:
+            profiler.disable()
+            trace.profile = profiler
+
+            if memory:
+                trace.memory = (tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
 
 class HttpRequestParser():
-    
+    """
+    Incremental request head parser working directly on bytes. feed can be called with
+    any slicing of the stream, done is set once the blank line ending the head has been
+    read and request then holds the parsed HttpRequest. Lines are checked as they
+    arrive, so an over long or malformed head fails before it is buffered in full.
+    Header lines are validated but kept as bytes, and only split and decoded when
+    request.headers is first used.
+    """
+    REQUEST_LINE, HEADERS = range(2)
+
+    # tchar from RFC 9110, the characters allowed in methods and header names
+    TOKEN = b"!#$%&'*+-.^_`|~0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+    # visible ascii, the characters allowed in a request target
+    VISIBLE = bytes(range(0x21, 0x7f))
+
+    # CRLF terminated name: value lines. A folded line or whitespace before the colon
+    # fails the name, and a bare CR, LF or NUL fails the value
+    HEADER_LINES = re.compile(rb"(?:[-!#$%&'*+.^_`|~0-9A-Za-z]+:[^\r\n\0]*\r\n)*")
+
+    VERSIONS = {b"HTTP/1.1": "HTTP/1.1", b"HTTP/1.0": "HTTP/1.0"}
+
+    def __init__(self, max_line_size=8192, max_headers=100):
+        self.max_line_size = max_line_size
+        self.max_headers = max_headers
+
+        self.request = None
+        self.done = False
+
+        self._state = HttpRequestParser.REQUEST_LINE
+        self._line = bytearray()
+        self._headers = bytearray()
+        self._count = 0
+
     def parse(self, message):
-        headers, data = message.split("\r\n\r\n")[:2]
-        split = headers.split("\r\n")
-        method, url, version = map(str.strip, split[0].split(" "))
+        """ Parses a whole request message, anything after the head is taken as the body """
+        if isinstance(message, str):
+            message = message.encode()
 
-        header_end_index = 0
-        headers = {}
-        for header in split[1:]:
-            if header == "": # signals double \r\n \r\n. This means we have reached the end of the headers
-                break
+        consumed = self.feed(message)
+        if not self.done:
+            raise HttpException(HttpStatus.Bad_Request, "Incomplete request head")
 
-            key, value = map(str.strip, header.split(": "))
-            key = key.lower()
-            headers[key] = value
-            header_end_index += 1
+        self.request.body = bytes(message[consumed:])
+        return self.request
+
+    def feed(self, data, start=0, end=None):
+        """ Consumes data[start:end] up to the end of the head. Returns how many bytes were used """
+        if end is None:
+            end = len(data)
+
+        i = start
+        if self._state == HttpRequestParser.REQUEST_LINE and not self._line:
+            while data.startswith(b"\r\n", i, end): # empty lines before the request line are ignored
+                i += 2
+
+            # the usual case, the whole head arrived at once and is checked with a few calls over all of it
+            head_end = data.find(b"\r\n\r\n", i, end)
+            if head_end != -1:
+                line_end = data.find(b"\r\n", i, head_end + 2)
+                self._request_line(bytes(data[i:line_end]))
+                self._header_lines(bytes(data[line_end + 2:head_end + 2]))
+                self._finish()
+                return head_end + 4 - start
+
+        while i < end and not self.done:
+            line_end = data.find(b"\n", i, end)
+            if line_end == -1:
+                self._line += data[i:end]
+                if len(self._line) > self.max_line_size:
+                    self._too_long()
+
+                return end - start
+
+            if self._line:
+                self._line += data[i:line_end + 1]
+                line = bytes(self._line)
+                self._line.clear()
+            else:
+                line = bytes(data[i:line_end + 1])
+
+            i = line_end + 1
+
+            if self._state == HttpRequestParser.HEADERS:
+                if line == b"\r\n":
+                    self._finish()
+                else:
+                    self._header_lines(line)
+            elif line != b"\r\n":
+                if line[-2:] != b"\r\n":
+                    raise HttpException(HttpStatus.Bad_Request, "Malformed request line")
+
+                self._request_line(line[:-2])
+
+        return i - start
+
+    def _too_long(self):
+        if self._state == HttpRequestParser.REQUEST_LINE:
+            raise HttpException(HttpStatus.URI_Too_Long)
+
+        raise HttpException(HttpStatus.Request_Header_Fields_Too_Large)
+
+    def _request_line(self, line):
+        if len(line) > self.max_line_size:
+            raise HttpException(HttpStatus.URI_Too_Long)
 
-        if data.strip() == "":
-            data = None
+        parts = line.split(b" ")
+        if len(parts) != 3:
+            raise HttpException(HttpStatus.Bad_Request, "Malformed request line")
+
+        method, target, version = parts
+        if method == b"" or method.translate(None, HttpRequestParser.TOKEN) != b"":
+            raise HttpException(HttpStatus.Bad_Request, "Malformed method")
+
+        if target == b"" or target.translate(None, HttpRequestParser.VISIBLE) != b"":
+            raise HttpException(HttpStatus.Bad_Request, "Malformed request target")
+
+        if version not in HttpRequestParser.VERSIONS.keys():
+            # a well formed HTTP/x.y we don't speak, versus garbage
+            if len(version) == 8 and version[:5] == b"HTTP/" and version[6:7] == b"." and version[5:8:2].isdigit():
+                raise HttpException(HttpStatus.HTTP_Version_Not_Supported)
+
+            raise HttpException(HttpStatus.Bad_Request, "Malformed version")
+
+        method = method.decode()
+        target = target.decode()
+        if method == HttpMethod.CONNECT:
+            # authority-form, host:port
+            host, _, port = target.rpartition(":")
+            if host == "" or not port.isdigit() or target[0] == "/":
+                raise HttpException(HttpStatus.Bad_Request, "Malformed CONNECT target")
+
+        elif method not in HttpMethod.METHODS:
+            raise HttpException(HttpStatus.Not_Implemented)
+
+        elif target[0] != "/" and not target.startswith(("http://", "https://")):
+            raise HttpException(HttpStatus.Bad_Request, "Unsupported request target")
 
         request = HttpRequest()
         request.method = method
-        request.url = url
-        request.version = version
-        request.headers = headers
-        request.data = data
-       
-        return request
+        request.url = target
+        request.version = HttpRequestParser.VERSIONS[version]
+
+        self.request = request
+        self._state = HttpRequestParser.HEADERS
+
+    def _header_lines(self, lines):
+        """ Checks and keeps one or more CRLF terminated header lines """
+        count = lines.count(b"\n")
+        self._count += count
+        if self._count > self.max_headers:
+            raise HttpException(HttpStatus.Request_Header_Fields_Too_Large)
+
+        # no line can be over the limit if all of them together are not
+        if len(lines) > self.max_line_size + 2 and max(map(len, lines.split(b"\r\n"))) > self.max_line_size:
+            raise HttpException(HttpStatus.Request_Header_Fields_Too_Large)
+
+        if HttpRequestParser.HEADER_LINES.fullmatch(lines) is None:
+            raise HttpException(HttpStatus.Bad_Request, "Malformed header line")
+
+        self._headers += lines
+
+    def _finish(self):
+        self.request.raw_headers = bytes(self._headers)
+        self.done = True
 
 class HttpResponseParser():
     
@@ -180,423 +1088,5074 @@ class HttpResponseParser():
         return response
 
 class HttpResponseStreamParser():
+    """
+    Collects a whole response from the chunks read off an upstream socket. Works on
+    bytes, and handles content-length, chunked and close-delimited bodies. An empty
+    message signals that upstream closed the connection.
+    """
     
     def __init__(self):
         self.response = None
 
         self.recvd_headers = False
         self.header_length = 0
-        self.header_end_index = 0
 
-        self.data = None
+        self.data = bytearray()
+        self.content_length = None
+        self.chunked = None
 
-        self.bytes_recvd = 0
-        self.content_length = 0
+        self._scanned = 0
 
     def parseNext(self, message):
-        self.bytes_recvd += len(message)
-
-        decode = message.decode()
-        if self.data is None:
-            self.data = decode
-        else:
-            self.data += decode
+        eof = len(message) == 0
+        self.data += message
 
         if not self.recvd_headers:
-            if "\r\n\r\n" in self.data:
-                self.recvd_headers = True
+            header_end_index = self.data.find(b"\r\n\r\n", self._scanned)
+            if header_end_index == -1:
+                self._scanned = max(0, len(self.data) - 3)
+                return None
 
-                self.header_end_index = self.data.find("\r\n\r\n")
-                self.header_length = len(self.data[:self.header_end_index + 4].encode())
+            self.recvd_headers = True
+            self.header_length = header_end_index + 4
 
-                parser = HttpResponseParser()
-                header_response = parser.parse(self.data[:self.header_end_index + 4])
-                self.response = header_response
+            parser = HttpResponseParser()
+            header_response = parser.parse(self.data[:self.header_length].decode("iso-8859-1"))
+            self.response = header_response
 
-                if "content-length" not in header_response.headers.keys():
-                    response = HttpResponse(HttpStatus.Length_Required)
-                    return response
-                
+            if header_response.headers.get("transfer-encoding", "").lower() == "chunked":
+                self.chunked = ChunkedDecoder()
+                self._body = bytearray()
+                self._chunk_pos = self.header_length
+            elif "content-length" in header_response.headers.keys():
                 self.content_length = int(header_response.headers["content-length"])
-        
-        if self.recvd_headers:
-            if self.bytes_recvd - self.header_length == self.content_length:
-                self.response.data = self.data[self.header_end_index + 4:]
+
+        if self.chunked is not None:
+            self._chunk_pos += self.chunked.feed(self.data, self._chunk_pos, out=self._body)
+            if self.chunked.done:
+                self.response.headers.pop("transfer-encoding")
+                self.response.data = bytes(self._body)
+                return self.response
+
+        elif self.content_length is not None:
+            if len(self.data) - self.header_length >= self.content_length:
+                self.response.data = bytes(self.data[self.header_length:self.header_length + self.content_length])
                 return self.response
+
+        elif eof:
+            # no framing, the body runs until upstream closes the connection
+            self.response.data = bytes(self.data[self.header_length:])
+            return self.response
         
         return None
 
-class HttpException(Exception):
-    """ Raised when an Http exception occurs """
-    def __init__(self, status_code, *args):
-        super().__init__(*args)
-        self.status_code = status_code
+class ChunkedDecoder():
+    """
+    Incremental decoder for a chunked body. feed can be called with any slicing of the
+    stream and returns how many bytes belonged to the body, done is set once the
+    last chunk and the trailers have been read.
+    """
+    SIZE, DATA, DATA_END, TRAILER = range(4)
 
-class HttpRequestHandler():
-    
-    def __init__(self):
-        self.RESOURCE_DIR = "./resources"
-        
-        self.logger = ConsoleLogger()
-        self.resources = []
+    MAX_LINE = 8192
 
-        for (dirpath, dirnames, filenames) in os.walk(self.RESOURCE_DIR):
-            dirpath = dirpath.replace(self.RESOURCE_DIR, "")
+    # RFC 9112 chunk-size, 1*HEXDIG, kept to what fits in 64 bits
+    CHUNK_SIZE = re.compile(rb"[0-9A-Fa-f]{1,16}")
 
-            for filename in filenames:
-                path = os.path.join(dirpath, filename).replace("\\", "/")
-                path = path.removeprefix("/")
-                path = "/" + path
-                self.resources.append(path)
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.done = False
 
-    def handle(self, message, routes):
-        parser = HttpRequestParser()
-        request = None
-        response = None
-        
+        self._state = ChunkedDecoder.SIZE
+        self._remaining = 0
+        self._line = bytearray()
+
+    def feed(self, data, start=0, end=None, out=None):
+        """ Consumes data[start:end], appending the decoded bytes to out if given """
+        if end is None:
+            end = len(data)
+
+        i = start
+        while i < end and not self.done:
+            if self._state in [ChunkedDecoder.SIZE, ChunkedDecoder.TRAILER]:
+                line_end = data.find(b"\n", i, end)
+                if line_end == -1:
+                    self._line += data[i:end]
+                    i = end
+                    if len(self._line) > ChunkedDecoder.MAX_LINE:
+                        raise HttpException(HttpStatus.Bad_Request)
+                    break
+
+                self._line += data[i:line_end + 1]
+                i = line_end + 1
+
+                line = bytes(self._line).rstrip(b"\r\n")
+                self._line.clear()
+
+                if self._state == ChunkedDecoder.TRAILER:
+                    if line == b"":
+                        self.done = True
+                    continue
+
+                # int would also take a sign, 0x, underscores and whitespace, which other parsers don't
+                size, extension, _ = line.partition(b";")
+                if extension:
+                    size = size.rstrip(b" \t")
+
+                if ChunkedDecoder.CHUNK_SIZE.fullmatch(size) is None:
+                    raise HttpException(HttpStatus.Bad_Request)
+
+                size = int(size, 16)
+
+                if size == 0:
+                    self._state = ChunkedDecoder.TRAILER
+                    continue
+
+                self.size += size
+                if self.max_size is not None and self.size > self.max_size:
+                    raise HttpException(HttpStatus.Payload_Too_Large)
+
+                self._state = ChunkedDecoder.DATA
+                self._remaining = size
+
+            elif self._state == ChunkedDecoder.DATA:
+                take = min(self._remaining, end - i)
+                if out is not None:
+                    out += data[i:i + take]
+
+                i += take
+                self._remaining -= take
+
+                if self._remaining == 0:
+                    self._state = ChunkedDecoder.DATA_END
+                    self._remaining = 2 # CRLF after the chunk data
+
+            else:
+                # anything but CRLF means the chunk size was wrong, and the framing can't be trusted
+                if data[i] != b"\r\n"[2 - self._remaining]:
+                    raise HttpException(HttpStatus.Bad_Request)
+
+                i += 1
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self._state = ChunkedDecoder.SIZE
+
+        return i - start
+
+class HttpRequestReader():
+    """
+    Incremental, bytes level reader for a persistent connection. Splits the stream into
+    complete request messages, reading exactly content-length bytes or a chunked body.
+    Pipelined requests stay buffered and are handed out in order. The head is parsed
+    as it arrives, request holds the parsed form of the last message returned.
+
+    The timeouts are deadlines rather than per read limits, so a client trickling
+    a byte at a time can't hold the connection: header_timeout runs from the first
+    byte of a request to the end of its head, body_timeout from there to the end
+    of the body, and idle_timeout between requests.
+
+    With spool_size set, a body larger than spool_size, or one the client waits on a
+    100 Continue for, isn't buffered: the message is returned once the head is in
+    and the view reads the body off the connection through request.stream. Those
+    reads get body_timeout each, as a large upload can take longer than any
+    deadline. attach or attach_async gives the reader the connection to read from.
+    """
+    def __init__(self, max_requests=100, max_header_size=16384, max_body_size=10485760, recv_size=65536,
+                 header_timeout=None, body_timeout=None, idle_timeout=None, spool_size=None):
+        self.max_requests = max_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.spool_size = spool_size
+
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.idle_timeout = idle_timeout
+
+        self.requests = 0
+        self.keep_alive = True
+
+        # the last message returned, and the time spent parsing its head
+        self.request = None
+        self.parse_time = 0.0
+
+        self.buffer = bytearray()
+        self._recv_buffer = bytearray(recv_size)
+        self._recv_view = memoryview(self._recv_buffer)
+
+        # the body being streamed to a view, with its content-length left or its decoder
+        self.stream = None
+        self._stream_left = None
+        self._stream_decoder = None
+        self._continue = False # a 100 Continue is owed before reading the body
+
+        self._source = None
+        self._writer = None
+        self._loop = None
+
+        self._reset()
+
+    def _reset(self):
+        self._parser = None
+        self._scanned = 0      # buffer[:_scanned] has been fed to the parser
+        self._parse_time = 0.0
+        self._started = None   # when the first byte of the request arrived
+        self._head_read = None # when its head was complete
+        self._head_end = -1
+        self._head = None
+
+        # chunked body state
+        self._chunk_pos = 0
+        self._chunked = None
+        self._body = None
+
+    def attach(self, connection):
+        """ Sets the socket streamed bodies are read from """
+        self._source = connection
+
+    def attach_async(self, reader, writer):
+        """ Sets the asyncio streams streamed bodies are read from, on the running loop """
+        self._source = reader
+        self._writer = writer
+        self._loop = asyncio.get_running_loop()
+
+    def recv_into(self, connection):
+        """ Reads what is available on connection into the buffer. Returns 0 at EOF """
+        n = connection.recv_into(self._recv_buffer)
+        if n > 0:
+            self.buffer += self._recv_view[:n]
+            if self._started is None:
+                self._started = time.monotonic()
+
+        return n
+
+    def feed(self, data):
+        self.buffer += data
+        if self._started is None and len(data) > 0:
+            self._started = time.monotonic()
+
+    def wait_time(self):
+        """
+        Returns (phase, seconds) for the next read: whether it waits for the next
+        request ("idle"), the rest of a head ("header") or a body ("body"), and how
+        long is left before the deadline. seconds is None without a timeout.
+        """
+        if self._head_read is not None:
+            phase, timeout, since = "body", self.body_timeout, self._head_read
+        elif self._started is not None:
+            phase, timeout, since = "header", self.header_timeout, self._started
+        else:
+            return "idle", self.idle_timeout
+
+        if timeout is None:
+            return phase, None
+
+        return phase, since + timeout - time.monotonic()
+
+    def next_message(self):
+        """
+        Returns the next complete request as bytes, or None if more data is needed.
+        Raises HttpException if the request breaks the size limits or can't be framed.
+        """
+        if self._head_end == -1 and not self._read_head():
+            return None
+
+        transfer_encoding = self._parser.request.header("transfer-encoding")
+        if transfer_encoding is not None:
+            if transfer_encoding.lower() != "chunked":
+                raise HttpException(HttpStatus.Not_Implemented)
+
+            return self._read_chunked()
+
+        return self._read_content_length()
+
+    def close_after(self, response):
+        """ Stops reading after response if it leaves the connection in an unknown state """
+        if response.status_code in [HttpStatus.Bad_Request, HttpStatus.Length_Required,
+                                    HttpStatus.Request_Timeout, HttpStatus.Payload_Too_Large, HttpStatus.URI_Too_Long,
+                                    HttpStatus.Request_Header_Fields_Too_Large, HttpStatus.Not_Implemented,
+                                    HttpStatus.HTTP_Version_Not_Supported]:
+            self.keep_alive = False
+
+        if self.stream is not None:
+            self.keep_alive = False # the rest of an unread body isn't worth reading just to skip it
+
+        if isinstance(response, HttpStreamResponse):
+            if self.request is not None and self.request.version == "HTTP/1.0":
+                response.until_close() # chunked is HTTP/1.1 only
+
+            if not response.framed:
+                self.keep_alive = False
+
+        response.headers = {"connection": "keep-alive" if self.keep_alive else "close"}
+
+    def _read_head(self):
+        if self._parser is None:
+            self._parser = HttpRequestParser(min(self.max_header_size, 8192))
+
+        start = time.perf_counter()
+        self._scanned += self._parser.feed(self.buffer, self._scanned)
+        self._parse_time += time.perf_counter() - start
+
+        if self._scanned > self.max_header_size:
+            raise HttpException(HttpStatus.Request_Header_Fields_Too_Large)
+
+        if not self._parser.done:
+            return False
+
+        self._head_read = time.monotonic()
+        self._head_end = self._scanned
+        self._head = bytes(self.buffer[:self._head_end])
+        self._chunk_pos = self._head_end
+
+        # HTTP/1.0 clients can't send expect
+        if self.spool_size is not None and self._parser.request.version == "HTTP/1.1":
+            expect = self._parser.request.header("expect")
+            if expect is not None:
+                if expect.lower() != "100-continue":
+                    raise HttpException(HttpStatus.Expectation_Failed)
+
+                self._continue = True
+
+        return True
+
+    def body_into(self, out):
+        """ Moves what has arrived of the streamed body into out. Returns True once the body is complete """
+        if self._stream_decoder is not None:
+            used = self._stream_decoder.feed(self.buffer, out=out)
+            del self.buffer[:used]
+            done = self._stream_decoder.done
+        else:
+            take = min(self._stream_left, len(self.buffer))
+            out += self.buffer[:take]
+            del self.buffer[:take]
+            self._stream_left -= take
+            done = self._stream_left == 0
+
+        if done:
+            self._end_stream()
+
+        return done
+
+    def fill(self):
+        """ Reads more of a streamed body. Raises HttpException if it times out or the connection closes """
+        if self._loop is not None:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+
+            if running is self._loop:
+                raise RuntimeError("Coroutine views read the body with read_async or async for")
+
+            # a sync view on an executor thread, the streams belong to the loop
+            asyncio.run_coroutine_threadsafe(self.fill_async(), self._loop).result()
+            return
+
+        if self._continue:
+            self._continue = False
+            self._source.sendall(HttpStatus.status_line(HttpStatus.Continue) + b"\r\n")
+
+        self._source.settimeout(self.body_timeout)
+        try:
+            received = self.recv_into(self._source)
+        except timeout:
+            raise HttpException(HttpStatus.Request_Timeout)
+
+        if received == 0:
+            raise HttpException(HttpStatus.Bad_Request) # closed part way through the body
+
+    async def fill_async(self):
+        if self._loop is None:
+            self.fill() # a coroutine view run on a threaded server, which can block
+            return
+
+        if self._continue:
+            self._continue = False
+            self._writer.write(HttpStatus.status_line(HttpStatus.Continue) + b"\r\n")
+            await self._writer.drain()
+
+        try:
+            data = await asyncio.wait_for(self._source.read(len(self._recv_buffer)), self.body_timeout)
+        except asyncio.TimeoutError:
+            raise HttpException(HttpStatus.Request_Timeout)
+
+        if not data:
+            raise HttpException(HttpStatus.Bad_Request)
+
+        self.feed(data)
+
+    def _streams(self, size, complete):
+        if self.spool_size is None or complete:
+            return False
+
+        return size > self.spool_size or self._continue
+
+    def _start_stream(self, message_end, left=None, decoder=None, decoded=b""):
+        head_read, owed = self._head_read, self._continue
+
+        self.stream = HttpRequestBody(decoded, self, self.spool_size)
+        self._stream_left = left
+        self._stream_decoder = decoder
+        self._parser.request.stream = self.stream
+
+        message = self._finish(self._head, message_end)
+
+        # the buffer holds body now, not the start of a pipelined request
+        self._started = None
+        self._head_read = head_read
+        self._continue = owed
+        return message
+
+    def _end_stream(self):
+        self.stream = None
+        self._stream_left = None
+        self._stream_decoder = None
+        self._continue = False
+
+        self._head_read = None
+        self._started = time.monotonic() if len(self.buffer) > 0 else None
+
+    def _read_content_length(self):
+        head_end = self._head_end
+
+        content_length = self._parser.request.header("content-length")
+        if content_length is not None:
+            # 1*DIGIT only, int would also take a sign, underscores and non-ASCII digits
+            # that a server behind a proxy could frame differently
+            if not (content_length.isascii() and content_length.isdigit()):
+                raise HttpException(HttpStatus.Bad_Request)
+
+            content_length = int(content_length)
+
+            if content_length > self.max_body_size:
+                raise HttpException(HttpStatus.Payload_Too_Large)
+
+            message_end = head_end + content_length
+            if self._streams(content_length, len(self.buffer) >= message_end):
+                return self._start_stream(head_end, left=content_length)
+
+        else:
+            # no content-length or transfer-encoding means no body, what follows is the next request
+            message_end = head_end
+
+        if len(self.buffer) < message_end:
+            return None
+
+        message = bytes(self.buffer[:message_end])
+        self._parser.request.body = message[head_end:]
+        return self._finish(message, message_end)
+
+    def _read_chunked(self):
+        if self._chunked is None:
+            self._chunked = ChunkedDecoder(self.max_body_size)
+            self._body = bytearray()
+
+        self._chunk_pos += self._chunked.feed(self.buffer, self._chunk_pos, out=self._body)
+        if self._streams(len(self._body), self._chunked.done):
+            return self._start_stream(self._chunk_pos, decoder=self._chunked, decoded=self._body)
+
+        if not self._chunked.done:
+            return None
+
+        headers = self._parser.request.headers
+        headers.pop("transfer-encoding")
+        headers["content-length"] = str(len(self._body))
+        self._parser.request.body = bytes(self._body)
+
+        head = self._dechunked_head(len(self._body))
+        return self._finish(head + self._body, self._chunk_pos)
+
+    def _dechunked_head(self, content_length):
+        # hand the handler a content-length framed message
+        lines = self._head.split(b"\r\n")[:-2]
+        lines = [line for line in lines if not line.lower().startswith(b"transfer-encoding:")]
+        lines.append(b"content-length: " + str(content_length).encode())
+
+        return b"\r\n".join(lines) + b"\r\n\r\n"
+
+    def _finish(self, message, message_end):
+        del self.buffer[:message_end]
+
+        self.requests += 1
+        if not self._persistent() or self.requests >= self.max_requests:
+            self.keep_alive = False
+
+        self.request = self._parser.request
+        self.parse_time = self._parse_time
+
+        self._reset()
+        self._continue = False
+        if len(self.buffer) > 0:
+            self._started = time.monotonic() # a pipelined request is already arriving
+
+        return message
+
+    def _persistent(self):
+        # HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only if asked to
+        options = [option.strip() for option in self._parser.request.header("connection", "").lower().split(",")]
+        if self._parser.request.version == "HTTP/1.0":
+            return "keep-alive" in options
+
+        return "close" not in options
+
+class HttpException(Exception):
+    """ Raised when an Http exception occurs """
+    def __init__(self, status_code, *args, headers=None):
+        super().__init__(*args)
+        self.status_code = status_code
+        self.headers = headers
+
+class Route():
+    """ A view function registered for a url rule such as /users/<int:id>, with its ViewCache if any """
+    def __init__(self, rule, view_func, methods, cache=None):
+        self.rule = rule
+        self.view_func = view_func
+        self.methods = set(method.upper() for method in methods)
+        self.is_async = asyncio.iscoroutinefunction(view_func)
+        self.cache = cache
+
+        self.segments = []
+        self.params = []
+        for segment in rule.strip("/").split("/"):
+            if segment.startswith("<") and segment.endswith(">"):
+                converter, _, name = segment[1:-1].rpartition(":")
+                converter = converter or "str"
+                if converter not in Router.CONVERTERS.keys():
+                    raise ValueError("Unknown converter in route " + rule + ": " + converter)
+
+                self.segments.append((converter, name))
+                self.params.append(name)
+            else:
+                self.segments.append(segment)
+
+        if any(segment[0] == "path" for segment in self.segments[:-1] if isinstance(segment, tuple)):
+            raise ValueError("<path:...> must be the last segment of route " + rule)
+
+        # decide the call shape once instead of on every request
+        args = getfullargspec(view_func)[0] # accesses 'args'
+        if ismethod(view_func):
+            args = args[1:] # bound self
+        self.wants_request = len(args) > len(self.params)
+
+    @property
+    def is_static(self):
+        return len(self.params) == 0
+
+    def call(self, request, params):
+        if self.wants_request:
+            return self.view_func(request, **params)
+
+        return self.view_func(**params)
+
+class RouterNode():
+    def __init__(self):
+        self.static = {}    # segment -> RouterNode
+        self.dynamic = {}   # (converter, name) -> RouterNode
+        self.routes = {}    # method -> Route ending at this node
+
+class Router():
+    """
+    Maps a method and path to a Route. Fully static rules are found with one dict
+    lookup, rules with variables are kept in a trie keyed by segment, so the cost of
+    a lookup depends on the depth of the path rather than the number of routes.
+    """
+    # converter -> (pattern a segment must match, type). Plain ASCII digits only, as int and float
+    # would also take signs, underscores, other scripts' digits, nan and inf, giving one resource many urls
+    CONVERTERS = {
+        "int": (re.compile(r"[0-9]+"), int),
+        "float": (re.compile(r"[0-9]+(?:\.[0-9]+)?"), float),
+        "str": (None, str),
+        "path": (None, str)
+    }
+
+    # order dynamic segments are tried in, most specific first
+    PRIORITY = ["int", "float", "str", "path"]
+
+    def __init__(self):
+        self._static = {}   # path -> {method: Route}
+        self._root = RouterNode()
+
+    def add(self, rule, view_func, methods, cache=None):
+        route = Route(rule, view_func, methods, cache)
+
+        if route.is_static:
+            routes = self._static.setdefault("/" + rule.strip("/"), {})
+        else:
+            node = self._root
+            for segment in route.segments:
+                if isinstance(segment, tuple):
+                    node = node.dynamic.setdefault(segment, RouterNode())
+                else:
+                    node = node.static.setdefault(segment, RouterNode())
+
+            node.dynamic = dict(sorted(node.dynamic.items(), key=lambda item: Router.PRIORITY.index(item[0][0])))
+            routes = node.routes
+
+        for method in route.methods:
+            routes[method] = route
+
+        return route
+
+    def match(self, method, path):
+        """
+        Returns (route, params), or (None, None) if no rule matches path.
+        Raises HttpException 405 with an allow header if the rule exists for other methods.
+        """
+        path = "/" + path.strip("/")
+
+        candidates = []
+        if path in self._static.keys():
+            candidates.append((self._static[path], {}))
+
+        segments = path[1:].split("/")
+        self._walk(self._root, segments, 0, {}, candidates)
+
+        for routes, params in candidates:
+            route = routes.get(method)
+            if route is None and method == HttpMethod.HEAD:
+                route = routes.get(HttpMethod.GET)
+
+            if route is not None:
+                return route, params
+
+        if len(candidates) == 0:
+            return None, None
+
+        allowed = set()
+        for routes, _ in candidates:
+            allowed.update(routes.keys())
+
+        if HttpMethod.GET in allowed:
+            allowed.add(HttpMethod.HEAD)
+
+        raise HttpException(HttpStatus.Method_Not_Allowed, headers={"allow": ", ".join(sorted(allowed))})
+
+    def _walk(self, node, segments, index, params, candidates):
+        if index == len(segments):
+            if len(node.routes) > 0:
+                candidates.append((node.routes, dict(params)))
+            return
+
+        segment = segments[index]
+
+        child = node.static.get(segment)
+        if child is not None:
+            self._walk(child, segments, index + 1, params, candidates)
+
+        for (converter, name), child in node.dynamic.items():
+            if converter == "path":
+                if len(child.routes) > 0:
+                    params[name] = "/".join(segments[index:])
+                    candidates.append((child.routes, dict(params)))
+                    del params[name]
+                continue
+
+            if segment == "":
+                continue
+
+            pattern, convert = Router.CONVERTERS[converter]
+            if pattern is not None and pattern.fullmatch(segment) is None:
+                continue
+
+            params[name] = convert(segment)
+            self._walk(child, segments, index + 1, params, candidates)
+            del params[name]
+
+class ViewCache():
+    """
+    Opt-in response cache for a route, passed to HttpServer.route as cache. GET and
+    HEAD responses are kept for ttl seconds, keyed by the path, the query parameters
+    named in query (the whole query string if None) and the request headers named
+    in headers, so callers that differ in anything else share an entry. At most
+    max_entries are kept, least recently used out first. Concurrent misses for a key
+    wait for the one running view instead of each running it. Responses get a
+    cache-control max-age and vary to match, unless the view set its own.
+    """
+    METHODS = [HttpMethod.GET, HttpMethod.HEAD]
+
+    # set per response, never replayed from the cache
+    UNCACHED_HEADERS = ["date", "connection", "age"]
+
+    def __init__(self, ttl=60, headers=None, query=None, max_entries=256, private=False, collapse_timeout=10):
+        self.ttl = ttl
+        self.headers = [name.lower() for name in headers or []]
+        self.query = query
+        self.max_entries = max_entries
+        self.private = private
+        self.collapse_timeout = collapse_timeout
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict() # key -> (expires, stored_at, status_code, headers, body)
+        self._inflight = {}           # key -> Future resolved once the leading view is done
+        self._lock = Lock()
+
+    def key(self, request, encoding=None):
+        """ The cache key of request. encoding is the content-encoding it would get """
+        if self.query is None:
+            query = request.query
+        else:
+            query = tuple(sorted((name, value) for name, value in parse_qsl(request.query, keep_blank_values=True)
+                                 if name in self.query))
+
+        headers = tuple(request.headers.get(name) for name in self.headers)
+        return (request.path, query, headers, encoding)
+
+    def get(self, key):
+        """ A fresh copy of the cached response for key, or None """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        expires, stored_at, status_code, headers, body = entry
+
+        response = HttpResponse(status_code)
+        response.headers = headers
+        if headers.get("cache-control", "").startswith(self._directive()):
+            response.headers = {"cache-control": f"{self._directive()}, max-age={int(expires - now)}"}
+
+        response.headers = {"age": int(now - stored_at)}
+        response.data = body
+        return response
+
+    def begin(self, key):
+        """ Returns (leader, future). Only the leader runs the view, the others wait on future """
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return False, future
+
+            future = Future()
+            self._inflight[key] = future
+            return True, future
+
+    def end(self, key):
+        with self._lock:
+            future = self._inflight.pop(key, None)
+
+        if future is not None:
+            future.set_result(None)
+
+    def store(self, key, response):
+        """ Caches response if it can be, adding cache-control and vary to it either way """
+        if type(response) is not HttpResponse or response.status_code != HttpStatus.OK:
+            return
+
+        if "cache-control" not in response.headers.keys():
+            response.headers = {"cache-control": f"{self._directive()}, max-age={int(self.ttl)}"}
+
+        if len(self.headers) > 0:
+            vary = [name.strip() for name in response.headers.get("vary", "").split(",") if name.strip() != ""]
+            response.headers = {"vary": ", ".join(vary + [name for name in self.headers if name not in vary])}
+
+        directives = ProxyCache.directives(response.headers["cache-control"])
+        if "no-store" in directives or "no-cache" in directives or "set-cookie" in response.headers.keys():
+            return
+
+        headers = dict((name, value) for name, value in response.headers.items()
+                       if name not in ViewCache.UNCACHED_HEADERS)
+
+        body = response.data
+        if isinstance(body, str):
+            body = body.encode()
+
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, now, response.status_code, headers, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _directive(self):
+        return "private" if self.private else "public"
+
+class ResourceCacheEntry():
+    def __init__(self, data, headers, stat, checked_at):
+        self.data = data
+        self.headers = headers
+        self.stat = stat
+        self.checked_at = checked_at
+
+class ResourceCache():
+    """
+    Size bounded LRU cache of static resources. Bodies are kept as bytes together with
+    their precomputed headers, and are revalidated with a stat at most once per
+    revalidate_interval seconds.
+    """
+    def __init__(self, max_bytes=16777216, max_entry_size=1048576, revalidate_interval=1):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.revalidate_interval = revalidate_interval
+
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path):
+        """ Returns the cached entry for path, loading it if needed. None if path is too big to cache """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                self._entries.move_to_end(path)
+                if now - entry.checked_at < self.revalidate_interval:
+                    return entry
+
+        stat = os.stat(path)
+        if entry is not None and self._same_file(entry.stat, stat):
+            entry.checked_at = now
+            return entry
+
+        if stat.st_size > self.max_entry_size:
+            self.invalidate(path)
+            return None
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        headers = HttpFileResponse.resource_headers(path, stat)
+        headers["content-length"] = len(data)
+
+        entry = ResourceCacheEntry(data, headers, stat, now)
+        self._put(path, entry)
+
+        return entry
+
+    def invalidate(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.size -= len(entry.data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _put(self, path, entry):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old.data)
+
+            self._entries[path] = entry
+            self.size += len(entry.data)
+
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.data)
+
+    def _same_file(self, a, b):
+        return (a.st_ino, a.st_mtime_ns, a.st_size) == (b.st_ino, b.st_mtime_ns, b.st_size)
+
+class ResourceIndex():
+    """
+    Set of the urls served from a resource directory, shared by every connection.
+    Built once, then kept current by re-scanning only the directories whose mtime
+    changed, at most once per check_interval seconds.
+    """
+    def __init__(self, resource_dir="./resources", check_interval=1):
+        self.resource_dir = resource_dir
+        self.check_interval = check_interval
+
+        self._urls = frozenset()
+        self._files = {}        # directory -> urls of the files directly in it
+        self._dir_mtimes = {}   # directory -> st_mtime_ns when it was scanned
+        self._checked_at = time.monotonic()
+        self._lock = Lock()
+
+        self.reload()
+
+    def __contains__(self, url):
+        if self.check_interval is not None and time.monotonic() - self._checked_at >= self.check_interval:
+            self.refresh()
+
+        return url in self._urls
+
+    def __iter__(self):
+        return iter(self._urls)
+
+    def __len__(self):
+        return len(self._urls)
+
+    def reload(self):
+        """ Rebuilds the whole index from disk """
+        with self._lock:
+            self._files = {}
+            self._dir_mtimes = {}
+            self._scan(self.resource_dir)
+            self._publish()
+
+    def refresh(self):
+        """ Re-scans the directories that changed since the last check """
+        if not self._lock.acquire(blocking=False):
+            return # another thread is already refreshing
+
+        try:
+            self._checked_at = time.monotonic()
+
+            changed = False
+            for dirpath, mtime in list(self._dir_mtimes.items()):
+                if dirpath not in self._dir_mtimes:
+                    continue # removed along with its parent
+
+                try:
+                    current = os.stat(dirpath).st_mtime_ns
+                except OSError:
+                    self._forget(dirpath)
+                    changed = True
+                    continue
+
+                if current != mtime:
+                    self._scan_dir(dirpath)
+                    changed = True
+
+            if changed:
+                self._publish()
+        finally:
+            self._lock.release()
+
+    def _scan(self, dirpath):
+        for (dirpath, dirnames, filenames) in os.walk(dirpath):
+            self._dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+            self._files[dirpath] = set(self._url(dirpath, filename) for filename in filenames)
+
+    def _scan_dir(self, dirpath):
+        self._dir_mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+
+        files = set()
+        subdirs = set()
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.add(entry.path)
+                else:
+                    files.add(self._url(dirpath, entry.name))
+
+        self._files[dirpath] = files
+
+        for subdir in subdirs:
+            if subdir not in self._dir_mtimes:
+                self._scan(subdir)
+
+        for known in list(self._dir_mtimes.keys()):
+            if os.path.dirname(known) == dirpath and known not in subdirs:
+                self._forget(known)
+
+    def _forget(self, dirpath):
+        prefix = dirpath + os.sep
+        for known in list(self._dir_mtimes.keys()):
+            if known == dirpath or known.startswith(prefix):
+                del self._dir_mtimes[known]
+                del self._files[known]
+
+    def _publish(self):
+        urls = set()
+        for files in self._files.values():
+            urls.update(files)
+
+        self._urls = frozenset(urls)
+
+    def _url(self, dirpath, filename):
+        dirpath = dirpath.replace(self.resource_dir, "", 1)
+
+        path = os.path.join(dirpath, filename).replace("\\", "/")
+        path = path.removeprefix("/")
+        return "/" + path
+
+class StreamCompressor():
+    """ Incremental compressor with the same compress/flush interface for every encoding """
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        else:
+            wbits = 31 if encoding == "gzip" else 15 # gzip header or zlib (deflate) header
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._compressor.process(data)
+
+        return self._compressor.compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self._compressor.finish()
+
+        return self._compressor.flush()
+
+class Compression():
+    """
+    Content negotiation on Accept-Encoding. Static files are served from a .gz/.br
+    sibling when one exists, otherwise compressed once and kept in a size bounded LRU
+    cache keyed on the file's etag. Dynamic responses are compressed on the fly.
+    """
+    SUFFIXES = {
+        "br": ".br",
+        "gzip": ".gz"
+    }
+
+    MIME_TYPES = [
+        "text/*",
+        "application/json",
+        "application/javascript",
+        "application/xml",
+        "image/svg+xml"
+    ]
+
+    def __init__(self, min_size=1024, mime_types=MIME_TYPES, level=6, max_cache_bytes=16777216, max_file_size=10485760):
+        self.min_size = min_size
+        self.mime_types = mime_types
+        self.level = level
+        self.max_cache_bytes = max_cache_bytes
+        self.max_file_size = max_file_size
+
+        # server preference, brotli only if the module is installed
+        self.encodings = ["gzip", "deflate"]
+        if brotli is not None:
+            self.encodings.insert(0, "br")
+
+        self.cache_size = 0
+        self._cache = OrderedDict()  # (path, encoding) -> (etag, data)
+        self._lock = Lock()
+
+    def negotiate(self, accept_encoding):
+        """ Returns the encoding to use for accept_encoding, or None for identity """
+        accepted = {}
+        for item in accept_encoding.split(","):
+            coding, _, params = item.strip().partition(";")
+            q = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+
+            accepted[coding.strip().lower()] = q
+
+        for encoding in self.encodings:
+            if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+
+        return None
+
+    def compressible(self, content_type):
+        mime_type = content_type.split(";")[0].strip().lower()
+        for allowed in self.mime_types:
+            if allowed == mime_type or (allowed.endswith("/*") and mime_type.startswith(allowed[:-1])):
+                return True
+
+        return False
+
+    def compressor(self, encoding):
+        return StreamCompressor(encoding, self.level)
+
+    def compress(self, data, encoding):
+        if encoding == "gzip":
+            # gzip.compress with mtime=0 keeps the output stable, so the etag stays valid
+            return gzip.compress(data, self.level, mtime=0)
+
+        compressor = self.compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    def etag(self, etag, encoding):
+        # every encoding is its own representation, so it gets its own validator
+        return etag[:-1] + "-" + encoding + '"'
+
+    def sibling(self, path, encoding):
+        """ Returns (path, stat) of a precompressed file next to path, if there is one """
+        if encoding not in Compression.SUFFIXES.keys():
+            return None, None
+
+        sibling = path + Compression.SUFFIXES[encoding]
+        try:
+            return sibling, os.stat(sibling)
+        except OSError:
+            return None, None
+
+    def get(self, path, etag, encoding, data=None):
+        """ Returns the compressed body of the file at path, compressing it only if the cache is stale """
+        key = (path, encoding)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == etag:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+
+        compressed = self.compress(data, encoding)
+
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.cache_size -= len(old[1])
+
+            self._cache[key] = (etag, compressed)
+            self.cache_size += len(compressed)
+
+            while self.cache_size > self.max_cache_bytes and len(self._cache) > 1:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self.cache_size -= len(evicted)
+
+        return compressed
+
+class HttpRequestHandler():
+    
+    def __init__(self, resources=None, resource_cache=None, compression=None, logger=None, client=None,
+                 tracer=None):
+        if logger is None:
+            logger = ConsoleLogger()
+
+        self.logger = logger
+        self.client = client
+        self.resource_cache = resource_cache
+
+        # what the last handled request was, for metrics
+        self.route = None
+        self.method = None
+        self.parse_time = 0.0
+        self.handler_time = 0.0
+        self.compression = compression
+
+        # with a tracer, the RequestTrace of the last handled request
+        self.tracer = tracer
+        self.trace = None
+
+        # with defer_log set, the access log record waits in pending_log until the caller knows the final status
+        self.defer_log = False
+        self.pending_log = None
+
+        if resources is None:
+            resources = ResourceIndex()
+
+        self.resources = resources
+
+        # urls in the index are relative to the directory it was built from
+        self.RESOURCE_DIR = resources.resource_dir.rstrip("/")
+
+    def handle(self, message, routes, request=None):
+        start = time.perf_counter()
+        request, response = self._parse(message, request)
+        parsed = time.perf_counter()
+        trace = self._begin_trace(request, start, parsed)
+        if response is not None:
+            self._measure("-", request, start, parsed)
+            self._head_only(request, response)
+            return response
+
+        try:
+            route, params = routes.match(request.method, self._path(request))
+        except HttpException as e:
+            route, params = None, None
+            response = self._error_response(e)
+
+        label = self._route_label(route, response)
+        try:
+            if trace is not None:
+                label, response = self._dispatched(trace, label, parsed, response)
+
+            if response is None:
+                if route is not None:
+                    response = self._run_view(trace, self._view_response, route, request, params)
+                else:
+                    response = self._run_view(trace, self._handle_resource, request)
+        except Exception as e:
+            response = self._server_error(request, e)
+
+        self._measure(label, request, start, parsed)
+        self._log(response, request)
+        self._head_only(request, response)
+        return response
+
+    async def handle_async(self, message, routes, executor=None, request=None):
+        """
+        Event loop version of handle. Coroutine views are awaited, while sync views
+        and file IO are pushed to executor so they never block the loop.
+        """
+        start = time.perf_counter()
+        request, response = self._parse(message, request)
+        parsed = time.perf_counter()
+        trace = self._begin_trace(request, start, parsed)
+        if response is not None:
+            self._measure("-", request, start, parsed)
+            self._head_only(request, response)
+            return response
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            route, params = routes.match(request.method, self._path(request))
+        except HttpException as e:
+            route, params = None, None
+            response = self._error_response(e)
+
+        label = self._route_label(route, response)
+        try:
+            if trace is not None:
+                label, response = self._dispatched(trace, label, parsed, response)
+
+            if response is None:
+                if route is not None and route.cache is not None and request.method in ViewCache.METHODS:
+                    response = await self._run_view_async(
+                        trace, self._cached_view_response_async(route, request, params, executor))
+                elif route is not None and route.is_async:
+                    response = await self._run_view_async(trace, self._call_view_async(route, request, params))
+                    await loop.run_in_executor(executor, self._compress_response, request, response)
+                elif route is not None:
+                    response = await loop.run_in_executor(executor, self._run_view, trace, self._view_response,
+                                                          route, request, params)
+                else:
+                    response = await loop.run_in_executor(executor, self._run_view, trace, self._handle_resource,
+                                                          request)
+        except Exception as e:
+            response = self._server_error(request, e)
+
+        self._measure(label, request, start, parsed)
+        self._log(response, request)
+        self._head_only(request, response)
+        return response
+
+    def _head_only(self, request, response):
+        # HEAD is answered by the GET view or file, but only the head goes out
+        if request is not None and request.method == HttpMethod.HEAD:
+            response.head_only = True
+
+    def _server_error(self, request, exception):
+        """ A view or hook raised something other than HttpException, the client gets a 500 """
+        self.logger.error(f"{request.method} {request.url} failed", exception)
+        return HttpResponse(HttpStatus.Internal_Server_Error)
+
+    def _route_label(self, route, response):
+        if route is not None:
+            return route.rule
+
+        # unrouted requests fall through to static resources unless matching failed
+        return "static" if response is None else "-"
+
+    def _begin_trace(self, request, start, parsed):
+        self.trace = None
+        if self.tracer is not None:
+            self.trace = self.tracer.begin(request, self.client, start, parsed)
+
+        return self.trace
+
+    def _dispatched(self, trace, label, since, response):
+        """
+        Runs the before hooks if routing found something to serve. Returns the label
+        and the response one gave, requests a hook answered are labelled hook.
+        """
+        self.tracer.dispatched(trace, label, since)
+        if response is not None:
+            return label, response
+
+        try:
+            result = self.tracer.run_before(trace)
+        except HttpException as e:
+            result = e
+
+        if result is None:
+            return label, None
+
+        trace.route = "hook"
+        if isinstance(result, HttpException):
+            return trace.route, self._error_response(result)
+
+        return trace.route, self._view_result(result)
+
+    def _run_view(self, trace, func, *args):
+        if trace is None:
+            return func(*args)
+
+        return self.tracer.run_view(trace, func, *args)
+
+    async def _run_view_async(self, trace, coroutine):
+        if trace is None:
+            return await coroutine
+
+        return await self.tracer.run_view_async(trace, coroutine)
+
+    def _measure(self, label, request, start, parsed):
+        self.route = label
+        self.method = request.method if request is not None else "-"
+        self.parse_time = parsed - start
+        self.handler_time = time.perf_counter() - parsed
+
+    def _log(self, response, request=None):
+        record = (response.status_code, request, self.client, response.headers.get("content-length"))
+        if self.defer_log:
+            self.pending_log = record
+        else:
+            self.logger.http_connection(*record)
+
+    def _parse(self, message, request=None):
+        parser = HttpRequestParser()
+        response = None
+        
+        try:
+            if request is None: # otherwise already parsed while reading
+                request = parser.parse(message)
+        except HttpException as e:
+            response = self._error_response(e)
+            self._log(response, request)
+            return request, response
+        except Exception as e:
+            self.logger.error("Request parsing failed", e)
+            response = HttpResponse(HttpStatus.Bad_Request)
+            self._log(response, request)
+            return request, response
+
+        if request.method == HttpMethod.CONNECT:
+            response = HttpResponse(HttpStatus.Not_Implemented) # tunnels are for ProxyServer
+            self._log(response, request)
+            return request, response
+        
+        if "content-length" not in request.headers.keys() and "transfer-encoding" not in request.headers.keys() \
+                and request.data is not None:
+            response = HttpResponse(HttpStatus.Length_Required)
+            self._log(response, request)
+            return request, response
+
+        return request, None
+
+    def _call_view(self, route, request, params):
+        try:
+            data = route.call(request, params)
+            if route.is_async:
+                data = asyncio.run(data) # coroutine view on a threaded server
+
+            response = self._view_result(data)
+        except HttpException as e:
+            response = self._error_response(e)
+
+        return response
+
+    async def _call_view_async(self, route, request, params):
+        try:
+            response = self._view_result(await route.call(request, params))
+        except HttpException as e:
+            response = self._error_response(e)
+
+        return response
+
+    def _view_response(self, route, request, params):
+        if route.cache is not None and request.method in ViewCache.METHODS:
+            return self._cached_view_response(route, request, params)
+
+        return self._render_view(route, request, params)
+
+    def _render_view(self, route, request, params):
+        response = self._call_view(route, request, params)
+        self._compress_response(request, response)
+
+        return response
+
+    def _cached_view_response(self, route, request, params):
+        cache = route.cache
+        key = cache.key(request, self._view_encoding(request))
+
+        response = cache.get(key)
+        if response is not None:
+            return response
+
+        leader, future = cache.begin(key)
+        if not leader:
+            try:
+                future.result(cache.collapse_timeout)
+            except FutureTimeout:
+                pass
+
+            response = cache.get(key)
+            if response is not None:
+                return response
+
+        try:
+            response = self._render_view(route, request, params)
+            cache.store(key, response)
+        finally:
+            if leader:
+                cache.end(key)
+
+        return response
+
+    async def _cached_view_response_async(self, route, request, params, executor):
+        """ _cached_view_response without blocking the loop, hits are answered on it directly """
+        cache = route.cache
+        key = cache.key(request, self._view_encoding(request))
+
+        response = cache.get(key)
+        if response is not None:
+            return response
+
+        loop = asyncio.get_running_loop()
+
+        leader, future = cache.begin(key)
+        if not leader:
+            # asyncio.wait leaves the future alone on timeout, unlike wait_for
+            await asyncio.wait([asyncio.wrap_future(future)], timeout=cache.collapse_timeout)
+
+            response = cache.get(key)
+            if response is not None:
+                return response
+
+        try:
+            if route.is_async:
+                response = await self._call_view_async(route, request, params)
+                await loop.run_in_executor(executor, self._compress_response, request, response)
+            else:
+                response = await loop.run_in_executor(executor, self._render_view, route, request, params)
+
+            cache.store(key, response)
+        finally:
+            if leader:
+                cache.end(key)
+
+        return response
+
+    def _view_encoding(self, request):
+        # cached responses are kept compressed, one entry per encoding
+        if self.compression is None:
+            return None
+
+        return self.compression.negotiate(request.headers.get("accept-encoding", ""))
+
+    def _compress_response(self, request, response):
+        """ Compresses a dynamic response body in place if the client accepts it """
+        if self.compression is None or response.status_code != HttpStatus.OK:
+            return
+
+        if "content-encoding" in response.headers.keys() or not self.compression.compressible(response.headers["content-type"]):
+            return
+
+        response.headers = {"vary": "accept-encoding"}
+
+        if isinstance(response, HttpStreamResponse):
+            if response.length is not None and response.length < self.compression.min_size:
+                return
+
+            encoding = self.compression.negotiate(request.headers.get("accept-encoding", ""))
+            if encoding is not None:
+                response.compress(self.compression.compressor(encoding), encoding)
+
+            return
+
+        data = response.data
+        if isinstance(data, str):
+            data = data.encode()
+
+        if not isinstance(data, (bytes, bytearray)) or len(data) < self.compression.min_size:
+            return
+
+        encoding = self.compression.negotiate(request.headers.get("accept-encoding", ""))
+        if encoding is not None:
+            response.data = self.compression.compress(data, encoding)
+            response.headers = {"content-encoding": encoding}
+
+    def _error_response(self, exception):
+        response = HttpResponse(exception.status_code)
+        if exception.headers is not None:
+            response.headers = exception.headers
+
+        return response
+
+    def _path(self, request):
+        return request.path
+
+    def _handle_resource(self, request):
+        url = self._path(request)
+        if url not in self.resources:
+            return HttpResponse(HttpStatus.Not_Found)
+
+        path = self.RESOURCE_DIR + url
+
+        try:
+            entry = None
+            if self.resource_cache is not None:
+                entry = self.resource_cache.get(path)
+
+            if entry is not None:
+                stat, headers = entry.stat, entry.headers
+            else:
+                stat = os.stat(path)
+                headers = HttpFileResponse.resource_headers(path, stat)
+        except OSError:
+            return HttpResponse(HttpStatus.Internal_Server_Error)
+
+        encoding = self._negotiate_static(request, headers, stat)
+        etag = headers["etag"]
+        if encoding is not None:
+            etag = self.compression.etag(etag, encoding)
+
+        if not self._modified(request, etag, stat.st_mtime):
+            response = HttpResponse(HttpStatus.Not_Modified)
+            response.headers = {"etag": etag, "last-modified": headers["last-modified"]}
+            if self.compression is not None and self.compression.compressible(headers["content-type"]):
+                response.headers = {"vary": "accept-encoding"}
+
+            return response
+
+        if encoding is not None:
+            try:
+                return self._create_compressed_resource_response(path, headers, entry, encoding, etag)
+            except OSError:
+                return HttpResponse(HttpStatus.Internal_Server_Error)
+
+        ranges = None
+        if request.method == HttpMethod.GET and "range" in request.headers.keys():
+            if self._if_range(request, headers["etag"], stat.st_mtime):
+                try:
+                    ranges = ByteRanges.parse(request.headers["range"], stat.st_size)
+                except HttpException as e:
+                    return self._error_response(e)
+
+        if entry is not None:
+            response = self._create_cached_resource_response(entry, ranges)
+        else:
+            response = self._create_static_resource_response(path, stat, ranges)
+
+        if self.compression is not None and self.compression.compressible(headers["content-type"]):
+            response.headers = {"vary": "accept-encoding"}
+
+        return response
+    
+    def _view_result(self, data):
+        """
+        Views return the body, or a complete HttpResponse. Iterators, async iterators
+        and file objects are streamed as they are read.
+        """
+        if isinstance(data, HttpResponse):
+            return data
+
+        if data is not None and not isinstance(data, (str, bytes, bytearray, memoryview)):
+            if hasattr(data, "read") or hasattr(data, "__iter__") or hasattr(data, "__aiter__"):
+                return HttpStreamResponse(HttpStatus.OK, data)
+
+        response = HttpResponse(HttpStatus.OK)
+        self._set_response_data(response, data)
+        return response
+
+    def _set_response_data(self, response, data):
+        d = ""
+        if data is not None:
+            d = data
+
+        response.data = d
+
+    def _modified(self, request, etag, modified_date):
+        # If-None-Match takes precedence over If-Modified-Since when both are sent
+        if "if-none-match" in request.headers.keys():
+            return not self._etag_matches(request.headers["if-none-match"], etag)
+
+        if "if-modified-since" in request.headers.keys():
+            try:
+                date = parsedate_to_datetime(request.headers["if-modified-since"])
+            except (TypeError, ValueError):
+                return True # invalid dates are ignored
+
+            return self._if_modified_since(modified_date, date)
+
+        return True
+
+    def _if_modified_since(self, modified_date, datetime):
+        unixtime = datetime.timestamp() # convert datetime obj to unix time
+        return int(modified_date) > unixtime
+
+    def _etag_matches(self, header_value, etag):
+        # weak comparison, see RFC 7232 section 2.3.2
+        if header_value.strip() == "*":
+            return True
+
+        etag = etag.removeprefix("W/")
+        for candidate in header_value.split(","):
+            if candidate.strip().removeprefix("W/") == etag:
+                return True
+
+        return False
+
+    def _if_range(self, request, etag, modified_date):
+        """ Returns True if the range request applies to the current representation """
+        if "if-range" not in request.headers.keys():
+            return True
+
+        value = request.headers["if-range"].strip()
+        if value.startswith("W/") or etag.startswith("W/"):
+            return False # If-Range needs a strong validator
+
+        if value.startswith('"'):
+            return value == etag
+
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return False
+
+        return int(modified_date) == int(date.timestamp())
+
+    def _negotiate_static(self, request, headers, stat):
+        if self.compression is None or "range" in request.headers.keys():
+            return None # ranges always apply to the identity encoding
+
+        if stat.st_size < self.compression.min_size or stat.st_size > self.compression.max_file_size:
+            return None
+
+        if not self.compression.compressible(headers["content-type"]):
+            return None
+
+        return self.compression.negotiate(request.headers.get("accept-encoding", ""))
+
+    def _create_compressed_resource_response(self, path, headers, entry, encoding, etag):
+        sibling, sibling_stat = self.compression.sibling(path, encoding)
+        if sibling is not None:
+            response = HttpFileResponse(HttpStatus.OK, sibling, sibling_stat)
+        else:
+            data = entry.data if entry is not None else None
+            response = HttpResponse(HttpStatus.OK)
+            response.data = self.compression.get(path, headers["etag"], encoding, data)
+
+        response.headers = {
+            "content-type": headers["content-type"],
+            "last-modified": headers["last-modified"],
+            "etag": etag,
+            "content-encoding": encoding,
+            "vary": "accept-encoding"
+        }
+
+        # byte ranges are only offered on the identity encoding
+        response.headers.pop("accept-ranges", None)
+
+        return response
+
+    def _create_cached_resource_response(self, entry, ranges):
+        if ranges is None:
+            response = HttpResponse(HttpStatus.OK)
+            response.headers = entry.headers
+            response.data = entry.data
+        else:
+            response = HttpResponse(HttpStatus.Partial_Content)
+            response.headers = entry.headers
+            response.headers = ranges.headers(entry.headers["content-type"])
+            response.data = ranges.join(entry.data, entry.headers["content-type"])
+
+        return response
+
+    def _create_static_resource_response(self, resource_path, stat=None, ranges=None):
+        response = None
+        try:
+            status_code = HttpStatus.OK if ranges is None else HttpStatus.Partial_Content
+            response = HttpFileResponse(status_code, resource_path, stat, ranges)
+        except:
+            response = HttpResponse(HttpStatus.Internal_Server_Error)
+
+        return response
+            
+class Resolver():
+    """
+    Resolves upstream host names for the proxy. Answers are cached for ttl seconds,
+    failures for negative_ttl. Concurrent lookups of the same name share one
+    getaddrinfo call, run on a small thread pool so waiting can time out. Names in
+    hosts (an /etc/hosts style file) are answered without a lookup, and lookup can
+    be replaced with a stub taking getaddrinfo's arguments.
+    """
+    # RFC 8305 connection attempt delay
+    ATTEMPT_DELAY = 0.25
+
+    def __init__(self, ttl=60, negative_ttl=5, max_entries=1024, hosts=None, lookup=None, workers=4,
+                 timeout=10):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+
+        if lookup is None:
+            lookup = getaddrinfo
+
+        self.lookup = lookup
+        self.hosts = {}
+        if hosts is not None:
+            self.hosts = Resolver.read_hosts(hosts)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict() # (host, port) -> (expires, addresses or gaierror)
+        self._inflight = {}           # (host, port) -> Future of the running lookup
+        self._executor = ThreadPoolExecutor(workers, "resolver")
+        self._lock = Lock()
+
+    @staticmethod
+    def read_hosts(path):
+        """ Parses a hosts file into {name: [address]} """
+        hosts = {}
+        with open(path) as f:
+            for line in f:
+                fields = line.partition("#")[0].split()
+                for name in fields[1:]:
+                    hosts.setdefault(name.lower(), []).append(fields[0])
+
+        return hosts
+
+    def resolve(self, host, port):
+        """ Returns getaddrinfo style (family, type, proto, canonname, sockaddr) tuples for a stream connection """
+        key = (host.lower(), port)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._answer(entry[1])
+
+            self.misses += 1
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._lookup, key)
+                self._inflight[key] = future
+
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise timeout(f"Resolving {host} timed out")
+
+    def forget(self, host, port):
+        """ Drops a cached answer, e.g. once none of its addresses could be reached """
+        with self._lock:
+            self._entries.pop((host.lower(), port), None)
+
+    def connect(self, host, port, connect_timeout=None):
+        """
+        Connects to host, trying its addresses happy eyeballs style: families
+        alternate, and a new attempt starts every ATTEMPT_DELAY seconds, or as soon
+        as one fails, while earlier attempts are still pending. The first to connect
+        wins. Returns a blocking socket.
+        """
+        addresses = Resolver.interleave(self.resolve(host, port))
+        deadline = None if connect_timeout is None else time.monotonic() + connect_timeout
+        pending = {}
+        error = OSError(f"No addresses for {host}")
+        start_next = 0
+
+        try:
+            while len(addresses) > 0 or len(pending) > 0:
+                now = time.monotonic()
+                if deadline is not None and now >= deadline:
+                    raise timeout(f"Connecting to {host}:{port} timed out")
+
+                if len(addresses) > 0 and (now >= start_next or len(pending) == 0):
+                    family, kind, proto, _, sockaddr = addresses.pop(0)
+                    sock = socket(family, kind, proto)
+                    sock.setblocking(False)
+                    result = sock.connect_ex(sockaddr)
+                    if result == 0:
+                        return self._connected(sock, pending)
+
+                    if result not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        sock.close()
+                        error = OSError(result, os.strerror(result))
+                        continue
+
+                    pending[sock] = sockaddr
+                    start_next = now + Resolver.ATTEMPT_DELAY
+
+                wait = deadline
+                if len(addresses) > 0:
+                    wait = start_next if deadline is None else min(start_next, deadline)
+
+                _, writable, _ = select([], list(pending), [], None if wait is None else max(0, wait - now))
+                for sock in writable:
+                    result = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+                    if result == 0:
+                        del pending[sock]
+                        return self._connected(sock, pending)
+
+                    del pending[sock]
+                    sock.close()
+                    error = OSError(result, os.strerror(result))
+                    start_next = 0 # the next address doesn't wait for a failed one
+        except BaseException:
+            for sock in pending:
+                sock.close()
+
+            raise
+
+        self.forget(host, port)
+        raise error
+
+    @staticmethod
+    def interleave(addresses):
+        """ Alternates address families, starting with the first one getaddrinfo preferred """
+        families = OrderedDict()
+        for address in addresses:
+            families.setdefault(address[0], []).append(address)
+
+        ordered = []
+        groups = list(families.values())
+        while any(len(group) > 0 for group in groups):
+            for group in groups:
+                if len(group) > 0:
+                    ordered.append(group.pop(0))
+
+        return ordered
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _lookup(self, key):
+        host, port = key
+        try:
+            if host in self.hosts:
+                addresses = []
+                for address in self.hosts[host]:
+                    addresses += getaddrinfo(address, port, 0, SOCK_STREAM, 0, AI_NUMERICHOST)
+            else:
+                addresses = self.lookup(host, port, 0, SOCK_STREAM)
+
+            answer, ttl = addresses, self.ttl
+        except gaierror as e:
+            answer, ttl = e, self.negative_ttl
+        except BaseException:
+            # nothing to cache, but the next caller must start a lookup of its own
+            with self._lock:
+                self._inflight.pop(key, None)
+
+            raise
+
+        with self._lock:
+            self._inflight.pop(key, None)
+            if ttl > 0:
+                self._entries[key] = (time.monotonic() + ttl, answer)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return self._answer(answer)
+
+    def _answer(self, answer):
+        if isinstance(answer, gaierror):
+            raise answer
+
+        return answer
+
+    def _connected(self, sock, pending):
+        for other in pending:
+            other.close()
+
+        pending.clear()
+        sock.setblocking(True)
+        return sock
+
+class UpstreamPool():
+    """
+    Idle keep-alive connections to upstream servers, kept per (host, port). New
+    connections resolve and connect through resolver.
+    """
+    def __init__(self, max_idle=8, idle_timeout=30, connect_timeout=10, read_timeout=30, resolver=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        if resolver is None:
+            resolver = Resolver(timeout=connect_timeout)
+
+        self.resolver = resolver
+
+        self._idle = {} # (host, port) -> [(socket, released_at)]
+        self._lock = Lock()
+
+    def acquire(self, host, port):
+        """ Returns (socket, reused). Reused sockets may still turn out to be closed by upstream """
+        now = time.monotonic()
+
+        with self._lock:
+            idle = self._idle.get((host, port), [])
+            while len(idle) > 0:
+                sock, released_at = idle.pop()
+                if now - released_at < self.idle_timeout and self._alive(sock):
+                    return sock, True
+
+                sock.close()
+
+        sock = self.resolver.connect(host, port, self.connect_timeout)
+        sock.settimeout(self.read_timeout)
+        return sock, False
+
+    def release(self, host, port, sock):
+        with self._lock:
+            idle = self._idle.setdefault((host, port), [])
+            if len(idle) < self.max_idle:
+                idle.append((sock, time.monotonic()))
+                return
+
+        sock.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for sock, _ in idle:
+                    sock.close()
+
+            self._idle = {}
+
+    def _alive(self, sock):
+        # an idle connection upstream has closed reads as EOF straight away
+        sock.setblocking(False)
+        try:
+            return sock.recv(1, MSG_PEEK) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(self.read_timeout)
+
+class ProxyCacheEntry():
+    def __init__(self, key, status_line, headers, body, path, size, lifetime, age, etag, last_modified,
+                 no_cache, must_revalidate):
+        self.key = key
+        self.status_line = status_line
+        self.headers = headers # "name: value" lines, without framing headers
+        self.body = body       # None when the body lives on disk at path
+        self.path = path
+        self.size = size
+        self.lifetime = lifetime
+        self.initial_age = age
+        self.stored_at = time.time()
+        self.etag = etag
+        self.last_modified = last_modified
+        self.no_cache = no_cache
+        self.must_revalidate = must_revalidate
+
+    def age(self):
+        return int(self.initial_age + time.time() - self.stored_at)
+
+    def validators(self):
+        """ Conditional request headers to revalidate this entry upstream """
+        validators = {}
+        if self.etag is not None:
+            validators["if-none-match"] = self.etag
+
+        if self.last_modified is not None:
+            validators["if-modified-since"] = self.last_modified
+
+        return validators
+
+class ProxyCache():
+    """
+    Shared HTTP cache for ProxyServer. Small bodies are kept in memory, bodies over
+    disk_threshold are written to disk_dir (if given) and served with sendfile. Both
+    tiers are size bounded LRUs. Concurrent misses for the same url are collapsed
+    into a single upstream request.
+    """
+    CACHEABLE = [200, 203, 301, 404, 410]
+
+    MAX_HEURISTIC_LIFETIME = 86400
+
+    def __init__(self, max_bytes=67108864, max_entry_size=8388608, disk_dir=None, disk_threshold=262144,
+                 max_disk_bytes=1073741824, collapse_timeout=10):
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_entry_size
+        self.disk_dir = disk_dir
+        self.disk_threshold = disk_threshold
+        self.max_disk_bytes = max_disk_bytes
+        self.collapse_timeout = collapse_timeout
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_size = 0
+        self.disk_size = 0
+
+        self._entries = OrderedDict() # (key, vary values) -> entry
+        self._vary = {}               # key -> header names the response varies on
+        self._variants = {}           # key -> set of (key, vary values)
+        self._inflight = {}           # key -> Event set once the leading request is done
+        self._lock = Lock()
+
+    @staticmethod
+    def directives(header_value):
+        """ Parses a cache-control header into {directive: value} """
+        directives = {}
+        for part in header_value.split(","):
+            name, _, value = part.strip().partition("=")
+            if name != "":
+                directives[name.lower()] = value.strip().strip('"')
+
+        return directives
+
+    def lookup(self, key, request_headers):
+        with self._lock:
+            names = self._vary.get(key)
+            if names is None:
+                return None
+
+            variant = self._variant(key, names, request_headers)
+            entry = self._entries.get(variant)
+            if entry is not None:
+                self._entries.move_to_end(variant)
+
+            return entry
+
+    def begin(self, key):
+        """ Returns (leader, event). Only the leader fetches, the others wait on event """
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is not None:
+                return False, event
+
+            event = Event()
+            self._inflight[key] = event
+            return True, event
+
+    def end(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+
+        if event is not None:
+            event.set()
+
+    def fresh(self, entry, directives):
+        """ Whether entry can be served without revalidation, given the request's cache-control """
+        if entry.no_cache or "no-cache" in directives.keys():
+            return False
+
+        age = entry.age()
+        lifetime = entry.lifetime
+
+        max_age = self._seconds(directives.get("max-age"))
+        if max_age is not None:
+            lifetime = min(lifetime, max_age)
+
+        min_fresh = self._seconds(directives.get("min-fresh"))
+        if min_fresh is not None:
+            age += min_fresh
+
+        if age < lifetime:
+            return True
+
+        if "max-stale" not in directives.keys() or entry.must_revalidate:
+            return False
+
+        max_stale = self._seconds(directives["max-stale"])
+        return max_stale is None or age - lifetime <= max_stale
+
+    def store(self, key, request, relay):
+        """ Stores the response relay captured, if it is cacheable. Returns whether it was stored """
+        headers = relay.header_names
+        if relay.status_code not in self.CACHEABLE:
+            return False
+
+        directives = self.directives(headers.get("cache-control", ""))
+        if "no-store" in directives.keys() or "private" in directives.keys():
+            return False
+
+        shared = "public" in directives.keys() or "s-maxage" in directives.keys()
+        if "authorization" in request.headers.keys() and not shared:
+            return False
+
+        names = [name.strip().lower() for name in headers.get("vary", "").split(",") if name.strip() != ""]
+        if "*" in names:
+            return False
+
+        lifetime = self._lifetime(relay.status_code, headers, directives)
+        etag = headers.get("etag")
+        last_modified = headers.get("last-modified")
+        if lifetime is None:
+            if etag is None and last_modified is None:
+                return False
+
+            lifetime = 0 # stored, but revalidated on every use
+
+        body = bytes(relay.captured)
+        path = None
+        if self.disk_dir is not None and len(body) > self.disk_threshold:
+            path = os.path.join(self.disk_dir, uuid.uuid4().hex)
+            try:
+                with open(path, "wb") as f:
+                    f.write(body)
+            except OSError:
+                return False
+
+            body = None
+
+        variant = self._variant(key, names, request.headers)
+        entry = ProxyCacheEntry(variant, relay.status_line, self._stored_headers(relay.headers), body, path,
+                                len(relay.captured), lifetime, self._seconds(headers.get("age")) or 0, etag,
+                                last_modified, "no-cache" in directives.keys(),
+                                "must-revalidate" in directives.keys() or "proxy-revalidate" in directives.keys())
+
+        with self._lock:
+            if self._vary.get(key) != names:
+                self._invalidate(key)
+                self._vary[key] = names
+
+            self._remove(variant)
+            self._entries[variant] = entry
+            self._variants.setdefault(key, set()).add(variant)
+            if path is None:
+                self.memory_size += entry.size
+            else:
+                self.disk_size += entry.size
+
+            self._evict()
+
+        return True
+
+    def refresh(self, entry, relay):
+        """ Updates entry from a 304 response to its revalidation """
+        updated = self._stored_headers(relay.headers)
+        names = set(line.partition(":")[0].lower() for line in updated)
+        headers = [line for line in entry.headers if line.partition(":")[0].lower() not in names] + updated
+
+        header_names = {}
+        for line in headers:
+            name, _, value = line.partition(":")
+            header_names[name.lower()] = value.strip()
+
+        directives = self.directives(header_names.get("cache-control", ""))
+        status_code = int(entry.status_line.split(" ", 2)[1])
+
+        entry.headers = headers
+        entry.lifetime = self._lifetime(status_code, header_names, directives) or 0
+        entry.initial_age = self._seconds(relay.header_names.get("age")) or 0
+        entry.stored_at = time.time()
+        entry.etag = header_names.get("etag", entry.etag)
+        entry.last_modified = header_names.get("last-modified", entry.last_modified)
+        entry.no_cache = "no-cache" in directives.keys()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            for variant in list(self._entries.keys()):
+                self._remove(variant)
+
+            self._vary = {}
+
+    def _invalidate(self, key):
+        for variant in list(self._variants.get(key, [])):
+            self._remove(variant)
+
+        self._vary.pop(key, None)
+
+    def _remove(self, variant):
+        entry = self._entries.pop(variant, None)
+        if entry is None:
+            return
+
+        variants = self._variants.get(variant[0])
+        if variants is not None:
+            variants.discard(variant)
+            if len(variants) == 0:
+                del self._variants[variant[0]]
+
+        if entry.path is None:
+            self.memory_size -= entry.size
+            return
+
+        self.disk_size -= entry.size
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        for variant in list(self._entries.keys()):
+            if self.memory_size <= self.max_bytes and self.disk_size <= self.max_disk_bytes:
+                break
+
+            entry = self._entries[variant]
+            if entry.path is None and self.memory_size > self.max_bytes:
+                self._remove(variant)
+            elif entry.path is not None and self.disk_size > self.max_disk_bytes:
+                self._remove(variant)
+
+    def _variant(self, key, names, request_headers):
+        return (key, tuple(request_headers.get(name, "") for name in names))
+
+    def _stored_headers(self, headers):
+        # framing is recomputed when serving, and age is added from the entry
+        skip = ["content-length", "transfer-encoding", "age"]
+        return [line for line in headers if line.partition(":")[0].lower() not in skip]
+
+    def _lifetime(self, status_code, headers, directives):
+        """ Freshness lifetime in seconds, None if the response gives none """
+        for name in ["s-maxage", "max-age"]:
+            seconds = self._seconds(directives.get(name))
+            if seconds is not None:
+                return seconds
+
+        date = self._timestamp(headers.get("date"))
+        if date is None:
+            date = time.time()
+
+        if "expires" in headers.keys():
+            expires = self._timestamp(headers["expires"])
+            if expires is None:
+                return 0 # an invalid expires means already expired
+
+            return max(0, int(expires - date))
+
+        # heuristic freshness, a fraction of the time since the resource last changed
+        last_modified = self._timestamp(headers.get("last-modified"))
+        if last_modified is not None and status_code in self.CACHEABLE:
+            return min(max(0, int((date - last_modified) / 10)), self.MAX_HEURISTIC_LIFETIME)
+
+        return None
+
+    def _seconds(self, value):
+        if value is None or not value.isdigit():
+            return None
+
+        return int(value)
+
+    def _timestamp(self, value):
+        if value is None:
+            return None
+
+        try:
+            return parsedate_to_datetime(value).timestamp()
+        except (TypeError, ValueError):
+            return None
+
+class HttpProxyRequestHandler():
+    # headers that only apply to a single connection and are never forwarded
+    HOP_BY_HOP = [
+        "connection",
+        "keep-alive",
+        "proxy-connection",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "upgrade"
+    ]
+
+    MAX_HEADER_SIZE = 65536
+
+    # what CONNECT may reach by default, tunnels are for TLS
+    TUNNEL_PORTS = [443]
+
+    def __init__(self, pool=None, cache=None, recv_size=65536, logger=None, client=None, metrics=None,
+                 tunnel_ports=TUNNEL_PORTS, tunnel_timeout=300):
+        if logger is None:
+            logger = ConsoleLogger()
+
+        self.logger = logger
+        self.client = client
+        self.metrics = metrics
+
+        if pool is None:
+            pool = UpstreamPool()
+
+        self.pool = pool
+        self.cache = cache
+
+        # ports CONNECT may reach, None for any, and how long a tunnel may sit idle
+        self.tunnel_ports = tunnel_ports
+        self.tunnel_timeout = tunnel_timeout
+
+        self._buffer = bytearray(recv_size)
+        self._view = memoryview(self._buffer)
+
+    def handle(self, message, connection, reader):
+        """
+        Forwards the request upstream and relays the response to connection while it
+        arrives. Returns an error response to send instead, or None once relayed.
+        """
+        request_parser = HttpRequestParser()
+        request = reader.request
+        response = None
+        
+        try:
+            if request is None:
+                request = request_parser.parse(message)
+        except HttpException as e:
+            response = HttpResponse(e.status_code)
+            self.logger.http_connection(response.status_code, request, self.client)
+            return response
+        except Exception:
+            response = HttpResponse(HttpStatus.Bad_Request)
+            self.logger.http_connection(response.status_code, request, self.client)
+            return response
+
+        if request.method == HttpMethod.CONNECT:
+            return self._tunnel(request, connection, reader)
+
+        if request.method in ["POST", "PUT"] and "content-length" not in request.headers.keys():
+            response = HttpResponse(HttpStatus.Length_Required)
+            self.logger.http_connection(response.status_code, request, self.client)
+            return response
+
+        try:
+            host, port, path = self._target(request)
+        except ValueError:
+            response = HttpResponse(HttpStatus.Bad_Request)
+            self.logger.http_connection(response.status_code, request, self.client)
+            return response
+
+        # Modify request
+        request.url = path
+        for header in HttpProxyRequestHandler.HOP_BY_HOP:
+            request.headers.pop(header, None)
+
+        # the body has been read in full already, upstream has nothing to wait for
+        request.headers.pop("expect", None)
+
+        request.headers["connection"] = "keep-alive"
+
+        self.logger.proxy_connection(request, self.client)
+
+        key = f"{host}:{port}{path}"
+
+        if self.cache is not None and request.method == HttpMethod.GET:
+            return self._handle_cacheable(request, key, host, port, connection, reader)
+
+        response, _ = self._forward(request, host, port, connection, reader)
+
+        # unsafe methods make any cached copy of the url stale
+        if self.cache is not None and request.method in [HttpMethod.POST, HttpMethod.PUT, HttpMethod.DELETE]:
+            self.cache.invalidate(key)
+
+        return response
+
+    def _forward(self, request, host, port, connection, reader, revalidating=False, capture_limit=0):
+        """
+        Sends request upstream and relays the response to connection. Returns (response, relay),
+        where response is an error to send instead. When revalidating, a 304 is not relayed
+        so the caller can answer from its cached copy.
+        """
+        # Make request to destination webserver, retrying once if a pooled connection went stale
+        outgoing = request.serialize()
+        for attempt in range(2):
+            try:
+                sock, reused = self.pool.acquire(host, port)
+            except timeout:
+                return self._upstream_timeout(), None
+            except (OSError, ValueError):
+                # ValueError covers names that can't be encoded, e.g. a label over 63 characters
+                return HttpResponse(HttpStatus.Bad_Gateway), None
+
+            relay = HttpUpstreamRelay(request, sock, connection, self._buffer, self._view)
+            try:
+                sock.sendall(outgoing)
+                relay.read_head()
+                if revalidating and relay.status_code == HttpStatus.Not_Modified:
+                    reusable = relay.reusable
+                else:
+                    reusable = relay.relay(reader, capture_limit)
+            except (OSError, HttpException) as e:
+                sock.close()
+                if relay.started:
+                    reader.keep_alive = False # the client already has part of the response
+                    return None, None
+
+                if reused and attempt == 0 and relay.received == 0:
+                    continue
+
+                if isinstance(e, timeout):
+                    return self._upstream_timeout(), None
+
+                return HttpResponse(HttpStatus.Bad_Gateway), None
+
+            if reusable:
+                self.pool.release(host, port, sock)
+            else:
+                sock.close()
+
+            return None, relay
+
+    def _tunnel(self, request, connection, reader):
+        """ Answers CONNECT by relaying bytes between the client and host:port until the tunnel closes """
+        host, _, port = request.url.rpartition(":")
+        host, port = host.strip("[]"), int(port)
+
+        if self.tunnel_ports is not None and port not in self.tunnel_ports:
+            response = HttpResponse(HttpStatus.Forbidden)
+            self.logger.http_connection(response.status_code, request, self.client)
+            return response
+
+        try:
+            upstream = self.pool.resolver.connect(host, port, self.pool.connect_timeout)
+        except timeout:
+            return self._upstream_timeout()
+        except (OSError, ValueError):
+            return HttpResponse(HttpStatus.Bad_Gateway)
+
+        self.logger.proxy_connection(request, self.client)
+
+        # the connection is the tunnel's from here on
+        reader.keep_alive = False
+        try:
+            upstream.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            connection.sendall(HttpStatus.status_line(HttpStatus.OK) + b"\r\n")
+
+            # whatever the client sent after the CONNECT head already belongs to the tunnel
+            if len(reader.buffer) > 0:
+                upstream.sendall(reader.buffer)
+                reader.buffer.clear()
+
+            HttpTunnel(connection, upstream, self.tunnel_timeout, self._view).run()
+        except OSError:
+            pass
+        finally:
+            upstream.close()
+
+        return None
+
+    def _upstream_timeout(self):
+        if self.metrics is not None:
+            self.metrics.timed_out("upstream")
+
+        return HttpResponse(HttpStatus.Gateway_Timeout)
+
+    def _handle_cacheable(self, request, key, host, port, connection, reader):
+        directives = ProxyCache.directives(request.headers.get("cache-control", ""))
+        if "no-store" in directives.keys():
+            response, _ = self._forward(request, host, port, connection, reader)
+            return response
+
+        entry = self.cache.lookup(key, request.headers)
+        if entry is None and "only-if-cached" in directives.keys():
+            return HttpResponse(HttpStatus.Gateway_Timeout)
+
+        leader = False
+        if entry is None:
+            # concurrent misses for the same url wait for a single upstream fetch
+            leader, event = self.cache.begin(key)
+            if not leader:
+                event.wait(self.cache.collapse_timeout)
+                entry = self.cache.lookup(key, request.headers)
+
+        try:
+            if entry is not None and self.cache.fresh(entry, directives):
+                if self._send_cached(entry, request, connection, reader):
+                    self.cache.hits += 1
+                    return None
+
+            self.cache.misses += 1
+
+            # revalidate the cached copy with its own validators instead of the client's
+            client_conditionals = {}
+            if entry is not None:
+                for header in ["if-none-match", "if-modified-since"]:
+                    if header in request.headers.keys():
+                        client_conditionals[header] = request.headers.pop(header)
+
+                request.headers.update(entry.validators())
+
+            response, relay = self._forward(request, host, port, connection, reader,
+                                            revalidating=entry is not None, capture_limit=self.cache.max_entry_size)
+            if response is not None or relay is None:
+                return response
+
+            if entry is not None and relay.status_code == HttpStatus.Not_Modified:
+                self.cache.refresh(entry, relay)
+                for header in entry.validators().keys():
+                    request.headers.pop(header, None)
+
+                request.headers.update(client_conditionals)
+                if not self._send_cached(entry, request, connection, reader):
+                    return HttpResponse(HttpStatus.Bad_Gateway)
+
+                return None
+
+            if relay.captured is not None:
+                self.cache.store(key, request, relay)
+
+            return None
+        finally:
+            if leader:
+                self.cache.end(key)
+
+    def _send_cached(self, entry, request, connection, reader):
+        """ Answers from entry. Returns False if its body was evicted from disk before it could be sent """
+        connection_header = "connection: " + ("keep-alive" if reader.keep_alive else "close")
+
+        if entry.etag is not None and "if-none-match" in request.headers.keys():
+            tags = [tag.strip().removeprefix("W/") for tag in request.headers["if-none-match"].split(",")]
+            if entry.etag.removeprefix("W/") in tags:
+                head = ["HTTP/1.1 304 Not Modified", f"etag: {entry.etag}", f"age: {entry.age()}", connection_header]
+                connection.sendall(("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1"))
+                return True
+
+        file = None
+        if entry.path is not None:
+            try:
+                file = open(entry.path, "rb")
+            except OSError:
+                return False
+
+        head = [entry.status_line] + entry.headers
+        head.append(f"content-length: {entry.size}")
+        head.append(f"age: {entry.age()}")
+        head.append(connection_header)
+        head = ("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1")
+
+        if file is None:
+            HttpResponse.send_buffers(connection, [head, entry.body])
+            return True
+
+        with file:
+            HttpResponse.send_buffers(connection, [head], SEND_MORE if entry.size > 0 else 0)
+            HttpFileResponse.sendfile(connection, file, 0, entry.size)
+
+        return True
+
+    def _target(self, request):
+        """ Returns (host, port, path) from the absolute url, falling back to the host header """
+        url = request.url
+        if url.startswith("http://"):
+            parts = urlsplit(url)
+            authority = parts.netloc
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+        else:
+            authority = request.headers.get("host", "")
+            path = url
+
+        host, _, port = authority.rpartition(":")
+        if host == "" or not port.isdigit():
+            host, port = authority, 80 # no port given, or an IPv6 literal without one
+
+        host = host.strip("[]")
+        if host == "":
+            raise ValueError("No upstream host in request")
+
+        return host, int(port), path
+
+class HttpTunnel():
+    """
+    Relays bytes both ways between a client and an upstream socket until both sides
+    have closed, or neither has sent anything for idle_timeout. Between plain
+    sockets the bytes move through a pipe with os.splice and never enter Python,
+    otherwise they are copied through view.
+    """
+    def __init__(self, client, upstream, idle_timeout=300, view=None):
+        self.client = client
+        self.upstream = upstream
+        self.idle_timeout = idle_timeout
+
+        if view is None:
+            view = memoryview(bytearray(65536))
+
+        self._view = view
+        self._splice = hasattr(os, "splice") and not any(HttpResponse.encrypted(sock) for sock in [client, upstream])
+
+    def run(self):
+        peers = {self.client: self.upstream, self.upstream: self.client}
+        reading = [self.client, self.upstream]
+
+        # one pipe per direction, splice needs one between two sockets
+        pipes = {}
+        if self._splice:
+            pipes = {self.client: os.pipe(), self.upstream: os.pipe()}
+
+        for sock in reading:
+            sock.setblocking(True)
+
+        try:
+            while len(reading) > 0:
+                # a TLS socket can hold decrypted bytes that select doesn't know about
+                ready = [sock for sock in reading if HttpResponse.encrypted(sock) and sock.pending() > 0]
+                if len(ready) == 0:
+                    ready = select(reading, [], [], self.idle_timeout)[0]
+                    if len(ready) == 0:
+                        return # idle
+
+                for sock in ready:
+                    moved = self._move(sock, peers[sock], pipes.get(sock))
+                    if moved != 0:
+                        continue
+
+                    # pass the half close on, a TLS socket can't send one so the tunnel ends
+                    reading.remove(sock)
+                    if HttpResponse.encrypted(peers[sock]) or HttpResponse.encrypted(sock):
+                        return
+
+                    try:
+                        peers[sock].shutdown(SHUT_WR)
+                    except OSError:
+                        return
+        finally:
+            for read_end, write_end in pipes.values():
+                os.close(read_end)
+                os.close(write_end)
+
+    def _move(self, source, destination, pipe):
+        """ Moves what is available from source to destination. Returns 0 at EOF, None if nothing was there """
+        if pipe is None:
+            received = source.recv_into(self._view)
+            if received > 0:
+                destination.sendall(self._view[:received])
+
+            return received
+
+        read_end, write_end = pipe
+        try:
+            received = os.splice(source.fileno(), write_end, len(self._view), flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+
+        left = received
+        while left > 0:
+            left -= os.splice(read_end, destination.fileno(), left, flags=os.SPLICE_F_MOVE)
+
+        return received
+
+class HttpUpstreamRelay():
+    """
+    Reads one response off an upstream socket and relays it to the client as it arrives,
+    using the handler's receive buffer. Handles content-length, chunked and
+    close-delimited bodies.
+    """
+    # the reason phrase may be empty, or left out along with the space before it
+    STATUS_LINE = re.compile(r"(HTTP/1\.[01]) ([0-9]{3})(?: .*)?")
+
+    def __init__(self, request, sock, connection, buffer, view):
+        self.request = request
+        self.sock = sock
+        self.connection = connection
+        self.buffer = buffer
+        self.view = view
+
+        self.received = 0
+        self.started = False
+
+        self.status_line = None
+        self.captured = None
+
+    def read_head(self):
+        """ Reads and parses the status line and headers of the upstream response, past any interim 1xx ones """
+        head, self.body_start = self._read_head()
+        while HttpUpstreamRelay.interim(head):
+            head, self.body_start = self._read_head(self.body_start)
+
+        self.status_line, _, header_block = head.partition("\r\n")
+        match = HttpUpstreamRelay.STATUS_LINE.fullmatch(self.status_line)
+        if match is None:
+            raise HttpException(HttpStatus.Bad_Gateway)
+
+        version, self.status_code = match.group(1), int(match.group(2))
+
+        self.headers = []       # forwarded "name: value" lines
+        self.header_names = {}  # lowercased name -> value, hop-by-hop included
+        for line in header_block.split("\r\n"):
+            if ":" not in line:
+                continue
+
+            key, value = line.split(":", 1)
+            key = key.strip()
+            self.header_names[key.lower()] = value.strip()
+            if key.lower() not in HttpProxyRequestHandler.HOP_BY_HOP:
+                self.headers.append(f"{key}: {value.strip()}")
+
+        self.reusable = version == "HTTP/1.1" and self.header_names.get("connection", "").lower() != "close"
+
+    @staticmethod
+    def interim(head):
+        # 100 Continue, 103 Early Hints and the like come before the final response, 101 is final
+        status_code = head.split(" ", 2)[1] if head.count(" ") > 0 else ""
+        return len(status_code) == 3 and status_code.startswith("1") and status_code != "101"
+
+    def relay(self, reader, capture_limit=0):
+        """
+        Relays the response to the client. Returns True if the upstream connection can
+        be reused. With a capture_limit the decoded body is also kept in captured, as
+        long as it fits.
+        """
+        if self.status_line is None:
+            self.read_head()
+
+        self._capture_limit = capture_limit
+        if capture_limit > 0:
+            self.captured = bytearray()
+
+        reusable = self.reusable
+        header_names = self.header_names
+        status_code = self.status_code
+        headers = list(self.headers)
+        body_start = self.body_start
+
+        if self.request.method == HttpMethod.HEAD or status_code < 200 or status_code in [204, 304]:
+            framing, length = "length", 0
+        elif header_names.get("transfer-encoding", "").lower() == "chunked":
+            framing, length = "chunked", None
+        elif "content-length" in header_names.keys():
+            length = header_names["content-length"]
+            if not (length.isascii() and length.isdigit()):
+                raise HttpException(HttpStatus.Bad_Gateway)
+
+            framing, length = "length", int(length)
+        else:
+            # body runs until upstream closes, so the client can't be kept alive either
+            framing, length = "close", None
+            reusable = False
+            reader.keep_alive = False
+
+        headers.append("connection: " + ("keep-alive" if reader.keep_alive else "close"))
+
+        self.started = True
+        self.connection.sendall((self.status_line + "\r\n" + "\r\n".join(headers) + "\r\n\r\n").encode("iso-8859-1"))
+
+        if framing == "length":
+            extra = self._relay_length(body_start, length)
+        elif framing == "chunked":
+            extra = self._relay_chunked(body_start)
+        else:
+            self._relay_until_close(body_start)
+            extra = 0
+
+        return reusable and extra == 0
+
+    def _capture(self, data):
+        if self.captured is None:
+            return
+
+        if len(self.captured) + len(data) > self._capture_limit:
+            self.captured = None # too big to keep
+            return
+
+        self.captured += data
+
+    def _read_head(self, pending=b""):
+        # pending is what followed an interim response, the start of the next head
+        head = bytearray(pending)
+        scanned = 0
+        while True:
+            header_end = head.find(b"\r\n\r\n", scanned)
+            if header_end != -1:
+                break
+
+            if len(head) > HttpProxyRequestHandler.MAX_HEADER_SIZE:
+                raise HttpException(HttpStatus.Bad_Gateway)
+
+            scanned = max(0, len(head) - 3)
+
+            n = self.sock.recv_into(self.buffer)
+            if n == 0:
+                raise ConnectionError("Upstream closed the connection")
+
+            self.received += n
+            head += self.view[:n]
+
+        return head[:header_end].decode("iso-8859-1"), head[header_end + 4:]
+
+    def _relay_length(self, body_start, length):
+        """ Relays exactly length bytes, returns how many unexpected bytes followed """
+        first = min(len(body_start), length)
+        if first > 0:
+            self.connection.sendall(body_start[:first])
+            self._capture(body_start[:first])
+
+        remaining = length - first
+        while remaining > 0:
+            n = self.sock.recv_into(self.buffer, min(remaining, len(self.buffer)))
+            if n == 0:
+                raise ConnectionError("Upstream closed the connection mid body")
+
+            self.connection.sendall(self.view[:n])
+            self._capture(self.view[:n])
+            remaining -= n
+
+        return len(body_start) - first
+
+    def _relay_chunked(self, body_start):
+        # chunks are passed through untouched, the decoder only finds the end of the body
+        decoder = ChunkedDecoder()
+        decoded = bytearray() if self.captured is not None else None
+
+        consumed = decoder.feed(body_start, out=decoded)
+        self.connection.sendall(body_start[:consumed])
+        extra = len(body_start) - consumed
+
+        while not decoder.done:
+            if decoded is not None:
+                self._capture(decoded)
+                decoded = bytearray() if self.captured is not None else None
+
+            n = self.sock.recv_into(self.buffer)
+            if n == 0:
+                raise ConnectionError("Upstream closed the connection mid body")
+
+            consumed = decoder.feed(self.buffer, 0, n, out=decoded)
+            self.connection.sendall(self.view[:consumed])
+            extra = n - consumed
+
+        if decoded is not None:
+            self._capture(decoded)
+
+        return extra
+
+    def _relay_until_close(self, body_start):
+        if len(body_start) > 0:
+            self.connection.sendall(body_start)
+            self._capture(body_start)
+
+        while True:
+            n = self.sock.recv_into(self.buffer)
+            if n == 0:
+                break
+
+            self.connection.sendall(self.view[:n])
+            self._capture(self.view[:n])
+
+class HttpRequest():
+    VERSIONS = ["HTTP/1.0", "HTTP/1.1"]
+
+    def __init__(self):
+        self._method = None
+        self._url = None
+        self._version = None
+        self._headers = None
+        self._data = None
+        self._body = None
+        self._stream = None
+        self._form = None
+
+        # the header lines as received, decoded into headers on first use
+        self.raw_headers = None
+        self._lowered = None
+
+        self._split_url = None
+
+    @property
+    def method(self):
+        return self._method
+    
+    @method.setter
+    def method(self, value):
+        if value not in HttpMethod.METHODS and value != HttpMethod.CONNECT:
+            raise ValueError("Unknown method: " + value)
+        
+        self._method = value
+
+    @property
+    def url(self):
+        return self._url
+    
+    @url.setter
+    def url(self, value):
+        self._url = value
+
+    @property
+    def path(self):
+        """ The url without its query string, and without scheme and host for an absolute url """
+        return self._split()[0]
+
+    @property
+    def query(self):
+        return self._split()[1]
+
+    @property
+    def version(self):
+        return self._version
+    
+    @version.setter
+    def version(self, value):
+        if value not in HttpRequest.VERSIONS:
+            raise ValueError("Unsupported HTTP version: " + value + " .Only HTTP/1.0 and HTTP/1.1 are supported")
+        
+        self._version = value
+
+    @property
+    def headers(self):
+        if self._headers is None:
+            self._headers = self._decode_headers(self._fields())
+
+        return self._headers
+    
+    @headers.setter
+    def headers(self, value):
+        self._headers = dict((k.lower(), v) for k,v in value.items())
+        self.raw_headers = None
+        self._lowered = None
+
+    def header(self, name, default=None):
+        """ One header's value, found in the received lines without decoding the others """
+        if self._headers is not None or not self.raw_headers:
+            return self.headers.get(name, default)
+
+        if self._lowered is None:
+            raw = b"\r\n" + self.raw_headers
+            self._lowered = (raw, raw.lower())
+
+        raw, lowered = self._lowered
+        key = b"\r\n" + name.encode("iso-8859-1") + b":"
+        start = lowered.find(key)
+        if start == -1:
+            return default
+
+        start += len(key)
+        if lowered.find(key, start) != -1:
+            return self.headers[name] # repeated, combined as headers does
+
+        return raw[start:raw.find(b"\r\n", start)].decode("iso-8859-1").strip(" \t")
+
+    def get_all(self, name):
+        """ Every value of a header that may be repeated, in the order received """
+        name = name.lower()
+        if self.raw_headers is None:
+            return [self.headers[name]] if name in self.headers.keys() else []
+
+        return [value for key, value in self._fields() if key == name]
+
+    @property
+    def data(self):
+        body = self.body
+        if self._data is None and body is not None and body.strip() != b"":
+            self._data = body.decode(errors="replace")
+
+        return self._data
+    
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._body = value.encode() if isinstance(value, str) else value
+
+    @property
+    def body(self):
+        """ The raw body bytes. For a streamed body this reads what is left of it into memory """
+        if self._body is None and self._stream is not None and self._stream.streaming:
+            self._body = self._stream.read()
+
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self._data = None
+        self._stream = None
+
+    @property
+    def stream(self):
+        """ The body as an HttpRequestBody, read off the connection while it arrives if it was streamed """
+        if self._stream is None:
+            self._stream = HttpRequestBody(self._body or b"")
+
+        return self._stream
+
+    @stream.setter
+    def stream(self, value):
+        self._stream = value
+
+    def form(self):
+        """
+        Parses a urlencoded or multipart/form-data body into {name: value} as it is
+        read. File parts are HttpUpload objects, spooled to temporary files, and a
+        repeated name keeps its last value.
+        """
+        if self._form is None:
+            parser = self._form_parser()
+            for chunk in self.stream:
+                parser.feed(chunk)
+
+            self._form = parser.close()
+
+        return self._form
+
+    async def form_async(self):
+        """ form for coroutine views """
+        if self._form is None:
+            parser = self._form_parser()
+            async for chunk in self.stream:
+                parser.feed(chunk)
+
+            self._form = parser.close()
+
+        return self._form
+
+    def _form_parser(self):
+        content_type, parameters = MultipartParser.parameters(self.headers.get("content-type", ""))
+        if content_type == "application/x-www-form-urlencoded":
+            return UrlEncodedParser(self.stream.spool_size)
+
+        if content_type == "multipart/form-data":
+            if parameters.get("boundary", "") == "":
+                raise HttpException(HttpStatus.Bad_Request)
+
+            return MultipartParser(parameters["boundary"], self.stream.spool_size)
+
+        raise HttpException(HttpStatus.Unsupported_Media_Type)
+
+    def serialize(self):
+        """ The request as bytes, for sending on to an upstream server """
+        head = f"{self._method} {self._url} {self._version}\r\n"
+        for key, value in self.headers.items():
+            head += f"{key}: {value}\r\n"
+
+        head = (head + "\r\n").encode("iso-8859-1")
+        if self._body is None:
+            return head
+
+        return head + self._body
+
+    def _split(self):
+        if self._split_url is None or self._split_url[0] is not self._url:
+            url = self._url
+            if not url.startswith("/"):
+                parts = urlsplit(url)
+                url = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+            path, _, query = url.partition("?")
+            self._split_url = (self._url, path, query)
+
+        return self._split_url[1:]
+
+    def _fields(self):
+        if not self.raw_headers:
+            return []
+
+        fields = []
+        for line in self.raw_headers.decode("iso-8859-1").split("\r\n")[:-1]:
+            name, _, value = line.partition(":")
+            fields.append((name.lower(), value.strip(" \t")))
+
+        return fields
+
+    def _decode_headers(self, fields):
+        headers = dict(fields)
+        if len(headers) == len(fields):
+            return headers
+
+        # repeated headers are combined into one comma separated value, as RFC 9110 allows
+        headers = {}
+        for name, value in fields:
+            if name in headers.keys():
+                headers[name] += ("; " if name == "cookie" else ", ") + value
+            else:
+                headers[name] = value
+
+        return headers
+
+    def __repr__(self):
+        line_break = "\r\n"
+        status_line = f"{self._method} {self._url} {self._version}" + line_break
+        response = status_line
+        
+        for _, (key, value) in enumerate(self.headers.items()):
+            response += f"{key}: {value}" + line_break
+
+        response += line_break
+
+        if self.data is not None:
+            response += self.data
+
+        return response
+
+class HttpRequestBody():
+    """
+    File-like request body. A streamed body is read off the connection while it
+    arrives: read blocks for more, and iterating yields the pieces as they come in.
+    Coroutine views use read_async and async for. spool copies what is left into a
+    temporary file that only moves to disk past spool_size.
+    """
+    def __init__(self, data=b"", reader=None, spool_size=1048576):
+        self.spool_size = spool_size
+
+        self._buffer = bytearray(data)
+        self._reader = reader # the HttpRequestReader the rest comes from, None once it has all arrived
+
+    @property
+    def streaming(self):
+        """ Whether part of the body is still to arrive """
+        return self._reader is not None
+
+    def read(self, size=-1):
+        while self._reader is not None and (size < 0 or len(self._buffer) < size):
+            self._pull()
+
+        return self._take(size)
+
+    async def read_async(self, size=-1):
+        while self._reader is not None and (size < 0 or len(self._buffer) < size):
+            await self._pull_async()
+
+        return self._take(size)
+
+    def spool(self):
+        """ The rest of the body as a file, rewound """
+        file = SpooledTemporaryFile(self.spool_size)
+        for chunk in self:
+            file.write(chunk)
+
+        file.seek(0)
+        return file
+
+    async def spool_async(self):
+        file = SpooledTemporaryFile(self.spool_size)
+        async for chunk in self:
+            file.write(chunk)
+
+        file.seek(0)
+        return file
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self._buffer) == 0 and self._reader is not None:
+            self._pull()
+
+        if len(self._buffer) == 0:
+            raise StopIteration
+
+        return self._take(-1)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self._buffer) == 0 and self._reader is not None:
+            await self._pull_async()
+
+        if len(self._buffer) == 0:
+            raise StopAsyncIteration
+
+        return self._take(-1)
+
+    def _take(self, size):
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return data
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _pull(self):
+        # a chunked body can take a read without any body bytes coming out of it
+        size = len(self._buffer)
+        while self._reader is not None and len(self._buffer) == size:
+            if self._reader.body_into(self._buffer):
+                self._reader = None
+            elif len(self._buffer) == size:
+                self._reader.fill()
+
+    async def _pull_async(self):
+        size = len(self._buffer)
+        while self._reader is not None and len(self._buffer) == size:
+            if self._reader.body_into(self._buffer):
+                self._reader = None
+            elif len(self._buffer) == size:
+                await self._reader.fill_async()
+
+class HttpUpload():
+    """ A file part of a multipart/form-data body """
+    def __init__(self, name, filename, content_type, file):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = 0
+
+    def save(self, path):
+        self.file.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(self.file, f)
+
+    def close(self):
+        self.file.close()
+
+class UrlEncodedParser():
+    """ Incremental application/x-www-form-urlencoded parser. Fields are limited to max_field_size bytes """
+    def __init__(self, max_field_size=1048576):
+        self.max_field_size = max_field_size
+        self.fields = {}
+
+        self._pending = bytearray()
+
+    def feed(self, data):
+        self._pending += data
+
+        end = self._pending.rfind(b"&")
+        if end != -1:
+            for pair in self._pending[:end].split(b"&"):
+                self._add(pair)
+
+            del self._pending[:end + 1]
+
+        if len(self._pending) > self.max_field_size:
+            raise HttpException(HttpStatus.Payload_Too_Large)
+
+    def close(self):
+        self._add(self._pending)
+        return self.fields
+
+    def _add(self, pair):
+        if len(pair) == 0:
+            return
+
+        name, _, value = bytes(pair).replace(b"+", b" ").partition(b"=")
+        self.fields[unquote_to_bytes(name).decode(errors="replace")] = unquote_to_bytes(value).decode(errors="replace")
+
+class MultipartParser():
+    """
+    Incremental multipart/form-data parser. Field values are kept in memory, up to
+    max_field_size each, and file parts are written to HttpUpload files as they
+    arrive, which stay in memory up to spool_size.
+    """
+    PREAMBLE, DELIMITER, HEADERS, PART, EPILOGUE = range(5)
+
+    MAX_HEADER_SIZE = 16384
+
+    # name=value parameters in a header, value possibly quoted
+    PARAMETER = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+    def __init__(self, boundary, spool_size=1048576, max_field_size=1048576):
+        self.spool_size = spool_size
+        self.max_field_size = max_field_size
+        self.fields = {}
+
+        self._delimiter = b"\r\n--" + boundary.encode("iso-8859-1")
+        self._buffer = bytearray(b"\r\n") # so the first delimiter looks like the rest
+        self._state = MultipartParser.PREAMBLE
+        self._part = None
+
+    @staticmethod
+    def parameters(header_value):
+        """ Splits a header like content-type into (lowercased value, {parameter: value}) """
+        value, _, _ = header_value.partition(";")
+
+        parameters = {}
+        for name, parameter in MultipartParser.PARAMETER.findall(header_value):
+            if parameter.startswith('"'):
+                parameter = re.sub(r'\\(.)', r"\1", parameter[1:-1])
+
+            parameters[name.lower()] = parameter.strip()
+
+        return value.strip().lower(), parameters
+
+    def feed(self, data):
+        self._buffer += data
+
+        while True:
+            if self._state in [MultipartParser.PREAMBLE, MultipartParser.PART]:
+                end = self._buffer.find(self._delimiter)
+                if end == -1:
+                    # keep what could be the start of a delimiter split across feeds
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        self._write(self._buffer[:-keep])
+                        del self._buffer[:-keep]
+
+                    return
+
+                self._write(self._buffer[:end])
+                del self._buffer[:end + len(self._delimiter)]
+                self._end_part()
+                self._state = MultipartParser.DELIMITER
+
+            elif self._state == MultipartParser.DELIMITER:
+                if len(self._buffer) < 2:
+                    return
+
+                if self._buffer.startswith(b"--"):
+                    self._state = MultipartParser.EPILOGUE
+                    self._buffer.clear()
+                    return
+
+                # transport padding may follow the boundary
+                line_end = self._buffer.find(b"\r\n")
+                if line_end == -1:
+                    if len(self._buffer) > MultipartParser.MAX_HEADER_SIZE:
+                        raise HttpException(HttpStatus.Bad_Request)
+                    return
+
+                if self._buffer[:line_end].strip(b" \t") != b"":
+                    raise HttpException(HttpStatus.Bad_Request)
+
+                del self._buffer[:line_end + 2]
+                self._state = MultipartParser.HEADERS
+
+            elif self._state == MultipartParser.HEADERS:
+                end = self._buffer.find(b"\r\n\r\n")
+                if end == -1 and not self._buffer.startswith(b"\r\n"):
+                    if len(self._buffer) > MultipartParser.MAX_HEADER_SIZE:
+                        raise HttpException(HttpStatus.Request_Header_Fields_Too_Large)
+                    return
+
+                if self._buffer.startswith(b"\r\n"):
+                    head, size = b"", 2 # a part without headers
+                else:
+                    head, size = bytes(self._buffer[:end]), end + 4
+
+                del self._buffer[:size]
+                self._start_part(head)
+                self._state = MultipartParser.PART
+
+            else:
+                self._buffer.clear()
+                return
+
+    def close(self):
+        if self._state != MultipartParser.EPILOGUE:
+            raise HttpException(HttpStatus.Bad_Request) # ended before the closing delimiter
+
+        return self.fields
+
+    def _start_part(self, head):
+        headers = {}
+        for line in head.decode("utf-8", errors="replace").split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        _, disposition = MultipartParser.parameters(headers.get("content-disposition", ""))
+        name = disposition.get("name", "")
+
+        if "filename" in disposition.keys():
+            upload = HttpUpload(name, disposition["filename"], headers.get("content-type", "application/octet-stream"),
+                                SpooledTemporaryFile(self.spool_size))
+            self._part = (name, upload)
+        else:
+            self._part = (name, bytearray())
+
+    def _write(self, data):
+        if self._part is None or len(data) == 0:
+            return # the preamble is ignored
+
+        name, sink = self._part
+        if isinstance(sink, HttpUpload):
+            sink.file.write(data)
+            sink.size += len(data)
+            return
+
+        sink += data
+        if len(sink) > self.max_field_size:
+            raise HttpException(HttpStatus.Payload_Too_Large)
+
+    def _end_part(self):
+        if self._part is None:
+            return
+
+        name, sink = self._part
+        if isinstance(sink, HttpUpload):
+            sink.file.seek(0)
+            self.fields[name] = sink
+        else:
+            self.fields[name] = sink.decode(errors="replace")
+
+        self._part = None
+
+class HttpResponse():
+    # statuses that never have a body, and so no content-length either
+    BODILESS = [HttpStatus.Continue, HttpStatus.Not_Modified]
+
+    def __init__(self, status_code):
+        self._version = "HTTP/1.1"
+        self._status_code = status_code
+        
+        self._headers = {
+            "date": HttpDate.now(),
+            "server": "SimpleHTTPServer/1.0",
+            "content-type": "text/html; charset=utf-8"
+        }
+
+        # framed from the start, so an error sent without a body can't leave a kept alive client waiting
+        if status_code not in HttpResponse.BODILESS:
+            self._headers["content-length"] = 0
+
+        self._data = None
+        self._body = b""
+
+        # the answer to a HEAD request, only the head is sent but it still describes the body
+        self.head_only = False
+
+        # body bytes handed to the connection so far, by the send paths that write in pieces
+        self.sent = 0
+    
+    @property
+    def version(self):
+        return self._version
+    
+    @version.setter
+    def version(self, value):
+        if value != "HTTP/1.1":
+            raise ValueError("Unsupported HTTP version: " + value + ". Only HTTP/1.1 is supported")
+        
+        self._version = value
+
+    @property
+    def status_code(self):
+        return self._status_code
+
+    @status_code.setter
+    def status_code(self, value):
+        if value not in HttpStatus.CODES:
+            raise ValueError("Unknown status code: " + str(value))
+        
+        self._status_code = value
+        if value in HttpResponse.BODILESS:
+            self._headers.pop("content-length", None)
+
+    @property
+    def headers(self):
+        return self._headers
+    
+    @headers.setter
+    def headers(self, value, overwrite=False):
+        value = dict((k.lower(), v) for k,v in value.items())
+        
+        if overwrite:
+            self.headers = value
+        
+        self._headers.update(value)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+        # encoded once here, the content-length and send both use it
+        if isinstance(value, str):
+            self._body = value.encode()
+        elif value is None:
+            self._body = b""
+        else:
+            self._body = value
+
+        self._headers["content-length"] = len(self._body)
+
+    @property
+    def head(self):
+        """ Status line and header block, encoded """
+        lines = [f"{key}: {value}\r\n" for key, value in self._headers.items()]
+        lines.append("\r\n")
+        try:
+            block = "".join(lines).encode("iso-8859-1")
+        except UnicodeEncodeError:
+            block = "".join(map(HttpResponse.latin1, lines)).encode("iso-8859-1")
+
+        return HttpStatus.status_line(self._status_code, self._version) + block
+
+    @staticmethod
+    def latin1(text):
+        """ Percent-encodes, as UTF-8, the characters of a header line that latin-1 can't carry """
+        return "".join(c if ord(c) < 256 else quote(c) for c in text)
+
+    def _generate_response(self):
+        return self.head + self._body
+
+    @property
+    def response(self):
+        return self._generate_response()
+
+    @property
+    def body_size(self):
+        """ Bytes sent after the head """
+        return 0 if self.head_only else len(self._body)
+
+    def send(self, connection, head=None):
+        """ head is self.head, if the caller already serialized it. Head and body go out in one write """
+        if head is None:
+            head = self.head
+
+        HttpResponse.send_buffers(connection, [head] if self.head_only else [head, self._body])
+
+    async def send_async(self, writer, head=None):
+        if head is None:
+            head = self.head
+
+        writer.writelines([head] if self.head_only else [head, self._body])
+        await writer.drain()
+
+    @staticmethod
+    def encrypted(connection):
+        """ Whether connection is TLS, which sendmsg and sendfile would go around """
+        return ssl is not None and isinstance(connection, ssl.SSLSocket)
+
+    @staticmethod
+    def unsent(connection):
+        """ Bytes the kernel still holds for connection, or None where that can't be asked """
+        if ioctl is None:
+            return None
+
+        try:
+            return int.from_bytes(ioctl(connection.fileno(), TIOCOUTQ, bytes(4)), sys.byteorder)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def wait_writable(connection, wait):
+        """
+        Waits for room to write on connection. A full send buffer may only report room
+        once a good part of it has drained, so the wait goes on while the client keeps
+        reading and raises timeout once wait seconds pass without it taking anything.
+        """
+        queued = HttpResponse.unsent(connection)
+        while not select([], [connection], [], wait)[1]:
+            now = HttpResponse.unsent(connection)
+            if queued is None or now is None or now >= queued:
+                raise timeout("timed out")
+
+            queued = now
+
+    @staticmethod
+    def send_buffers(connection, buffers, flags=0):
+        """ sendall for a list of buffers, written with sendmsg instead of being joined first """
+        buffers = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+        if not hasattr(connection, "sendmsg") or HttpResponse.encrypted(connection):
+            connection.sendall(b"".join(buffers))
+            return
+
+        while len(buffers) > 0:
+            try:
+                sent = connection.sendmsg(buffers, [], flags)
+            except timeout:
+                # a slow client may still be reading, only one that has stopped is given up on
+                HttpResponse.wait_writable(connection, connection.gettimeout())
+                continue
+
+            while sent > 0:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers[0])
+                    buffers.pop(0)
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+class ByteRanges():
+    """ Satisfiable ranges of a Range: bytes=... header for a body of a known size """
+    MAX_RANGES = 16
+
+    def __init__(self, ranges, size):
+        self.ranges = ranges # (first, last) byte positions, inclusive
+        self.size = size
+        self.boundary = uuid.uuid4().hex if len(ranges) > 1 else None
+
+    @staticmethod
+    def parse(header_value, size):
+        """
+        Returns None if the header should be ignored and the whole body sent.
+        Raises HttpException 416 if none of the ranges can be satisfied.
+        """
+        unit, _, spec = header_value.partition("=")
+        if unit.strip().lower() != "bytes" or spec.strip() == "":
+            return None
+
+        ranges = []
+        for item in spec.split(","):
+            first, dash, last = item.strip().partition("-")
+            if dash == "":
+                return None
+
+            try:
+                if first == "": # suffix range, the last n bytes
+                    length = int(last)
+                    if length <= 0:
+                        continue
+
+                    first, last = max(0, size - length), size - 1
+                else:
+                    first = int(first)
+                    if last == "":
+                        last = size - 1
+                    elif int(last) < first:
+                        return None
+                    else:
+                        last = min(int(last), size - 1)
+            except ValueError:
+                return None
+
+            if first >= size:
+                continue
+
+            ranges.append((first, last))
+
+        if len(ranges) > ByteRanges.MAX_RANGES:
+            return None
+
+        if len(ranges) == 0:
+            raise HttpException(HttpStatus.Range_Not_Satisfiable, headers={"content-range": f"bytes */{size}"})
+
+        return ByteRanges(ranges, size)
+
+    def headers(self, content_type):
+        if self.boundary is None:
+            first, last = self.ranges[0]
+            return {"content-range": f"bytes {first}-{last}/{self.size}"}
+
+        return {"content-type": f"multipart/byteranges; boundary={self.boundary}"}
+
+    def parts(self, content_type):
+        """
+        Returns the body layout as a list of (prefix, offset, count), where prefix is
+        sent before count bytes from offset, and the bytes that close the body.
+        """
+        if self.boundary is None:
+            first, last = self.ranges[0]
+            return [(b"", first, last - first + 1)], b""
+
+        parts = []
+        for i, (first, last) in enumerate(self.ranges):
+            line_break = "\r\n" if i > 0 else ""
+            prefix = (f"{line_break}--{self.boundary}\r\n"
+                      f"content-type: {content_type}\r\n"
+                      f"content-range: bytes {first}-{last}/{self.size}\r\n\r\n")
+            parts.append((prefix.encode(), first, last - first + 1))
+
+        return parts, f"\r\n--{self.boundary}--\r\n".encode()
+
+    def join(self, data, content_type):
+        parts, closing = self.parts(content_type)
+
+        body = bytearray()
+        for prefix, offset, count in parts:
+            body += prefix
+            body += data[offset:offset + count]
+
+        body += closing
+        return bytes(body)
+
+class HttpFileResponse(HttpResponse):
+    """
+    Response whose body is streamed from a file on disk instead of held in memory.
+    response only holds the status line and headers, send writes the body after them.
+    """
+    BLOCK_SIZE = 65536
+
+    # per thread buffers for when sendfile can't be used
+    _buffers = local()
+
+    def __init__(self, status_code, path, stat=None, ranges=None):
+        super().__init__(status_code)
+        self.path = path
+
+        if stat is None:
+            stat = os.stat(path)
+
+        self._headers.update(HttpFileResponse.resource_headers(path, stat))
+
+        if ranges is None:
+            self._parts, self._closing = [(b"", 0, stat.st_size)], b""
+        else:
+            content_type = self._headers["content-type"]
+            self._headers.update(ranges.headers(content_type))
+            self._parts, self._closing = ranges.parts(content_type)
+
+        content_length = len(self._closing)
+        for prefix, _, count in self._parts:
+            content_length += len(prefix) + count
+
+        self._headers["content-length"] = content_length
+
+    @staticmethod
+    def etag(stat, weak=False):
+        # cheap validator built from the inode, mtime and size instead of hashing the file
+        etag = f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if weak:
+            etag = "W/" + etag
+
+        return etag
+
+    @staticmethod
+    def resource_headers(path, stat):
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+
+        return {
+            "content-type": content_type,
+            "content-length": stat.st_size,
+            "last-modified": formatdate(stat.st_mtime, usegmt=True),
+            "etag": HttpFileResponse.etag(stat),
+            "accept-ranges": "bytes"
+        }
+
+    @property
+    def data(self):
+        return None
+
+    @data.setter
+    def data(self, value):
+        raise ValueError("HttpFileResponse body is read from " + self.path)
+
+    @property
+    def body_size(self):
+        return 0 if self.head_only else self._headers["content-length"]
+
+    def send(self, connection, head=None):
+        if head is None:
+            head = self.head
+
+        if self.head_only:
+            connection.sendall(head)
+            return
+
+        with open(self.path, "rb") as f:
+            for prefix, offset, count in self._parts:
+                # MSG_MORE lets the head go out in the same segment as the start of the file
+                HttpResponse.send_buffers(connection, [head, prefix], SEND_MORE if count > 0 else 0)
+                head = b""
+
+                HttpFileResponse.sendfile(connection, f, offset, count)
+
+            if self._closing:
+                connection.sendall(self._closing)
+
+    async def send_async(self, writer, head=None):
+        if head is None:
+            head = self.head
+
+        if self.head_only:
+            writer.write(head)
+            await writer.drain()
+            return
+
+        with open(self.path, "rb") as f:
+            writer.write(head)
+
+            for prefix, offset, count in self._parts:
+                writer.write(prefix)
+                await writer.drain()
+                await HttpFileResponse.sendfile_async(self, writer, f, offset, count)
+
+            writer.write(self._closing)
+            await writer.drain()
+
+    @staticmethod
+    def block_buffer():
+        """ The calling thread's block buffer, allocated on first use and reused by every send after it """
+        view = getattr(HttpFileResponse._buffers, "view", None)
+        if view is None:
+            view = HttpFileResponse._buffers.view = memoryview(bytearray(HttpFileResponse.BLOCK_SIZE))
+
+        return view
+
+    @staticmethod
+    async def sendfile_async(response, writer, file, offset, count):
+        """ loop.sendfile a block at a time, counting each into response.sent so a slow client shows progress """
+        loop = asyncio.get_running_loop()
+        end = offset + count
+        while offset < end:
+            block = min(HttpFileResponse.BLOCK_SIZE, end - offset)
+            await loop.sendfile(writer.transport, file, offset, block)
+            offset += block
+            response.sent += block
+
+    @staticmethod
+    def sendfile(connection, file, offset, count):
+        """ Sends count bytes of file from offset, with os.sendfile where the platform has it """
+        if not hasattr(os, "sendfile") or HttpResponse.encrypted(connection):
+            return HttpFileResponse.send_blocks(connection, file, offset, count)
+
+        wait = connection.gettimeout()
+        start = offset
+        end = offset + count
+        while offset < end:
+            try:
+                sent = os.sendfile(connection.fileno(), file.fileno(), offset, end - offset)
+            except BlockingIOError:
+                # sockets with a timeout are non-blocking underneath
+                HttpResponse.wait_writable(connection, wait)
+                continue
+            except OSError as e:
+                if offset == start and e.errno in [errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK]:
+                    # sendfile isn't supported for this file/socket pair
+                    return HttpFileResponse.send_blocks(connection, file, offset, count)
+                raise
+
+            if sent == 0:
+                break
+
+            offset += sent
+
+    @staticmethod
+    def send_blocks(connection, file, offset, count):
+        view = HttpFileResponse.block_buffer()
+
+        file.seek(offset)
+        while count > 0:
+            read = file.readinto(view[:min(count, len(view))])
+            if read == 0:
+                break
+
+            connection.sendall(view[:read])
+            count -= read
+
+class HttpStreamResponse(HttpResponse):
+    """
+    Response whose body is produced while it is sent: an iterator or generator of str
+    or bytes chunks, an async iterator, or a file object. Without a known length the
+    body goes out with transfer-encoding: chunked. A chunk is only pulled once the
+    previous one is written, so a slow client holds the producer back instead of the
+    body piling up in memory. Binary regular files are sent with sendfile.
+    """
+    BLOCK_SIZE = 65536
+
+    def __init__(self, status_code, body, length=None):
+        super().__init__(status_code)
+        self.body = body
+        self.compressor = None
+        self.chunked = False
+
+        self._file_length = HttpStreamResponse.file_length(body)
+        if length is None:
+            length = self._file_length
+
+        self.length = length
+        if length is None:
+            self.chunked = True
+            self._headers.pop("content-length", None)
+            self._headers["transfer-encoding"] = "chunked"
+        else:
+            self._headers["content-length"] = length
+
+    @staticmethod
+    def file_length(body):
+        """ Bytes left in body if it is a binary regular file, otherwise None """
+        if not hasattr(body, "fileno") or "b" not in getattr(body, "mode", ""):
+            return None
+
+        try:
+            stat = os.fstat(body.fileno())
+            if not S_ISREG(stat.st_mode):
+                return None
+
+            return stat.st_size - body.tell()
+        except (OSError, ValueError):
+            return None
+
+    @property
+    def data(self):
+        return None
+
+    @data.setter
+    def data(self, value):
+        raise ValueError("HttpStreamResponse body is produced while it is sent")
+
+    @property
+    def body_size(self):
+        return self.sent
+
+    def compress(self, compressor, encoding):
+        """ Compresses the body as it is sent, which makes its length unknown """
+        self.compressor = compressor
+        self.length = None
+        self.chunked = True
+        self._headers.pop("content-length", None)
+        self._headers["transfer-encoding"] = "chunked"
+        self._headers["content-encoding"] = encoding
+
+    def until_close(self):
+        """ Drops the chunked framing for clients that don't know it, the body then ends when the connection does """
+        if self.chunked:
+            self.chunked = False
+            self._headers.pop("transfer-encoding")
+
+    @property
+    def framed(self):
+        return self.chunked or self.length is not None
+
+    def send(self, connection, head=None):
+        if head is None:
+            head = self.head
+
+        try:
+            if self.head_only:
+                connection.sendall(head)
+                return
+
+            if self._sendfile():
+                # an empty file has nothing to follow the head, so it isn't held back for it
+                HttpResponse.send_buffers(connection, [head], SEND_MORE if self.length > 0 else 0)
+                if self.length > 0:
+                    HttpFileResponse.sendfile(connection, self.body, self.body.tell(), self.length)
+
+                self.sent = self.length
+                return
+
+            # the head waits for the first chunk so they share a write
+            for block in self._blocks():
+                self._write(connection, self._frame(self._encode(block)), head)
+                head = b""
+
+            self._write(connection, self._frame(self._flush()) + self._end(), head)
+        finally:
+            self.close()
+
+    async def send_async(self, writer, head=None):
+        if head is None:
+            head = self.head
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            if self.head_only:
+                writer.write(head)
+                await writer.drain()
+                return
+
+            if self._sendfile():
+                writer.write(head)
+                await writer.drain()
+                await HttpFileResponse.sendfile_async(self, writer, self.body, self.body.tell(), self.length)
+                return
+
+            async for block in self._blocks_async(loop):
+                await self._write_async(writer, self._frame(self._encode(block)), head)
+                head = b""
+
+            await self._write_async(writer, self._frame(self._flush()) + self._end(), head)
+        finally:
+            if hasattr(self.body, "aclose"):
+                await self.body.aclose()
+            else:
+                self.close()
+
+    def close(self):
+        """ Closes the body, which also runs the finally blocks of a generator cut short """
+        if hasattr(self.body, "close"):
+            self.body.close()
+
+    def _sendfile(self):
+        return self._file_length is not None and self.compressor is None and self.length == self._file_length
+
+    def _blocks(self):
+        if hasattr(self.body, "read"):
+            while True:
+                block = self.body.read(HttpStreamResponse.BLOCK_SIZE)
+                if not block:
+                    return
+
+                yield block
+
+        elif hasattr(self.body, "__aiter__"):
+            # an async generator returned to the threaded server, as with coroutine views
+            loop = asyncio.new_event_loop()
+            iterator = self.body.__aiter__()
+            try:
+                while True:
+                    try:
+                        yield loop.run_until_complete(iterator.__anext__())
+                    except StopAsyncIteration:
+                        return
+            finally:
+                if hasattr(self.body, "aclose"):
+                    loop.run_until_complete(self.body.aclose())
+                loop.close()
+
+        else:
+            yield from self.body
+
+    async def _blocks_async(self, loop):
+        if hasattr(self.body, "__aiter__"):
+            async for block in self.body:
+                yield block
+
+        elif isinstance(self.body, (list, tuple)):
+            for block in self.body:
+                yield block
+
+        else:
+            # reading a file or running a generator can block, so it happens off the loop
+            if hasattr(self.body, "read"):
+                iterator = iter(lambda: self.body.read(HttpStreamResponse.BLOCK_SIZE), self.body.read(0))
+            else:
+                iterator = iter(self.body)
+
+            end = object()
+            while True:
+                block = await loop.run_in_executor(None, next, iterator, end)
+                if block is end:
+                    return
+
+                yield block
+
+    def _encode(self, block):
+        if isinstance(block, str):
+            block = block.encode()
+
+        if self.compressor is not None:
+            block = self.compressor.compress(block)
+
+        return block
+
+    def _flush(self):
+        if self.compressor is None:
+            return b""
+
+        return self.compressor.flush()
+
+    def _frame(self, block):
+        if len(block) == 0:
+            return [] # an empty chunk would end a chunked body
+
+        if self.chunked:
+            return [b"%x\r\n" % len(block), block, b"\r\n"]
+
+        return [block]
+
+    def _end(self):
+        return [b"0\r\n\r\n"] if self.chunked else []
+
+    def _write(self, connection, buffers, head=b""):
+        # sent counts the body only, the head goes out with the first buffers
+        HttpResponse.send_buffers(connection, [head] + buffers)
+        self.sent += sum(len(buffer) for buffer in buffers)
+
+    async def _write_async(self, writer, buffers, head=b""):
+        writer.writelines([head] + buffers)
+        await writer.drain() # waits while the client is slower than the producer
+        self.sent += sum(len(buffer) for buffer in buffers)
+
+class TimerWheel():
+    """
+    Hashed timing wheel for many deadlines that are nearly always cancelled before
+    they expire. schedule and cancel are O(1) under one lock, and a single thread,
+    started on first use, advances the wheel a tick at a time and runs the callbacks
+    that came due. Callbacks run on that thread, so they should be quick.
+    """
+    def __init__(self, tick=0.05, slots=1024):
+        self.tick = tick
+
+        self._slots = [set() for _ in range(slots)]
+        self._pending = 0
+        self._origin = time.monotonic()
+        self._done = 0     # every tick up to this one has been run
+        self._sequence = 0 # keeps timers with the same deadline and callback apart
+
+        self._condition = Condition()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """ Runs callback after at least delay seconds. Returns a timer to pass to cancel """
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive(): # also after a fork
+                self._done = self._ticks()
+                self._thread = Thread(target=self._run, name="timer-wheel", daemon=True)
+                self._thread.start()
+
+            self._sequence += 1
+            timer = (self._ticks() + int(delay / self.tick) + 1, self._sequence, callback)
+            self._slots[timer[0] % len(self._slots)].add(timer)
+            self._pending += 1
+
+            if self._pending == 1:
+                self._condition.notify()
+
+        return timer
+
+    def cancel(self, timer):
+        """ Returns False if the timer already fired """
+        with self._condition:
+            slot = self._slots[timer[0] % len(self._slots)]
+            if timer not in slot:
+                return False
+
+            slot.remove(timer)
+            self._pending -= 1
+            return True
+
+    def _ticks(self):
+        return int((time.monotonic() - self._origin) / self.tick)
+
+    def _run(self):
+        while True:
+            for _, _, callback in self._advance():
+                try:
+                    callback()
+                except Exception as e:
+                    ConsoleLogger().error("Timer callback failed", e)
+
+    def _advance(self):
+        with self._condition:
+            while self._pending == 0:
+                self._condition.wait()
+                self._done = self._ticks() # nothing was due while the wheel sat empty
+
+            self._condition.wait(self.tick)
+
+            expired = []
+            now = self._ticks()
+            while self._done < now:
+                self._done += 1
+                slot = self._slots[self._done % len(self._slots)]
+                due = [timer for timer in slot if timer[0] <= self._done] # later ones are laps ahead
+                slot.difference_update(due)
+                expired += due
+
+            self._pending -= len(expired)
+            return expired
+
+class HandlerDeadline():
+    """
+    Answers a request with 503 from the timer thread when its handler runs past the
+    deadline. A running view can't be interrupted, so the worker carries on, and
+    finish tells it whether its response is still wanted.
+    """
+    def __init__(self, connection, on_expire=None):
+        self.connection = connection
+        self.on_expire = on_expire
+        self.expired = False
+
+        self._finished = False
+        self._lock = Lock()
+
+    def expire(self):
+        with self._lock:
+            if self._finished:
+                return
+
+            self.expired = True
+
+        response = HttpResponse(HttpStatus.Service_Unavailable)
+        response.headers = {"connection": "close"}
+
+        try:
+            self.connection.send(response.response)
+            self.connection.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+        if self.on_expire is not None:
+            self.on_expire()
+
+    def finish(self):
+        """ Returns False if the client was already answered """
+        with self._lock:
+            self._finished = True
+            return not self.expired
+
+class WorkerPool():
+    """ Fixed set of worker threads fed from a bounded queue of pending connections """
+    def __init__(self, worker_func, workers=8, queue_size=64, logger=None):
+        self.worker_func = worker_func
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size)
+        self.threads = []
+
+        if logger is None:
+            logger = ConsoleLogger()
+
+        self.logger = logger
+
+    def start(self):
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, item, block=False):
+        """
+        Queues item for the next free worker. Returns False if the queue is full
+        and block is False, so the caller can shed the load.
+        """
+        try:
+            self.queue.put(item, block=block)
+        except Full:
+            return False
+
+        return True
+
+    def shutdown(self):
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                self.worker_func(*item)
+            except ConnectionError:
+                pass # the client went away
+            except Exception as e:
+                self.logger.error("Worker failed", e)
+
+class TlsConfig():
+    """
+    TLS for a listener, built on one ssl context for its whole life so session
+    tickets and the session cache keep letting clients resume instead of doing a
+    full handshake. Supervisor workers share the ticket keys if the config is made
+    before they fork. cert_file and key_file are checked for changes at most every
+    reload_interval seconds as handshakes come in. A changed pair is loaded into a
+    new context that connections switch to from the SNI callback, so tickets issued
+    before a reload still resume. alpn lists the protocols offered, in preference
+    order.
+    """
+    def __init__(self, cert_file, key_file=None, password=None, alpn=None, tickets=2, reload_interval=5,
+                 ciphers=None):
+        if ssl is None:
+            raise RuntimeError("TLS needs the ssl module")
+
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.password = password
+        self.alpn = alpn if alpn is not None else ["http/1.1"]
+        self.tickets = tickets
+        self.reload_interval = reload_interval
+        self.ciphers = ciphers
+
+        self.reloads = 0
+
+        self.context = self._create_context()
+        self.context.sni_callback = self._select
+
+        self._current = self.context
+        self._files = self._modified()
+        self._checked = time.monotonic()
+        self._lock = Lock()
+
+    def wrap(self, connection):
+        """ Runs the server side handshake on connection, returning the TLS socket """
+        return self.context.wrap_socket(connection, server_side=True)
+
+    def accept(self, connection, handshake_timeout=None, metrics=None):
+        """ wrap with a time limit. Returns None if the handshake failed, once connection is closed """
+        connection.settimeout(handshake_timeout)
+        try:
+            return self.wrap(connection)
+        except timeout:
+            if metrics is not None:
+                metrics.timed_out("header")
+        except (OSError, ValueError):
+            pass # not TLS, or no protocol or cipher in common
+
+        connection.close()
+        return None
+
+    def reload(self):
+        """ Loads cert_file and key_file again. Returns False, keeping the current pair, if they don't load """
+        files = self._modified()
+        try:
+            context = self._create_context()
+        except (OSError, ValueError) as e:
+            ConsoleLogger().error("Certificate reload failed", e) # e.g. caught half way through being replaced
+            return False
+
+        with self._lock:
+            self._current = context
+            self._files = files
+            self.reloads += 1
+
+        return True
+
+    def session_stats(self):
+        """ Handshake and resumption counts of the listener context """
+        return self.context.session_stats()
+
+    def _create_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(self.cert_file, self.key_file, self.password)
+        context.set_alpn_protocols(self.alpn)
+
+        # TLS 1.3 tickets per handshake, TLS 1.2 uses tickets unless OP_NO_TICKET is set
+        context.num_tickets = self.tickets
+        if self.ciphers is not None:
+            context.set_ciphers(self.ciphers)
+
+        return context
+
+    def _modified(self):
+        files = []
+        for path in [self.cert_file, self.key_file]:
+            try:
+                stat = os.stat(path) if path is not None else None
+                files.append(None if stat is None else (stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except OSError:
+                files.append(None)
+
+        return files
+
+    def _select(self, connection, server_name, context):
+        now = time.monotonic()
+        if now - self._checked >= self.reload_interval:
+            self._checked = now
+            if self._modified() != self._files:
+                self.reload()
+
+        current = self._current
+        if current is not self.context:
+            connection.context = current
+
+class TcpServer(Thread):
+    """
+    Listening socket and accept loop shared by HttpServer and ProxyServer. Accepted
+    connections go to a WorkerPool that calls _handle_connection(connection, addr).
+    Subclasses set logger, metrics and header_timeout.
+    """
+    # What to do with a new connection when every worker is busy and the queue is full
+    OVERLOAD_REJECT = "reject" # reply 503 and close
+    OVERLOAD_BLOCK  = "block"  # stop accepting until a slot frees up
+
+    # how often the accept loop checks whether stop() was called
+    ACCEPT_INTERVAL = 0.5
+
+    def __init__(self, port, workers, queue_size, backlog, overload, reuse_port, tls):
+        Thread.__init__(self)
+        self.port = port
+
+        # set reuse_port to share the port with other processes, or listener to accept on an existing socket
+        self.reuse_port = reuse_port
+        self.listener = None
+        self.stopping = False
+
+        # a TlsConfig serves TLS, the handshake runs on the worker under header_timeout
+        self.tls = tls
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.backlog = backlog
+        self.overload = overload
+
+    def run(self):
+        tcp_socket = self._listen()
+        tcp_socket.settimeout(TcpServer.ACCEPT_INTERVAL)
+
+        pool = WorkerPool(self._handle_connection, self.workers, self.queue_size, self.logger)
+        pool.start()
+
+        self.logger.server("running...")
+
+        while not self.stopping:
+            try:
+                connection, addr = tcp_socket.accept()
+            except timeout:
+                continue
+
+            block = self.overload == TcpServer.OVERLOAD_BLOCK
+            if not pool.submit((connection, addr), block=block):
+                self._reject(connection)
+
+        # drain: queued and in-flight connections get one more response before the workers exit
+        for connection, addr in TcpServer.pending_connections(tcp_socket):
+            pool.submit((connection, addr), block=True)
+
+        tcp_socket.close()
+        pool.shutdown()
+
+    def stop(self):
+        """ Stops accepting connections. run returns once the open ones have finished """
+        self.stopping = True
+
+    @staticmethod
+    def pending_connections(tcp_socket):
+        """ Accepts what is already queued on tcp_socket, which closing it would reset """
+        tcp_socket.setblocking(False)
+        while True:
+            try:
+                yield tcp_socket.accept()
+            except OSError:
+                return
+
+    def _listen(self):
+        if self.listener is not None:
+            return self.listener
+
+        tcp_socket = socket(AF_INET, SOCK_STREAM)
+        if self.reuse_port:
+            tcp_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+
+        tcp_socket.bind(("", self.port))
+        tcp_socket.listen(self.backlog)
+        return tcp_socket
+
+    def _accepted(self, connection):
+        """ Readies a new connection, None if the TLS handshake failed """
+        connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        if self.tls is not None:
+            connection = self.tls.accept(connection, self.header_timeout, self.metrics)
+
+        return connection
+
+    def _timed_out(self, connection, reader, phase):
+        # a half read request gets told, an idle connection or stalled write is just closed
+        if phase in ["header", "body"]:
+            connection.settimeout(1)
+            try:
+                self._reply_error(connection, reader, HttpStatus.Request_Timeout)
+            except OSError:
+                pass
+
+        if self.metrics is not None:
+            self.metrics.timed_out(phase)
+
+    def _reply_error(self, connection, reader, status_code):
+        response = HttpResponse(status_code)
+        reader.close_after(response)
+        connection.sendall(response.response)
+
+        self.logger.http_connection(response.status_code)
+
+    def _reject(self, connection):
+        response = HttpResponse(HttpStatus.Service_Unavailable)
+        response.headers = {"retry-after": 1, "connection": "close"}
+
+        try:
+            if self.tls is None: # a TLS client couldn't read it before a handshake
+                connection.send(response.response)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+        self.logger.http_connection(response.status_code)
+
+class HttpServer(TcpServer):
+    def __init__(self, port=80, workers=8, queue_size=64, backlog=128, overload=TcpServer.OVERLOAD_REJECT,
+                 keep_alive_timeout=5, max_requests=100, max_header_size=16384, max_body_size=10485760,
+                 resource_cache=None, compression=None, access_log=None, metrics=None, metrics_path=None,
+                 reuse_port=False, header_timeout=10, body_timeout=30, handler_timeout=None, spool_size=1048576,
+                 tls=None, tracer=None):
+        TcpServer.__init__(self, port, workers, queue_size, backlog, overload, reuse_port, tls)
+        self.routes = Router()
+
+        # keep_alive_timeout is how long an idle connection is kept, and how long a write may stall
+        self.keep_alive_timeout = keep_alive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_requests = max_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+
+        # larger bodies are streamed to views through request.stream instead of read up front
+        self.spool_size = spool_size
+
+        # past handler_timeout the client gets a 503, the view itself can't be stopped
+        self.handler_timeout = handler_timeout
+        self.timers = TimerWheel()
+
+        self.resources = ResourceIndex()
+        self.resource_cache = resource_cache
+        self.compression = compression
+
+        self.logger = ConsoleLogger(access_log)
+
+        if metrics is None and metrics_path is not None:
+            metrics = Metrics()
+
+        self.metrics = metrics
+        if metrics_path is not None:
+            self.routes.add(metrics_path, self._metrics_view, [HttpMethod.GET])
+
+        # a Tracer times each request's stages and logs the slow ones
+        self.tracer = tracer
+
+    def route(self, endpoint, methods=None, cache=None):
+        """
+        Registers the decorated view for endpoint. endpoint can hold variables such as
+        /users/<int:id>, which are passed to the view as keyword arguments. methods
+        defaults to every method. cache is a ViewCache to serve repeated GETs from.
+        """
+        if methods is None:
+            methods = HttpMethod.METHODS
+
+        def add_rule(view_func=None):
+            if view_func is None:
+                raise ValueError("view_func cannot be None")
+            
+            self.routes.add(endpoint, view_func, methods, cache)
+
+            return view_func
+        
+        return add_rule
+    
+    def before_request(self, hook):
+        """ Registers hook(trace) to run before each view, see Tracer """
+        if self.tracer is None:
+            self.tracer = Tracer(threshold=None)
+
+        return self.tracer.before_request(hook)
+
+    def after_request(self, hook):
+        """ Registers hook(trace) to run after each response is sent, see Tracer """
+        if self.tracer is None:
+            self.tracer = Tracer(threshold=None)
+
+        return self.tracer.after_request(hook)
+
+    def abort(self, status_code):
+        raise HttpException(status_code)
+
+    def _handle_connection(self, connection, addr):
+        connection = self._accepted(connection)
+        if connection is None:
+            return
+
+        reader = self._create_reader()
+        reader.attach(connection)
+        handler = HttpRequestHandler(self.resources, self.resource_cache, self.compression, self.logger, addr[0],
+                                     self.tracer)
+
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+        phase = "idle"
         try:
-            request = parser.parse(message)
-        except Exception as e:
-            print(e)
-            response = HttpResponse(HttpStatus.Bad_Request)
-            self.logger.http_connection(response.status_code, request)
-            return response
-        
-        if "content-length" not in request.headers.keys() and request.data is not None:
-            response = HttpResponse(HttpStatus.Length_Required)
-            self.logger.http_connection(response.status_code, request)
-            return response
+            while True:
+                try:
+                    message = reader.next_message()
+                except HttpException as e:
+                    self._reply_error(connection, reader, e.status_code)
+                    break
 
-        # Can eventually be replaced with a routing system which would handle url variables, methods, etc.
-        # --------------------------------------------
-        url = request.url
-        if url in routes.keys():
-            try:
-                response = HttpResponse(HttpStatus.OK)
-                if len(routes[url]["args"]) > 0:
-                    self._set_response_data(response, routes[url]["view_func"](request))
+                if message is None:
+                    phase, wait = reader.wait_time()
+                    if wait is not None and wait <= 0:
+                        raise timeout("timed out")
+
+                    connection.settimeout(wait)
+                    if reader.recv_into(connection) == 0:
+                        break
+
+                    continue
+
+                # Handle HTTP request
+                if self.handler_timeout is None:
+                    response = handler.handle(message, self.routes, reader.request)
                 else:
-                    self._set_response_data(response, routes[url]["view_func"]())
-            except HttpException as e:
-                print(e)
-                response = HttpResponse(e.status_code)
-
-        elif url in self.resources:
-            if "if-modified-since" in request.headers.keys():
-                header_value = request.headers["if-modified-since"]
-                date = parsedate_to_datetime(header_value)
-                if not self._if_modified_since(self.RESOURCE_DIR + url, date):
-                    response = HttpResponse(HttpStatus.Not_Modified)
+                    response = self._handle_with_deadline(handler, message, reader, connection)
+                    if response is None:
+                        break # answered with a 503 already
+
+                if self.stopping:
+                    reader.keep_alive = False
+
+                reader.close_after(response)
+
+                phase = "send"
+                connection.settimeout(self.keep_alive_timeout)
+
+                if self.metrics is None and self.tracer is None:
+                    response.send(connection)
                 else:
-                    response = self._create_static_resource_response(self.RESOURCE_DIR + url)
-            else:
-                response = self._create_static_resource_response(self.RESOURCE_DIR + url)
-                
-        else:
-            response = HttpResponse(HttpStatus.Not_Found)
-        # --------------------------------------------
+                    start = time.perf_counter()
+                    head = response.head
+                    serialized = time.perf_counter()
+                    response.send(connection, head)
+                    self._record(handler, reader, response, message, head, start, serialized)
 
-        self.logger.http_connection(response.status_code, request)
-        return response
-    
-    def _set_response_data(self, response, data):
-        d = ""
-        if data is not None:
-            d = data
+                if not reader.keep_alive:
+                    break
+        except timeout:
+            self._timed_out(connection, reader, phase)
+        finally:
+            connection.close()
 
-        response.data = d
+            if self.metrics is not None:
+                self.metrics.connection_closed()
 
-    def _if_modified_since(self, path, datetime):
-        modified_date = os.path.getmtime(path) # already in unix time
-        unixtime = time.mktime(datetime.timetuple()) # convert datetime obj to unix time
-        return modified_date > unixtime
+    def _handle_with_deadline(self, handler, message, reader, connection):
+        """ Runs handler with handler_timeout. Returns None if the deadline already answered the client """
+        deadline = HandlerDeadline(connection)
+        timer = self.timers.schedule(self.handler_timeout, deadline.expire)
 
-    def _load_resource(self, path):
-        with open(path) as f:
-            data = f.read()
+        handler.defer_log = True
+        response = handler.handle(message, self.routes, reader.request)
+        record, handler.pending_log = handler.pending_log, None
 
-        return data
-    
-    def _create_static_resource_response(self, resource_path):
-        response = None
-        try:
-            response = HttpResponse(HttpStatus.OK)
-            data = self._load_resource(resource_path)
-            self._set_response_data(response, data)
-        except:
-            response = HttpResponse(HttpStatus.Internal_Server_Error)
+        self.timers.cancel(timer)
+        if deadline.finish():
+            if record is not None:
+                self.logger.http_connection(*record)
+
+            return response
+
+        self.logger.http_connection(HttpStatus.Service_Unavailable, reader.request, handler.client)
+        if self.metrics is not None:
+            self.metrics.timed_out("handler")
+
+        self._trace_timeout(handler)
+        return None
 
+    def _record(self, handler, reader, response, message, head, start, serialized):
+        sent = time.perf_counter()
+        if self.metrics is not None:
+            parse_time = reader.parse_time + handler.parse_time
+            timings = (parse_time, handler.handler_time, serialized - start, sent - serialized)
+            self.metrics.record_request(handler.route, handler.method, response.status_code, timings,
+                                        len(message), len(head) + response.body_size)
+
+        if handler.trace is not None:
+            handler.trace.mark("serialize", start, serialized)
+            handler.trace.mark("send", serialized, sent)
+            self.tracer.finish(handler.trace, response)
+
+    def _trace_timeout(self, handler):
+        # a request that ran out of time is the one most worth seeing in the slow log
+        if handler.trace is not None:
+            handler.trace.status_code = HttpStatus.Service_Unavailable
+            self.tracer.finish(handler.trace)
+
+    def _metrics_view(self):
+        response = HttpResponse(HttpStatus.OK)
+        response.headers = {"content-type": "text/plain; version=0.0.4; charset=utf-8"}
+        response.data = self.metrics.prometheus()
         return response
-            
-class HttpProxyRequestHandler():
-    def __init__(self):
-        self.logger = ConsoleLogger()
 
-    def handle(self, message, connection):
-        request_parser = HttpRequestParser()
-        request = None
-        response = None
-        
+    def _create_reader(self):
+        return HttpRequestReader(self.max_requests, self.max_header_size, self.max_body_size,
+                                 header_timeout=self.header_timeout, body_timeout=self.body_timeout,
+                                 idle_timeout=self.keep_alive_timeout, spool_size=self.spool_size)
+
+class AsyncHttpServer(HttpServer):
+    """
+    HttpServer engine built on asyncio streams. Uses the same route API, but idle
+    connections cost a coroutine instead of an OS thread. workers sizes the executor
+    that sync views and file IO run on.
+    """
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        tls = {}
+        if self.tls is not None:
+            tls = {"ssl": self.tls.context, "ssl_handshake_timeout": self.header_timeout}
+
+        if self.listener is not None:
+            server = await asyncio.start_server(self._handle_client, sock=self.listener, backlog=self.backlog, **tls)
+        else:
+            server = await asyncio.start_server(self._handle_client, port=self.port, backlog=self.backlog,
+                                                reuse_port=self.reuse_port or None, **tls)
+
+        self._loop = asyncio.get_running_loop()
+        self._server = server
+        self._clients = set()
+
+        self.logger.server("running...")
+
         try:
-            request = request_parser.parse(message)
-        except Exception:
-            response = HttpResponse(HttpStatus.Bad_Request)
-            self.logger.http_connection(response.status_code, request)
-            return response
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass # closed by stop()
 
-        if request.method in ["POST", "PUT"] and "content-length" not in request.headers.keys():
-            response = HttpResponse(HttpStatus.Length_Required)
-            self.logger.http_connection(response.status_code, request)
-            return response
+        # drain: let open connections finish their current request
+        if len(self._clients) > 0:
+            await asyncio.wait(self._clients)
 
-        host = request.headers["host"]
+        self.executor.shutdown()
 
-        # Modify request
-        index = request.url.find(host)
-        new_url = request.url[index + len(host):]
-        request.url = new_url
+    def stop(self):
+        self.stopping = True
 
-        # Make request to destination webserver
-        port = 80
+        loop = getattr(self, "_loop", None)
+        if loop is not None:
+            loop.call_soon_threadsafe(self._server.close)
 
-        sock = socket(AF_INET, SOCK_STREAM)
-        sock.connect((host, port))
-        sock.send(str(request).encode())
+    async def _handle_client(self, reader, writer):
+        request_reader = self._create_reader()
+        request_reader.attach_async(reader, writer)
+        peer = writer.get_extra_info("peername")
+        client = peer[0] if peer is not None else None
+        handler = HttpRequestHandler(self.resources, self.resource_cache, self.compression, self.logger, client,
+                                     self.tracer)
 
-        self.logger.proxy_connection(request)
+        task = asyncio.current_task()
+        self._clients.add(task)
 
-        # Wait for response from destination webserver
-        response_stream_parser = HttpResponseStreamParser()
-        response = None
-        while response is None:
-            message = sock.recv(1024)
-            response = response_stream_parser.parseNext(message)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
 
-        connection.send(response.response)
-        sock.close()
+        phase = "idle"
+        try:
+            while True:
+                try:
+                    message = request_reader.next_message()
+                except HttpException as e:
+                    await self._reply_error_async(writer, request_reader, e.status_code)
+                    break
 
-class HttpRequest():
-    def __init__(self):
-        self._method = None
-        self._url = None
-        self._version = None
-        self._headers = {}
-        self._data = None
+                if message is None:
+                    phase, wait = request_reader.wait_time()
+                    data = await asyncio.wait_for(reader.read(65536), wait)
+                    if not data:
+                        break
 
-    @property
-    def method(self):
-        return self._method
-    
-    @method.setter
-    def method(self, value):
-        if value not in HttpMethod.METHODS:
-            raise ValueError("Unknown method: " + value)
-        
-        self._method = value
+                    request_reader.feed(data)
+                    continue
 
-    @property
-    def url(self):
-        return self._url
-    
-    @url.setter
-    def url(self, value):
-        self._url = value
+                # Handle HTTP request
+                phase = "handler"
+                response = await asyncio.wait_for(
+                    handler.handle_async(message, self.routes, self.executor, request_reader.request),
+                    self.handler_timeout)
+                if self.stopping:
+                    request_reader.keep_alive = False
 
-    @property
-    def version(self):
-        return self._version
-    
-    @version.setter
-    def version(self, value):
-        if value != "HTTP/1.1":
-            raise ValueError("Unsupported HTTP version: " + value + " .Only HTTP/1.1 is supported")
-        
-        self._version = value
+                request_reader.close_after(response)
 
-    @property
-    def headers(self):
-        return self._headers
-    
-    @headers.setter
-    def headers(self, value):
-        self._headers = dict((k.lower(), v) for k,v in value.items())
+                phase = "send"
+                if self.metrics is None and self.tracer is None:
+                    await self._send_async(response, writer)
+                else:
+                    start = time.perf_counter()
+                    head = response.head
+                    serialized = time.perf_counter()
+                    await self._send_async(response, writer, head)
+                    self._record(handler, request_reader, response, message, head, start, serialized)
 
-    @property
-    def data(self):
-        return self._data
-    
-    @data.setter
-    def data(self, value):
-        self._data = value
+                if not request_reader.keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            await self._timed_out_async(writer, request_reader, handler, phase)
+        except ConnectionError:
+            pass # the client went away
+        except Exception as e:
+            self.logger.error("Connection failed", e)
+        finally:
+            writer.close()
+            self._clients.discard(task)
 
-    def __repr__(self):
-        line_break = "\r\n"
-        status_line = f"{self._method} {self._url} {self._version}" + line_break
-        response = status_line
-        
-        for _, (key, value) in enumerate(self._headers.items()):
-            response += f"{key}: {value}" + line_break
+            if self.metrics is not None:
+                self.metrics.connection_closed()
 
-        response += line_break
+    async def _send_async(self, response, writer, head=None):
+        # a timer handle is much cheaper than wait_for on every response. It is re-armed for as
+        # long as the client takes something, so only a send that stops moving is cut off
+        task = asyncio.current_task()
+        timer = None
+        stalled = []
 
-        if self._data is not None:
-            response += self._data
+        def progress():
+            return response.sent, writer.transport.get_write_buffer_size(), HttpResponse.unsent(sock)
 
-        return response
+        sock = writer.get_extra_info("socket")
 
-class HttpResponse():
-    def __init__(self, status_code):
-        self._version = "HTTP/1.1"
-        self._status_code = status_code
-        
-        self._headers = {
-            "date": formatdate(timeval=None, localtime=False, usegmt=True),
-            "server": "SimpleHTTPServer/1.0",
-            "content-type": "text/html; charset=utf-8"
-        }
+        def check(last):
+            nonlocal timer
+            now = progress()
+            if now != last:
+                timer = self._loop.call_later(self.keep_alive_timeout, check, now)
+            else:
+                # cancelling the send lets a pending sendfile unwind before the connection goes
+                stalled.append(True)
+                task.cancel()
 
-        self._data = None
-    
-    @property
-    def version(self):
-        return self._version
-    
-    @version.setter
-    def version(self, value):
-        if value != "HTTP/1.1":
-            raise ValueError("Unsupported HTTP version: " + value + ". Only HTTP/1.1 is supported")
-        
-        self._version = value
+        timer = self._loop.call_later(self.keep_alive_timeout, check, progress())
+        try:
+            await response.send_async(writer, head)
+        except asyncio.CancelledError:
+            if not stalled:
+                raise
 
-    @property
-    def status_code(self):
-        return self._status_code
+            writer.transport.abort()
+            raise asyncio.TimeoutError()
+        finally:
+            timer.cancel()
 
-    @status_code.setter
-    def status_code(self, value):
-        if value not in HttpStatus.CODES:
-            raise ValueError("Unknown status code: " + value)
-        
-        self._status_code = value
+    async def _reply_error_async(self, writer, reader, status_code):
+        response = HttpResponse(status_code)
+        reader.close_after(response)
+        writer.write(response.response)
+        await asyncio.wait_for(writer.drain(), self.keep_alive_timeout)
 
-    @property
-    def headers(self):
-        return self._headers
-    
-    @headers.setter
-    def headers(self, value, overwrite=False):
-        value = dict((k.lower(), v) for k,v in value.items())
-        
-        if overwrite:
-            self.headers = value
-        
-        self._headers.update(value)
+        self.logger.http_connection(response.status_code)
 
-    @property
-    def data(self):
-        return self._data
+    async def _timed_out_async(self, writer, reader, handler, phase):
+        # a half read request gets told, an idle connection or stalled write is just closed
+        if phase == "handler":
+            reader.keep_alive = False
+            status_code = HttpStatus.Service_Unavailable
+            self._trace_timeout(handler)
+        elif phase in ["header", "body"]:
+            status_code = HttpStatus.Request_Timeout
+        else:
+            status_code = None
 
-    @data.setter
-    def data(self, value):
-        self._data = value
-        self._headers["content-length"] = self._content_length(value)
+        if status_code is not None:
+            try:
+                await self._reply_error_async(writer, reader, status_code)
+            except (OSError, asyncio.TimeoutError):
+                pass
 
-    def _generate_response(self):
-        line_break = "\r\n"
-        
-        # set status line
-        response = f"{self._version} {self._status_code} {HttpStatus.message(self._status_code)}" + line_break
+        if self.metrics is not None:
+            self.metrics.timed_out(phase)
 
-        # set headers
-        for _, (key, value) in enumerate(self._headers.items()):
-            response += f"{key.lower()}: {value}" + line_break
-        
-        # add additional line break to indicate next section is the data
-        response += line_break
-        response = response.encode()
+class ProxyServer(TcpServer):
+    def __init__(self, port=8888, workers=8, queue_size=64, backlog=128, keep_alive_timeout=5, max_requests=100,
+                 max_header_size=16384, max_body_size=10485760, upstream_pool=None, cache=None, access_log=None,
+                 reuse_port=False, header_timeout=10, body_timeout=30, metrics=None, tls=None,
+                 tunnel_ports=HttpProxyRequestHandler.TUNNEL_PORTS, tunnel_timeout=300):
+        # tls is a TlsConfig for clients that reach the proxy itself over TLS
+        TcpServer.__init__(self, port, workers, queue_size, backlog, TcpServer.OVERLOAD_BLOCK, reuse_port, tls)
 
-        # set data
-        if self._data is not None:
-            data = self._data.encode()
-            response += data
+        # CONNECT is limited to tunnel_ports, None allows any
+        self.tunnel_ports = tunnel_ports
+        self.tunnel_timeout = tunnel_timeout
 
-        return response
-    
-    def _content_length(self, content):
-        if isinstance(content, str):
-            encoded = content.encode()
-            return len(encoded)
-        
-        return 0
+        # upstream connect and read timeouts are set on upstream_pool
+        self.keep_alive_timeout = keep_alive_timeout
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.max_requests = max_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
 
-    @property
-    def response(self):
-        return self._generate_response()
+        if upstream_pool is None:
+            upstream_pool = UpstreamPool()
 
-class HttpServer(Thread):
-    def __init__(self, port=80):
-        Thread.__init__(self)
-        self.port = port
-        self.routes = {}
+        self.upstream_pool = upstream_pool
+        self.cache = cache
 
-    def route(self, endpoint):
-        def add_rule(view_func=None):
-            if view_func is None:
-                raise ValueError("view_func cannot be None")
-            
-            args = getfullargspec(view_func)[0] # accesses 'args'
-            self.routes[endpoint] = {"view_func": view_func, "args": args}
+        self.logger = ConsoleLogger(access_log)
+        self.metrics = metrics
 
-            return view_func
-        
-        return add_rule
-    
-    def abort(self, status_code):
-        raise HttpException(status_code)
-    
-    def run(self):
-            tcp_socket = socket(AF_INET, SOCK_STREAM)
-            tcp_socket.bind(("", self.port))
-            tcp_socket.listen(1)
+    def _handle_connection(self, connection, addr):
+        connection = self._accepted(connection)
+        if connection is None:
+            return
 
-            logger = ConsoleLogger()
-            logger.server("running...")
+        reader = HttpRequestReader(self.max_requests, self.max_header_size, self.max_body_size,
+                                   header_timeout=self.header_timeout, body_timeout=self.body_timeout,
+                                   idle_timeout=self.keep_alive_timeout)
+        handler = HttpProxyRequestHandler(self.upstream_pool, self.cache, logger=self.logger, client=addr[0],
+                                          metrics=self.metrics, tunnel_ports=self.tunnel_ports,
+                                          tunnel_timeout=self.tunnel_timeout)
 
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+        phase = "idle"
+        try:
             while True:
-                connection, addr = tcp_socket.accept()
+                try:
+                    message = reader.next_message()
+                except HttpException as e:
+                    self._reply_error(connection, reader, e.status_code)
+                    break
+
+                if message is None:
+                    phase, wait = reader.wait_time()
+                    if wait is not None and wait <= 0:
+                        raise timeout("timed out")
 
-                message = connection.recv(1024).decode()
+                    connection.settimeout(wait)
+                    if reader.recv_into(connection) == 0:
+                        break
+
+                    continue
 
                 # Handle HTTP request
-                handler = HttpRequestHandler()
-                response = handler.handle(message, self.routes)
+                if self.stopping:
+                    reader.keep_alive = False
 
-                connection.send(response.response)
+                # relaying the response writes to the client as it goes
+                phase = "send"
+                connection.settimeout(self.keep_alive_timeout)
+
+                response = handler.handle(message, connection, reader)
+                if response is not None:
+                    reader.close_after(response)
+                    connection.sendall(response.response)
+
+                if not reader.keep_alive:
+                    break
+        except timeout:
+            self._timed_out(connection, reader, phase)
+        finally:
+            connection.close()
+
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+
+class Supervisor():
+    """
+    Pre-fork launcher that runs a server in several processes, so it isn't limited
+    to the one core the GIL allows. server_factory is called in each worker process
+    and returns a configured HttpServer, AsyncHttpServer or ProxyServer. Workers
+    share the port with SO_REUSEPORT, or where that's missing, accept on a listening
+    socket created before forking.
+
+    Workers that exit are restarted. SIGHUP replaces every worker: the new ones are
+    started before the old ones drain. SIGTERM and SIGINT drain every worker, and
+    stragglers are killed after drain_timeout. Caches and metrics are per process.
+    """
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, server_factory, processes=None, reuse_port=None, drain_timeout=30, restart_delay=1):
+        if not hasattr(os, "fork"):
+            raise OSError("Supervisor needs os.fork")
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        if reuse_port is None:
+            reuse_port = "SO_REUSEPORT" in globals()
+
+        self.server_factory = server_factory
+        self.processes = processes
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+
+        self.workers = {} # pid -> generation
+        self.generation = 0
+
+        self.logger = ConsoleLogger()
+
+        self._listener = None
+        self._signals = []
+        self._restarts = [] # times at which to replace workers that died
+        self._draining = {} # pid -> time by which it must have exited
 
-                connection.close()
-            
-class ProxyServer(Thread):
-    def __init__(self, port=8888):
-        Thread.__init__(self)
-        self.port = port
-    
     def run(self):
-        tcp_socket = socket(AF_INET, SOCK_STREAM)
-        tcp_socket.bind(("", self.port))
-        tcp_socket.listen(1)
+        if not self.reuse_port:
+            server = self.server_factory()
+            self._listener = socket(AF_INET, SOCK_STREAM)
+            self._listener.bind(("", server.port))
+            self._listener.listen(server.backlog)
+
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]:
+            signal.signal(signum, self._on_signal)
 
-        logger = ConsoleLogger()
-        logger.server("running...")
+        self.logger.server(f"supervising {self.processes} worker processes")
+        for _ in range(self.processes):
+            self._spawn()
 
         while True:
-            connection, addr = tcp_socket.accept()
+            self._reap()
+
+            while len(self._signals) > 0:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self._reload()
+                else:
+                    self._shutdown()
+                    return
+
+            now = time.monotonic()
+            while len(self._restarts) > 0 and self._restarts[0] <= now:
+                self._restarts.pop(0)
+                self._spawn()
+
+            self._kill_stragglers()
+            time.sleep(Supervisor.POLL_INTERVAL)
+
+    def _on_signal(self, signum, frame):
+        # only recorded here, the main loop acts on it
+        self._signals.append(signum)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker()
+
+        self.workers[pid] = self.generation
+
+    def _run_worker(self):
+        status = 0
+        try:
+            for signum in [signal.SIGINT, signal.SIGHUP]:
+                signal.signal(signum, signal.SIG_IGN)
+
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-            message = connection.recv(1024).decode()
+            server = self.server_factory()
+            server.reuse_port = self.reuse_port
+            server.listener = self._listener
 
-            # Handle HTTP request
-            handler = HttpProxyRequestHandler()
-            handler.handle(message, connection)
+            signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+            server.run()
+            server.logger.access_log.close()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
 
-            # connection.send(response.response)
+    def _reap(self):
+        while len(self.workers) > 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            generation = self.workers.pop(pid, None)
+            self._draining.pop(pid, None)
+
+            # workers of an older generation were told to exit
+            if generation == self.generation:
+                self.logger.server(f"worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+                self._restarts.append(time.monotonic() + self.restart_delay)
+
+    def _reload(self):
+        self.logger.server("reloading workers")
+
+        old = list(self.workers.keys())
+        self.generation += 1
+        self._restarts = []
+
+        for _ in range(self.processes):
+            self._spawn()
+
+        for pid in old:
+            self._drain(pid)
 
-            connection.close()
\ No newline at end of file
+    def _shutdown(self):
+        self.logger.server("draining workers")
+
+        for pid in list(self.workers.keys()):
+            self._drain(pid)
+
+        self.generation += 1 # nothing is restarted from here on
+        while len(self.workers) > 0:
+            self._reap()
+            self._kill_stragglers()
+            time.sleep(Supervisor.POLL_INTERVAL)
+
+        if self._listener is not None:
+            self._listener.close()
+
+        self.logger.access_log.close()
+
+    def _drain(self, pid):
+        self._draining[pid] = time.monotonic() + self.drain_timeout
+        self._kill(pid, signal.SIGTERM)
+
+    def _kill_stragglers(self):
+        now = time.monotonic()
+        for pid, deadline in list(self._draining.items()):
+            if now > deadline:
+                del self._draining[pid]
+                self._kill(pid, signal.SIGKILL)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
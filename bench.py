@@ -0,0 +1,315 @@
+"""
+Benchmarks for SimpleHttpServer.
+
+Microbenchmarks time the parsers and response serialization in-process. The load
+tests start the servers on loopback and drive them with asyncio clients: a static
+file, a dynamic route, and the proxy in front of a local stand-in upstream.
+
+    python bench.py                      # everything, JSON on stdout
+    python bench.py --only micro
+    python bench.py --duration 10 --connections 64 --output bench.json
+
+Results are JSON so runs can be compared across commits.
+"""
+from socket import socket, AF_INET, SOCK_STREAM
+from threading import Thread
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+
+from SimpleHttpServer import (HttpServer, AsyncHttpServer, ProxyServer, AccessLog, HttpRequestParser,
+                              HttpRequestReader, HttpResponseParser, HttpResponseStreamParser, HttpResponse, HttpStatus)
+
+REQUEST = (
+    "GET /users/42?page=2 HTTP/1.1\r\n"
+    "Host: localhost\r\n"
+    "User-Agent: bench/1.0\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    "Accept-Encoding: gzip, deflate, br\r\n"
+    "Accept-Language: en-US,en;q=0.5\r\n"
+    "Connection: keep-alive\r\n"
+    "\r\n"
+).encode()
+
+BODY = b"x" * 1024
+
+RESPONSE = (
+    "HTTP/1.1 200 OK\r\n"
+    "Date: Sun, 18 Oct 2026 10:00:00 GMT\r\n"
+    "Server: upstream\r\n"
+    "Content-Type: text/plain\r\n"
+    f"Content-Length: {len(BODY)}\r\n"
+    "\r\n"
+).encode() + BODY
+
+CHUNKED_RESPONSE = (
+    b"HTTP/1.1 200 OK\r\n"
+    b"Content-Type: text/plain\r\n"
+    b"Transfer-Encoding: chunked\r\n"
+    b"\r\n"
+    + b"".join(b"%x\r\n" % 256 + BODY[:256] + b"\r\n" for _ in range(4))
+    + b"0\r\n\r\n"
+)
+
+# ----- microbenchmarks -----
+
+def measure(func, repeat=5, min_time=0.2):
+    """ Best time per call in ns over repeat runs of at least min_time seconds each """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return {"ns_per_op": round(best * 1e9, 1), "ops_per_sec": round(1 / best)}
+
+def parse_request():
+    HttpRequestParser().parse(REQUEST)
+
+# one reader for every call, as on a kept-alive connection
+READER = HttpRequestReader()
+
+def read_request():
+    READER.buffer += REQUEST
+    READER.next_message()
+
+def read_request_headers():
+    # what a handler pays once it looks at the headers
+    READER.buffer += REQUEST
+    READER.next_message()
+    READER.request.headers.get("accept-encoding")
+
+def parse_response():
+    HttpResponseParser().parse(RESPONSE.decode("iso-8859-1"))
+
+def stream_parse_length():
+    parser = HttpResponseStreamParser()
+    parser.parseNext(RESPONSE[:100])
+    parser.parseNext(RESPONSE[100:])
+
+def stream_parse_chunked():
+    parser = HttpResponseStreamParser()
+    parser.parseNext(CHUNKED_RESPONSE[:100])
+    parser.parseNext(CHUNKED_RESPONSE[100:])
+
+def generate_response():
+    response = HttpResponse(HttpStatus.OK)
+    response.headers = {"content-type": "text/plain"}
+    response.data = BODY
+    response._generate_response()
+
+def run_micro():
+    benchmarks = {
+        "HttpRequestParser.parse": parse_request,
+        "HttpRequestReader.next_message": read_request,
+        "HttpRequestReader.next_message (headers read)": read_request_headers,
+        "HttpResponseParser.parse": parse_response,
+        "HttpResponseStreamParser.parseNext (content-length)": stream_parse_length,
+        "HttpResponseStreamParser.parseNext (chunked)": stream_parse_chunked,
+        "HttpResponse._generate_response": generate_response
+    }
+
+    return dict((name, measure(func)) for name, func in benchmarks.items())
+
+# ----- load tests -----
+
+def free_port():
+    with socket(AF_INET, SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket(AF_INET, SOCK_STREAM) as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+
+    raise RuntimeError(f"server on port {port} did not start")
+
+async def read_response(reader):
+    """ Returns (status, keep_alive) """
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head[9:12])
+
+    length = 0
+    keep_alive = True
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"connection":
+            keep_alive = value.strip().lower() != b"close"
+
+    if length > 0:
+        await reader.readexactly(length)
+
+    return status, keep_alive
+
+async def client(port, request, deadline, latencies, errors):
+    # reconnects whenever the server closes, e.g. after its max_requests per connection
+    while time.perf_counter() < deadline:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            keep_alive = True
+            while keep_alive and time.perf_counter() < deadline:
+                start = time.perf_counter()
+                writer.write(request)
+                status, keep_alive = await read_response(reader)
+                latencies.append(time.perf_counter() - start)
+                if status >= 400:
+                    errors[0] += 1
+        except (OSError, asyncio.IncompleteReadError):
+            errors[0] += 1
+        finally:
+            writer.close()
+
+async def load(port, request, duration, connections):
+    latencies = []
+    errors = [0]
+
+    # short warm up so caches and pools are populated before measuring
+    await asyncio.gather(*[client(port, request, time.perf_counter() + 0.2, [], [0]) for _ in range(connections)])
+
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[client(port, request, deadline, latencies, errors) for _ in range(connections)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    if len(latencies) == 0:
+        return {"requests": 0, "errors": errors[0]}
+
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3)
+    }
+
+async def stand_in_upstream(reader, writer):
+    """ Answers every request with a fixed keep-alive response """
+    try:
+        while True:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(RESPONSE)
+            await writer.drain()
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+def start_upstream(port):
+    loop = asyncio.new_event_loop()
+
+    async def serve():
+        server = await asyncio.start_server(stand_in_upstream, "127.0.0.1", port)
+        async with server:
+            await server.serve_forever()
+
+    Thread(target=loop.run_until_complete, args=(serve(),), daemon=True).start()
+    wait_for_port(port)
+
+def start_server(server_class, connections):
+    port = free_port()
+    server = server_class(port=port, workers=connections, queue_size=connections * 2,
+                          access_log=AccessLog(os.devnull))
+
+    @server.route("/users/<int:id>")
+    def user(id):
+        return f"<p>user {id}</p>"
+
+    server.daemon = True
+    server.start()
+    wait_for_port(port)
+    return port
+
+def run_load(duration, connections):
+    results = {}
+
+    for server_class in [HttpServer, AsyncHttpServer]:
+        port = start_server(server_class, connections)
+        name = server_class.__name__
+
+        static = b"GET /test.html HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        results[f"{name} static"] = asyncio.run(load(port, static, duration, connections))
+
+        dynamic = b"GET /users/42 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+        results[f"{name} dynamic"] = asyncio.run(load(port, dynamic, duration, connections))
+
+    upstream_port = free_port()
+    start_upstream(upstream_port)
+
+    proxy_port = free_port()
+    proxy = ProxyServer(port=proxy_port, workers=connections, queue_size=connections * 2,
+                        access_log=AccessLog(os.devnull))
+    proxy.daemon = True
+    proxy.start()
+    wait_for_port(proxy_port)
+
+    proxied = f"GET http://127.0.0.1:{upstream_port}/ HTTP/1.1\r\nHost: 127.0.0.1:{upstream_port}\r\n\r\n".encode()
+    results["ProxyServer"] = asyncio.run(load(proxy_port, proxied, duration, connections))
+
+    return results
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SimpleHttpServer")
+    parser.add_argument("--only", choices=["micro", "load"], help="run just one group of benchmarks")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per load test")
+    parser.add_argument("--connections", type=int, default=32, help="concurrent clients per load test")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    # static files are served relative to the repo
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = {
+        "commit": commit(),
+        "time": datetime.datetime.now().astimezone().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "duration": args.duration,
+        "connections": args.connections
+    }
+
+    if args.only in [None, "micro"]:
+        results["micro"] = run_micro()
+
+    if args.only in [None, "load"]:
+        results["load"] = run_load(args.duration, args.connections)
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
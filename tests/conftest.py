@@ -0,0 +1,144 @@
+import http.client
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from SimpleHttpServer import HttpServer, AsyncHttpServer, AccessLog
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.02)
+
+    raise RuntimeError(f"nothing listening on {port}")
+
+
+def wait_until(condition, timeout=5):
+    """ Polls condition, for what a server only does once the client already has its response """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+class Client():
+    """
+    Raw connection to a test server. Requests go out exactly as given, and responses
+    are read back in order from one buffered stream, so pipelined responses and any
+    stray bytes between them show up as they were sent.
+    """
+    def __init__(self, port, timeout=5):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        self.file = self.sock.makefile("rb")
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def request(self, method, path, headers=None, body=b""):
+        headers = dict(headers or {})
+        headers.setdefault("Host", "localhost")
+        if body:
+            headers.setdefault("Content-Length", str(len(body)))
+
+        head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        self.send(head.encode() + body)
+
+    def response(self, method="GET"):
+        """ Reads one response, returning (HTTPResponse, body) """
+        response = http.client.HTTPResponse(self, method=method)
+        response.begin()
+        return response, response.read()
+
+    def rest(self):
+        """ Everything left on the connection until the server closes it """
+        return self.file.read()
+
+    def makefile(self, mode, *args, **kwargs):
+        # http.client closes the file after each response, which would lose what is buffered
+        return _Unclosable(self.file)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class _Unclosable():
+    def __init__(self, file):
+        self._file = file
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    # static files are served from ./resources
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(params=[HttpServer, AsyncHttpServer], ids=["threaded", "async"])
+def server_class(request):
+    return request.param
+
+
+@pytest.fixture
+def make_server(server_class):
+    """ Returns make(**kwargs), a server of the engine under test on a free port, not started yet """
+    def make(**kwargs):
+        kwargs.setdefault("access_log", AccessLog(os.devnull))
+        return server_class(port=free_port(), **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def start():
+    """ Returns start(server), which runs server until the test ends and returns its port """
+    servers = []
+
+    def run(server):
+        server.daemon = True
+        server.start()
+        wait_for_port(server.port)
+        servers.append(server)
+        return server.port
+
+    yield run
+
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def connect():
+    """ Returns connect(port), a Client closed when the test ends """
+    clients = []
+
+    def open_client(port, timeout=5):
+        client = Client(port, timeout)
+        clients.append(client)
+        return client
+
+    yield open_client
+
+    for client in clients:
+        client.close()
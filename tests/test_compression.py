@@ -0,0 +1,87 @@
+import gzip
+
+import pytest
+
+from SimpleHttpServer import Compression, ResourceIndex
+
+
+@pytest.fixture
+def body():
+    with open("resources/test.html", "rb") as f:
+        return f.read()
+
+
+def get(client, path, headers=None):
+    client.request("GET", path, headers)
+    return client.response()
+
+
+def test_static_file_is_gzipped_with_its_own_etag(make_server, start, connect, body):
+    client = connect(start(make_server(compression=Compression(min_size=100))))
+
+    response, data = get(client, "/test.html", {"Accept-Encoding": "gzip"})
+    etag = response.getheader("etag")
+    assert response.getheader("content-encoding") == "gzip"
+    assert response.getheader("vary") == "accept-encoding"
+    assert etag.endswith('-gzip"')
+    assert gzip.decompress(data) == body
+
+    response, data = get(client, "/test.html")
+    assert response.getheader("content-encoding") is None
+    assert response.getheader("etag") == etag.replace("-gzip", "")
+    assert data == body
+
+    # the gzip etag only matches the gzip representation
+    response, _ = get(client, "/test.html", {"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status == 304
+    response, data = get(client, "/test.html", {"If-None-Match": etag})
+    assert (response.status, data) == (200, body)
+
+
+def test_precompressed_sibling_is_sent_as_is(make_server, start, connect, tmp_path):
+    (tmp_path / "app.js").write_bytes(b"let x = 1;\n" * 200)
+    (tmp_path / "app.js.gz").write_bytes(b"prebuilt")
+
+    server = make_server(compression=Compression())
+    server.resources = ResourceIndex(str(tmp_path))
+    client = connect(start(server))
+
+    response, data = get(client, "/app.js", {"Accept-Encoding": "br;q=0, gzip"})
+    assert response.getheader("content-encoding") == "gzip"
+    assert data == b"prebuilt"
+
+
+def test_views_are_compressed_above_min_size(make_server, start, connect):
+    server = make_server(compression=Compression(min_size=100))
+
+    @server.route("/long")
+    def long_view():
+        return "a" * 1000
+
+    @server.route("/short")
+    def short_view():
+        return "a" * 10
+
+    client = connect(start(server))
+
+    response, data = get(client, "/long", {"Accept-Encoding": "gzip"})
+    assert response.getheader("content-encoding") == "gzip"
+    assert gzip.decompress(data) == b"a" * 1000
+
+    response, data = get(client, "/short", {"Accept-Encoding": "gzip"})
+    assert response.getheader("content-encoding") is None
+    assert data == b"a" * 10
+
+
+@pytest.mark.parametrize("accept, encoding", [
+    ("gzip", "gzip"),
+    ("gzip;q=0, deflate", "deflate"),
+    ("*;q=0", None),
+    ("identity", None),
+    ("", None),
+])
+def test_negotiate(accept, encoding):
+    compression = Compression()
+    compression.encodings = ["gzip", "deflate"] # whether brotli is installed doesn't matter
+
+    assert compression.negotiate(accept) == encoding
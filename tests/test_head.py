@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+
+def test_pipelined_head_then_get(make_server, start, connect):
+    server = make_server()
+
+    @server.route("/hello")
+    def hello():
+        return "hello world"
+
+    client = connect(start(server))
+    client.send(b"HEAD /hello HTTP/1.1\r\nHost: x\r\n\r\n"
+                b"GET /hello HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+
+    response, body = client.response("HEAD")
+    assert response.status == 200
+    assert response.getheader("content-length") == "11"
+
+    # a body after the HEAD response would be read as the next status line
+    response, body = client.response()
+    assert (response.status, body) == (200, b"hello world")
+    assert client.rest() == b""
+
+
+def test_head_of_a_static_file_sends_no_body(make_server, start, connect):
+    size = os.path.getsize("resources/test.html")
+    client = connect(start(make_server()))
+    client.send(b"HEAD /test.html HTTP/1.1\r\nHost: x\r\n\r\n"
+                b"GET /test.html HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+
+    response, _ = client.response("HEAD")
+    assert response.getheader("content-length") == str(size)
+
+    response, body = client.response()
+    assert len(body) == size
+    assert client.rest() == b""
+
+
+@pytest.mark.parametrize("kind", ["generator", "file"])
+def test_head_of_a_streamed_view_sends_no_body(make_server, start, connect, kind):
+    server = make_server()
+
+    @server.route("/stream")
+    def stream():
+        if kind == "file":
+            return open("resources/test.html", "rb")
+
+        return (chunk for chunk in ["one", "two"])
+
+    client = connect(start(server))
+    client.send(b"HEAD /stream HTTP/1.1\r\nHost: x\r\n\r\n"
+                b"GET /stream HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+
+    client.response("HEAD")
+    response, body = client.response()
+    assert response.status == 200
+    assert len(body) > 0
+    assert client.rest() == b""
@@ -0,0 +1,116 @@
+import json
+import os
+import time
+
+import pytest
+
+from SimpleHttpServer import AccessLog, ConsoleLogger, HttpRequestReader
+
+
+def parse(data):
+    reader = HttpRequestReader()
+    reader.buffer += data
+    reader.next_message()
+    return reader.request
+
+
+def test_abort_writes_nothing_to_stdout(make_server, start, connect, capfd):
+    server = make_server()
+
+    @server.route("/forbidden")
+    def forbidden():
+        server.abort(403)
+
+    client = connect(start(server))
+    client.request("GET", "/forbidden", {"Connection": "close"})
+    response, _ = client.response()
+
+    assert response.status == 403
+    assert capfd.readouterr().out == ""
+
+
+def test_error_records_carry_the_traceback(tmp_path):
+    path = tmp_path / "log.json"
+    log = AccessLog(str(path), format=AccessLog.FORMAT_JSON)
+
+    try:
+        raise ValueError("boom")
+    except ValueError as e:
+        ConsoleLogger(log).error("View failed", e)
+
+    log.close()
+    record = json.loads(path.read_text())
+
+    assert record["error"] == "View failed"
+    assert "ValueError: boom" in record["exception"]
+
+
+def test_error_records_are_never_sampled_out(tmp_path):
+    path = tmp_path / "log.txt"
+    log = AccessLog(str(path), sample_rate=0)
+
+    ConsoleLogger(log).error("Worker failed")
+    log.close()
+
+    assert path.read_text() == "[Error]: Worker failed\n"
+
+
+def test_log_rotates_at_max_bytes(tmp_path):
+    path = str(tmp_path / "access.log")
+    # batches of one, so the size is checked before every line
+    log = AccessLog(path, batch_size=1, max_bytes=100, backup_count=2)
+    for i in range(5):
+        ConsoleLogger(log).server(f"line {i} " + "x" * 50)
+
+    log.close()
+
+    assert open(path).read().startswith("[Server]: line 4")
+    assert open(path + ".1").read().startswith("[Server]: line 3")
+    assert open(path + ".2").read().startswith("[Server]: line 2")
+    assert not os.path.exists(path + ".3")
+
+
+@pytest.mark.parametrize("format, expected", [
+    (AccessLog.FORMAT_COMMON, '10.0.0.1 - - [{time}] "GET /a?b=1 HTTP/1.1" 200 11'),
+    (AccessLog.FORMAT_COMBINED, '10.0.0.1 - - [{time}] "GET /a?b=1 HTTP/1.1" 200 11 "http://ref/" "curl/8"'),
+])
+def test_common_and_combined_formats(tmp_path, format, expected):
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), format=format)
+    request = parse(b"GET /a?b=1 HTTP/1.1\r\nHost: x\r\nReferer: http://ref/\r\nUser-Agent: curl/8\r\n\r\n")
+    timestamp = time.time()
+
+    log.log(("http", timestamp, 200, request, "10.0.0.1", 11))
+    log.close()
+
+    log_time = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(timestamp))
+    assert path.read_text() == expected.format(time=log_time) + "\n"
+
+
+def test_json_format(tmp_path):
+    path = tmp_path / "access.json"
+    log = AccessLog(str(path), format=AccessLog.FORMAT_JSON)
+    request = parse(b"POST /form HTTP/1.1\r\nHost: example.com\r\n\r\n")
+
+    ConsoleLogger(log).http_connection(201, request, "10.0.0.1", 2)
+    ConsoleLogger(log).http_connection(400)
+    log.close()
+
+    first, second = [json.loads(line) for line in path.read_text().splitlines()]
+    assert {key: first[key] for key in ["client", "host", "method", "url", "version", "status", "size"]} == {
+        "client": "10.0.0.1", "host": "example.com", "method": "POST", "url": "/form", "version": "HTTP/1.1",
+        "status": 201, "size": 2}
+    assert (second["method"], second["status"]) == (None, 400)
+
+
+def test_sample_rate_keeps_server_records(tmp_path):
+    path = tmp_path / "access.log"
+    log = AccessLog(str(path), sample_rate=0)
+    logger = ConsoleLogger(log)
+
+    logger.http_connection(200)
+    logger.server("running...")
+    log.close()
+
+    assert path.read_text() == "[Server]: running...\n"
+    assert log.sampled_out == 1
@@ -0,0 +1,64 @@
+from SimpleHttpServer import Metrics
+
+from conftest import wait_until
+
+
+def scrape(client):
+    client.request("GET", "/metrics")
+    response, body = client.response()
+    assert response.status == 200
+    assert response.getheader("content-type").startswith("text/plain; version=0.0.4")
+
+    samples = {}
+    for line in body.decode().splitlines():
+        if not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+
+    return samples
+
+
+def test_prometheus_endpoint(make_server, start, connect):
+    server = make_server(metrics_path="/metrics")
+
+    @server.route("/users/<int:id>")
+    def user(id):
+        return f"user {id}"
+
+    client = connect(start(server))
+    for path in ["/users/1", "/users/2", "/missing"]:
+        client.request("GET", path)
+        client.response()
+
+    wait_until(lambda: sum(server.metrics.snapshot()["requests"].values()) == 3)
+    samples = scrape(client)
+
+    # requests are counted per route rule, not per url
+    assert samples['simplehttp_requests_total{route="/users/<int:id>",method="GET",status="200"}'] == 2
+    assert samples['simplehttp_requests_total{route="static",method="GET",status="404"}'] == 1
+    assert samples['simplehttp_stage_seconds_count{stage="handler"}'] == 3
+    assert samples['simplehttp_stage_seconds_bucket{stage="handler",le="+Inf"}'] == 3
+
+    # the scraping connection is open while it is counted
+    other = scrape(connect(server.port))
+    assert other["simplehttp_connections_total"] == samples["simplehttp_connections_total"] + 1
+    assert other["simplehttp_connections_in_flight"] >= 2
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics(buckets=[0.1, 1.0])
+    for seconds in [0.05, 0.5, 5]:
+        metrics.record_request("/", "GET", 200, (0, seconds, 0, 0), 0, 0)
+
+    text = metrics.prometheus()
+    assert 'simplehttp_stage_seconds_bucket{stage="handler",le="0.1"} 1\n' in text
+    assert 'simplehttp_stage_seconds_bucket{stage="handler",le="1.0"} 2\n' in text
+    assert 'simplehttp_stage_seconds_bucket{stage="handler",le="+Inf"} 3\n' in text
+    assert 'simplehttp_stage_seconds_sum{stage="handler"} 5.55\n' in text
+
+
+def test_label_values_are_escaped():
+    metrics = Metrics()
+    metrics.record_request('/a"b\\c', "GET", 200, (0, 0, 0, 0), 0, 0)
+
+    assert 'route="/a\\"b\\\\c"' in metrics.prometheus()
@@ -0,0 +1,152 @@
+import pytest
+
+from SimpleHttpServer import (ChunkedDecoder, HttpException, HttpRequestReader, HttpStatus, HttpUpload,
+                              MultipartParser, UrlEncodedParser)
+
+
+def read(data, **kwargs):
+    reader = HttpRequestReader(**kwargs)
+    reader.buffer += data
+    return reader, reader.next_message()
+
+
+def test_framing_leaves_headers_undecoded():
+    reader, _ = read(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\nConnection: close\r\n\r\nhi")
+    request = reader.request
+
+    assert request.body == b"hi"
+    assert not reader.keep_alive
+    # nothing has been decoded until a handler asks
+    assert request._headers is None
+
+    assert request.header("content-length") == "2"
+    assert request.header("accept", "*/*") == "*/*"
+    assert request.headers == {"host": "x", "content-length": "2", "connection": "close"}
+
+
+def test_repeated_headers_are_combined():
+    reader, _ = read(b"GET / HTTP/1.1\r\nHost: x\r\nCookie: a=1\r\nCookie: b=2\r\nAccept: a\r\nAccept:  b \r\n\r\n")
+
+    assert reader.request.header("cookie") == "a=1; b=2"
+    assert reader.request.header("accept") == "a, b"
+
+
+# \xb2 decodes to a superscript two, which isdigit but not a DIGIT
+@pytest.mark.parametrize("length", [b"+2", b"1_0", b"-2", b"", b"0x2", b"\xb2"])
+def test_content_length_must_be_digits(length):
+    with pytest.raises(HttpException) as e:
+        read(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: " + length + b"\r\n\r\nhi")
+
+    assert e.value.status_code == HttpStatus.Bad_Request
+
+
+def test_conflicting_content_lengths_are_rejected():
+    with pytest.raises(HttpException) as e:
+        read(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\nContent-Length: 3\r\n\r\nhi")
+
+    assert e.value.status_code == HttpStatus.Bad_Request
+
+
+CHUNKED = b"4\r\nWiki\r\n5;ext=1\r\npedia\r\n0\r\nExpires: never\r\n\r\n"
+
+
+def test_chunked_body_decodes_across_any_split():
+    for size in [1, 2, 3, 7, len(CHUNKED)]:
+        decoder = ChunkedDecoder()
+        out = bytearray()
+        used = sum(decoder.feed(CHUNKED[i:i + size], out=out) for i in range(0, len(CHUNKED), size))
+
+        assert decoder.done and used == len(CHUNKED)
+        assert out == b"Wikipedia"
+
+
+@pytest.mark.parametrize("body", [b"4\r\nWikiX\r\n0\r\n\r\n", b"4\r\nWiki\rX0\r\n\r\n",
+                                  b"4\r\nWiki\n0\r\n\r\n"])
+def test_chunk_data_must_end_with_crlf(body):
+    decoder = ChunkedDecoder()
+    with pytest.raises(HttpException) as e:
+        for i in range(len(body)):
+            decoder.feed(body[i:i + 1])
+
+    assert e.value.status_code == HttpStatus.Bad_Request
+
+
+@pytest.mark.parametrize("size", [b"-2", b"0x4", b"+4", b"1_0", b" 4", b"4 ", b"\xd9\xa4", b"1" * 17, b""])
+def test_chunk_size_must_be_hex_digits(size):
+    decoder = ChunkedDecoder(max_size=10)
+    with pytest.raises(HttpException) as e:
+        decoder.feed(size + b"\r\nWiki\r\n0\r\n\r\n")
+
+    assert e.value.status_code == HttpStatus.Bad_Request
+
+
+def test_negative_chunks_cannot_get_past_max_size():
+    decoder = ChunkedDecoder(max_size=10)
+    with pytest.raises(HttpException):
+        decoder.feed(b"a\r\n0123456789\r\n" + b"-2\r\n" * 10 + b"0\r\n\r\n")
+
+    assert decoder.size <= 10
+
+
+def test_chunk_extensions_are_skipped():
+    decoder = ChunkedDecoder()
+    out = bytearray()
+    decoder.feed(b"4 ;name=value\r\nWiki\r\n0\r\n\r\n", out=out)
+
+    assert decoder.done and out == b"Wiki"
+
+
+def test_chunked_request_is_handed_on_with_a_content_length():
+    reader, message = read(b"POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n" + CHUNKED)
+
+    assert reader.request.body == b"Wikipedia"
+    assert reader.request.headers["content-length"] == "9"
+    assert b"transfer-encoding" not in message.lower()
+
+
+MULTIPART = (b"preamble\r\n--XyZ\r\nContent-Disposition: form-data; name=\"title\"\r\n\r\nhello\r\n"
+             b"--XyZ  \r\nContent-Disposition: form-data; name=\"doc\"; filename=\"a b.txt\"\r\n"
+             b"Content-Type: text/plain\r\n\r\nline\r\n--XyY\r\n--XyZ--\r\nepilogue")
+
+
+@pytest.mark.parametrize("size", [1, 5, len(MULTIPART)])
+def test_multipart_parts_split_across_feeds(size):
+    parser = MultipartParser("XyZ")
+    for i in range(0, len(MULTIPART), size):
+        parser.feed(MULTIPART[i:i + size])
+
+    fields = parser.close()
+    upload = fields["doc"]
+
+    assert fields["title"] == "hello"
+    assert isinstance(upload, HttpUpload)
+    assert (upload.filename, upload.content_type, upload.size) == ("a b.txt", "text/plain", 11)
+    upload.file.seek(0)
+    # a line that only starts like the boundary is part of the data
+    assert upload.file.read() == b"line\r\n--XyY"
+
+
+@pytest.mark.parametrize("body", [MULTIPART[:-30], MULTIPART.replace(b"--XyZ  ", b"--XyZ!!")])
+def test_malformed_multipart_is_rejected(body):
+    parser = MultipartParser("XyZ")
+    with pytest.raises(HttpException) as e:
+        parser.feed(body)
+        parser.close()
+
+    assert e.value.status_code == HttpStatus.Bad_Request
+
+
+def test_urlencoded_fields():
+    parser = UrlEncodedParser()
+    parser.feed(b"a=1&b=x%20y")
+    parser.feed(b"+z&a=2")
+
+    assert parser.close() == {"a": "2", "b": "x y z"}
+
+
+def test_oversized_field_is_rejected():
+    parser = MultipartParser("XyZ", max_field_size=3)
+    with pytest.raises(HttpException) as e:
+        parser.feed(MULTIPART)
+
+    assert e.value.status_code == HttpStatus.Payload_Too_Large
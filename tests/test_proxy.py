@@ -0,0 +1,122 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from SimpleHttpServer import AccessLog, ProxyServer, Resolver
+
+from conftest import free_port
+
+
+class Upstream():
+    """ One-connection origin server that answers each request with the given raw responses """
+    def __init__(self, *responses):
+        self.responses = responses
+        self.received = b""
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        conn, _ = self.listener.accept()
+        with conn:
+            while b"\r\n\r\n" not in self.received:
+                self.received += conn.recv(65536)
+
+            for response in self.responses:
+                conn.sendall(response)
+
+            # hold the connection until the proxy lets it go
+            conn.settimeout(5)
+            try:
+                while conn.recv(65536):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.fixture
+def proxy(start):
+    return start(ProxyServer(port=free_port(), access_log=AccessLog(os.devnull)))
+
+
+def test_interim_upstream_responses_are_skipped(proxy, connect):
+    upstream = Upstream(b"HTTP/1.1 100 Continue\r\n\r\n",
+                        b"HTTP/1.1 103 Early Hints\r\nLink: </a.css>\r\n\r\n"
+                        b"HTTP/1.1 201 Created\r\nContent-Length: 4\r\n\r\ndone")
+
+    client = connect(proxy)
+    client.request("POST", f"http://127.0.0.1:{upstream.port}/upload",
+                   {"Expect": "100-continue"}, b"data")
+    response, body = client.response()
+    upstream.close()
+
+    assert (response.status, body) == (201, b"done")
+    # the body was read in full before forwarding, upstream is not asked to wait
+    assert b"expect" not in upstream.received.lower()
+
+
+def test_unreachable_upstream_is_answered_with_502(proxy, connect):
+    client = connect(proxy)
+    client.request("GET", f"http://127.0.0.1:{free_port()}/")
+    response, _ = client.response()
+
+    assert response.status == 502
+
+
+def test_unresolvable_host_is_answered_with_502(proxy, connect):
+    # a label over 63 characters fails to encode before any lookup is made
+    host = "a" * 64 + ".example"
+    client = connect(proxy)
+    for method, url in [("GET", f"http://{host}/"), ("CONNECT", f"{host}:443")]:
+        client.request(method, url)
+        response, _ = client.response()
+        assert response.status == 502
+
+
+def test_failed_lookups_are_not_left_in_flight():
+    calls = []
+
+    def lookup(host, port, family, kind):
+        calls.append(host)
+        if len(calls) == 1:
+            raise OSError("resolver unavailable")
+
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("127.0.0.1", port))]
+
+    resolver = Resolver(lookup=lookup, timeout=1)
+    with pytest.raises(OSError):
+        resolver.resolve("example.com", 80)
+
+    # the failure is neither cached nor waited on, the next call looks up again
+    assert resolver.resolve("example.com", 80)[0][4] == ("127.0.0.1", 80)
+    assert calls == ["example.com", "example.com"]
+
+
+@pytest.mark.parametrize("response", [b"garbage\r\n\r\n", b"HTTP/1.1 2OO OK\r\n\r\n",
+                                      b"HTTP/1.1 200 OK\r\nContent-Length: abc\r\n\r\n",
+                                      b"HTTP/1.1 200 OK\r\nContent-Length: +4\r\n\r\nbody"])
+def test_malformed_upstream_response_is_answered_with_502(proxy, connect, response):
+    upstream = Upstream(response)
+
+    client = connect(proxy)
+    client.request("GET", f"http://127.0.0.1:{upstream.port}/")
+    response, _ = client.response()
+    upstream.close()
+
+    assert response.status == 502
+
+
+def test_half_sent_request_times_out_with_408(start, connect):
+    port = start(ProxyServer(port=free_port(), header_timeout=0.2, access_log=AccessLog(os.devnull)))
+    client = connect(port)
+    client.send(b"GET http://127.0.0.1/ HTTP/1.1\r\nHost: 127.0.0.1\r\n")
+    response, _ = client.response()
+
+    assert response.status == 408
+    assert client.rest() == b""
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+
+from SimpleHttpServer import AccessLog, HttpResponse, HttpServer, HttpStatus, ProxyCache, ProxyServer
+
+from conftest import Client, free_port, wait_until
+
+
+def response(body, **headers):
+    response = HttpResponse(HttpStatus.OK)
+    response.data = body
+    response.headers = dict((name.replace("_", "-"), value) for name, value in headers.items())
+    return response
+
+
+@pytest.fixture
+def origin(start):
+    """ An HttpServer for the proxy to fetch from, with calls counting the requests each view got """
+    server = HttpServer(port=free_port(), access_log=AccessLog(os.devnull))
+    server.calls = []
+
+    @server.route("/fresh")
+    def fresh(request):
+        server.calls.append(request.headers.get("if-none-match"))
+        return response("fresh", cache_control="max-age=60")
+
+    @server.route("/large")
+    def large(request):
+        server.calls.append(None)
+        return response("x" * 5000, cache_control="max-age=60")
+
+    @server.route("/validated")
+    def validated(request):
+        server.calls.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            not_modified = HttpResponse(HttpStatus.Not_Modified)
+            not_modified.headers = {"etag": '"v1"', "cache-control": "no-cache"}
+            return not_modified
+
+        return response("validated", etag='"v1"', cache_control="no-cache")
+
+    @server.route("/slow")
+    def slow(request):
+        server.calls.append(None)
+        time.sleep(0.3)
+        return response("slow", cache_control="max-age=60")
+
+    start(server)
+    return server
+
+
+def make_proxy(start, cache):
+    return start(ProxyServer(port=free_port(), cache=cache, access_log=AccessLog(os.devnull)))
+
+
+def get(port, url, headers=None):
+    client = Client(port)
+    try:
+        client.request("GET", url, headers)
+        return client.response()
+    finally:
+        client.close()
+
+
+def test_fresh_responses_are_served_from_the_cache(start, origin):
+    cache = ProxyCache()
+    proxy = make_proxy(start, cache)
+    url = f"http://127.0.0.1:{origin.port}/fresh"
+
+    first, body = get(proxy, url)
+    second, cached = get(proxy, url)
+
+    assert body == cached == b"fresh"
+    assert second.getheader("age") is not None
+    assert len(origin.calls) == 1
+    wait_until(lambda: cache.hits == 1)
+    assert cache.misses == 1
+
+
+def test_large_bodies_go_to_disk(start, origin, tmp_path):
+    cache = ProxyCache(disk_dir=str(tmp_path), disk_threshold=1000)
+    proxy = make_proxy(start, cache)
+    url = f"http://127.0.0.1:{origin.port}/large"
+
+    _, body = get(proxy, url)
+    _, cached = get(proxy, url)
+
+    assert body == cached == b"x" * 5000
+    assert (cache.disk_size, cache.memory_size) == (5000, 0)
+    assert len(os.listdir(tmp_path)) == 1
+    assert len(origin.calls) == 1
+
+
+def test_stale_entries_are_revalidated_with_their_etag(start, origin):
+    cache = ProxyCache()
+    proxy = make_proxy(start, cache)
+    url = f"http://127.0.0.1:{origin.port}/validated"
+
+    _, body = get(proxy, url)
+    response, cached = get(proxy, url)
+
+    assert body == cached == b"validated"
+    assert response.status == 200
+    assert origin.calls == [None, '"v1"']
+
+    # the client's own validator is answered from the refreshed entry
+    response, _ = get(proxy, url, {"If-None-Match": '"v1"'})
+    assert response.status == 304
+
+
+def test_concurrent_misses_are_collapsed(start, origin):
+    proxy = make_proxy(start, ProxyCache())
+    url = f"http://127.0.0.1:{origin.port}/slow"
+
+    bodies = []
+    threads = [threading.Thread(target=lambda: bodies.append(get(proxy, url)[1])) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bodies == [b"slow"] * 4
+    assert len(origin.calls) == 1
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+SIZE = os.path.getsize("resources/test.html")
+
+with open("resources/test.html", "rb") as f:
+    CONTENT = f.read()
+
+
+@pytest.mark.parametrize("header, content_range, body", [
+    ("bytes=0-9", f"bytes 0-9/{SIZE}", CONTENT[:10]),
+    ("bytes=-5", f"bytes {SIZE - 5}-{SIZE - 1}/{SIZE}", CONTENT[-5:]),
+    (f"bytes={SIZE - 3}-", f"bytes {SIZE - 3}-{SIZE - 1}/{SIZE}", CONTENT[-3:]),
+    ("bytes=0-99999", f"bytes 0-{SIZE - 1}/{SIZE}", CONTENT),
+])
+def test_single_range(make_server, start, connect, header, content_range, body):
+    client = connect(start(make_server()))
+    client.request("GET", "/test.html", {"Range": header})
+    response, data = client.response()
+
+    assert response.status == 206
+    assert response.getheader("content-range") == content_range
+    assert data == body
+
+
+def test_multiple_ranges_are_sent_as_multipart(make_server, start, connect):
+    client = connect(start(make_server()))
+    client.request("GET", "/test.html", {"Range": "bytes=0-1,10-11"})
+    response, data = client.response()
+
+    assert response.status == 206
+    content_type, _, boundary = response.getheader("content-type").partition("; boundary=")
+    assert content_type == "multipart/byteranges"
+
+    parts = data.split(b"--" + boundary.encode())
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    assert [part.split(b"\r\n\r\n", 1)[1] for part in parts[1:-1]] == [CONTENT[0:2] + b"\r\n", CONTENT[10:12] + b"\r\n"]
+    assert b"content-range: bytes 10-11/%d" % SIZE in parts[2]
+
+
+def test_stale_if_range_gets_the_whole_file(make_server, start, connect):
+    client = connect(start(make_server()))
+    client.request("GET", "/test.html")
+    etag = client.response()[0].getheader("etag")
+
+    client.request("GET", "/test.html", {"Range": "bytes=0-9", "If-Range": etag})
+    assert client.response()[0].status == 206
+
+    client.request("GET", "/test.html", {"Range": "bytes=0-9", "If-Range": '"stale"'})
+    response, data = client.response()
+    assert (response.status, data) == (200, CONTENT)
+
+
+def test_range_is_ignored_for_head(make_server, start, connect):
+    client = connect(start(make_server()))
+    client.send(b"HEAD /test.html HTTP/1.1\r\nHost: x\r\nRange: bytes=0-9\r\n\r\n"
+                b"GET /test.html HTTP/1.1\r\nHost: x\r\nRange: bytes=-5\r\n\r\n")
+
+    # range requests are defined for GET only
+    response, data = client.response("HEAD")
+    assert (response.status, response.getheader("content-length"), data) == (200, str(SIZE), b"")
+
+    response, data = client.response()
+    assert (response.status, data) == (206, CONTENT[-5:])
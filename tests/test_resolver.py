@@ -0,0 +1,121 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from SimpleHttpServer import Resolver
+
+
+def address(host, port, family=socket.AF_INET):
+    return (family, socket.SOCK_STREAM, 6, "", (host, port))
+
+
+class Lookup():
+    """ getaddrinfo stub that counts its calls and answers with addresses, or raises them if an exception """
+    def __init__(self, addresses, release=None):
+        self.addresses = addresses
+        self.release = release
+        self.calls = 0
+
+    def __call__(self, host, port, family, kind):
+        self.calls += 1
+        if self.release is not None:
+            self.release.wait(5)
+
+        if isinstance(self.addresses, Exception):
+            raise self.addresses
+
+        return self.addresses
+
+
+def test_answers_are_cached_for_ttl():
+    lookup = Lookup([address("127.0.0.1", 80)])
+    resolver = Resolver(ttl=0.2, lookup=lookup)
+
+    assert resolver.resolve("Example.com", 80) == resolver.resolve("example.com", 80) == lookup.addresses
+    assert (lookup.calls, resolver.hits, resolver.misses) == (1, 1, 1)
+
+    time.sleep(0.3)
+    resolver.resolve("example.com", 80)
+    assert lookup.calls == 2
+
+
+def test_failures_are_cached_for_negative_ttl():
+    lookup = Lookup(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+    resolver = Resolver(negative_ttl=5, lookup=lookup)
+
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            resolver.resolve("nowhere.example", 80)
+
+    assert lookup.calls == 1
+
+
+def test_concurrent_lookups_of_a_name_share_one_call():
+    release = threading.Event()
+    lookup = Lookup([address("127.0.0.1", 80)], release)
+    resolver = Resolver(lookup=lookup)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(resolver.resolve("example.com", 80)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.monotonic() + 5
+    while resolver.misses < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert lookup.calls == 1
+    assert results == [lookup.addresses] * 4
+
+
+def test_hosts_file_overrides_lookup(tmp_path):
+    hosts = tmp_path / "hosts"
+    hosts.write_text("# local names\n127.0.0.2 origin.test alias.test\n::1 origin.test # loopback too\n")
+    lookup = Lookup(socket.gaierror(socket.EAI_NONAME, "Name or service not known"))
+    resolver = Resolver(hosts=str(hosts), lookup=lookup)
+
+    addresses = resolver.resolve("ORIGIN.test", 8080)
+    assert [(a[0], a[4][:2]) for a in addresses] == [(socket.AF_INET, ("127.0.0.2", 8080)),
+                                                     (socket.AF_INET6, ("::1", 8080))]
+    assert resolver.resolve("alias.test", 80)[0][4] == ("127.0.0.2", 80)
+    assert lookup.calls == 0
+
+
+def test_interleave_alternates_families_starting_with_the_first():
+    v6 = [address(f"::{i}", 80, socket.AF_INET6) for i in range(1, 4)]
+    v4 = [address(f"10.0.0.{i}", 80) for i in range(1, 3)]
+
+    ordered = Resolver.interleave([v6[0], v6[1], v4[0], v6[2], v4[1]])
+    assert ordered == [v6[0], v4[0], v6[1], v4[1], v6[2]]
+
+
+def test_connect_moves_on_from_a_refused_address():
+    with socket.create_server(("127.0.0.1", 0)) as listener, socket.socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        lookup = Lookup([address("127.0.0.1", closed.getsockname()[1]), address("127.0.0.1", port)])
+        resolver = Resolver(lookup=lookup)
+
+        with resolver.connect("origin.test", port, connect_timeout=5) as sock:
+            assert sock.getpeername() == ("127.0.0.1", port)
+
+
+def test_unreachable_answers_are_forgotten():
+    with socket.socket() as closed:
+        closed.bind(("127.0.0.1", 0))
+        lookup = Lookup([address("127.0.0.1", closed.getsockname()[1])])
+        resolver = Resolver(lookup=lookup)
+
+        for _ in range(2):
+            with pytest.raises(OSError):
+                resolver.connect("origin.test", 80, connect_timeout=5)
+
+    # an answer none of whose addresses connected is looked up afresh
+    assert lookup.calls == 2
@@ -0,0 +1,99 @@
+import os
+
+from SimpleHttpServer import ResourceCache, ResourceIndex
+
+
+def test_cache_revalidates_with_a_stat(tmp_path):
+    path = tmp_path / "page.html"
+    path.write_bytes(b"first")
+    cache = ResourceCache(revalidate_interval=0)
+
+    entry = cache.get(str(path))
+    assert entry.data == b"first"
+    assert entry.headers["content-length"] == 5
+    assert cache.get(str(path)) is entry
+
+    path.write_bytes(b"second version")
+    entry = cache.get(str(path))
+    assert entry.data == b"second version"
+    assert cache.size == len(b"second version")
+
+
+def test_cache_is_bounded(tmp_path):
+    cache = ResourceCache(max_bytes=250, max_entry_size=100)
+    paths = []
+    for name in "abc":
+        paths.append(str(tmp_path / name))
+        with open(paths[-1], "wb") as f:
+            f.write(name.encode() * 100)
+
+    (tmp_path / "big").write_bytes(b"x" * 101)
+    assert cache.get(str(tmp_path / "big")) is None
+
+    for path in paths:
+        cache.get(path)
+
+    # the least recently used entry went to make room for the third
+    assert cache.size == 200
+    first = cache.get(paths[0])
+    assert first.data == b"a" * 100 and cache.get(paths[0]) is first
+    assert cache.size == 200
+
+
+def test_cached_files_are_served_and_refreshed(make_server, start, connect, tmp_path):
+    path = tmp_path / "page.html"
+    path.write_bytes(b"first")
+
+    server = make_server(resource_cache=ResourceCache(revalidate_interval=0))
+    server.resources = ResourceIndex(str(tmp_path))
+    client = connect(start(server))
+
+    client.request("GET", "/page.html")
+    assert client.response()[1] == b"first"
+
+    path.write_bytes(b"second version")
+    client.request("GET", "/page.html")
+    response, body = client.response()
+    assert body == b"second version"
+    assert response.getheader("content-length") == str(len(body))
+
+
+def test_files_come_from_the_injected_index_directory(make_server, start, connect, tmp_path):
+    (tmp_path / "elsewhere.txt").write_bytes(b"not in ./resources")
+
+    server = make_server()
+    server.resources = ResourceIndex(str(tmp_path) + "/")
+
+    client = connect(start(server))
+    client.send(b"GET /elsewhere.txt HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+    response, body = client.response()
+
+    assert (response.status, body) == (200, b"not in ./resources")
+
+
+def test_index_picks_up_added_and_removed_files(tmp_path):
+    (tmp_path / "index.html").write_bytes(b"")
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "site.css").write_bytes(b"")
+
+    index = ResourceIndex(str(tmp_path), check_interval=0)
+    assert set(index) == {"/index.html", "/css/site.css"}
+
+    (tmp_path / "about.html").write_bytes(b"")
+    (tmp_path / "js").mkdir()
+    (tmp_path / "js" / "app.js").write_bytes(b"")
+    os.remove(tmp_path / "css" / "site.css")
+    os.rmdir(tmp_path / "css")
+
+    assert "/about.html" in index
+    assert set(index) == {"/index.html", "/about.html", "/js/app.js"}
+
+
+def test_index_only_rescans_after_check_interval(tmp_path):
+    index = ResourceIndex(str(tmp_path), check_interval=60)
+    (tmp_path / "late.html").write_bytes(b"")
+
+    assert "/late.html" not in index
+
+    index.reload()
+    assert "/late.html" in index
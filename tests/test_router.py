@@ -0,0 +1,67 @@
+import pytest
+
+from SimpleHttpServer import HttpException, HttpStatus, Router
+
+
+def view(**params):
+    return params
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add("/users", view, ["GET", "POST"])
+    router.add("/users/<int:id>", view, ["GET"])
+    router.add("/users/<str:name>", view, ["GET"])
+    router.add("/users/<int:id>/posts/<float:score>", view, ["GET"])
+    router.add("/files/<path:rest>", view, ["GET"])
+    return router
+
+
+@pytest.mark.parametrize("path, rule, params", [
+    ("/users", "/users", {}),
+    ("/users/", "/users", {}),
+    ("/users/42", "/users/<int:id>", {"id": 42}),
+    ("/users/ada", "/users/<str:name>", {"name": "ada"}),
+    ("/users/7/posts/2.5", "/users/<int:id>/posts/<float:score>", {"id": 7, "score": 2.5}),
+    ("/users/7/posts/3", "/users/<int:id>/posts/<float:score>", {"id": 7, "score": 3.0}),
+    ("/files/a/b/c.txt", "/files/<path:rest>", {"rest": "a/b/c.txt"}),
+])
+def test_path_params(router, path, rule, params):
+    route, matched = router.match("GET", path)
+
+    assert route.rule == rule
+    assert matched == params
+
+
+@pytest.mark.parametrize("segment", ["+5", "-5", "1_0", "٤٢", " 5"])
+def test_int_takes_plain_digits_only(router, segment):
+    # anything int() would also accept falls through to the str rule
+    route, params = router.match("GET", f"/users/{segment}")
+
+    assert route.rule == "/users/<str:name>"
+    assert params == {"name": segment}
+
+
+@pytest.mark.parametrize("score", ["nan", "inf", "1e3", "-1.5", "1.", ".5", "1_0.5"])
+def test_float_takes_plain_decimals_only(router, score):
+    assert router.match("GET", f"/users/7/posts/{score}") == (None, None)
+
+
+def test_unknown_path(router):
+    assert router.match("GET", "/nowhere") == (None, None)
+
+
+def test_other_methods_get_405_with_allow(router):
+    with pytest.raises(HttpException) as e:
+        router.match("DELETE", "/users")
+
+    assert e.value.status_code == HttpStatus.Method_Not_Allowed
+    assert e.value.headers == {"allow": "GET, HEAD, POST"}
+
+
+def test_head_is_answered_by_get(router):
+    route, params = router.match("HEAD", "/users/42")
+
+    assert route.rule == "/users/<int:id>"
+    assert params == {"id": 42}
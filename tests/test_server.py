@@ -0,0 +1,268 @@
+import os
+import socket
+import time
+
+import pytest
+
+from SimpleHttpServer import AccessLog, HttpFileResponse, HttpResponse, HttpServer, HttpStatus
+
+from conftest import free_port
+
+
+def test_view_exception_is_answered_with_500_and_logged(make_server, start, connect, tmp_path):
+    log = AccessLog(str(tmp_path / "log.txt"))
+    server = make_server(access_log=log)
+
+    @server.route("/boom")
+    def boom():
+        raise RuntimeError("view broke")
+
+    @server.route("/aboom")
+    async def aboom():
+        raise RuntimeError("coroutine view broke")
+
+    @server.route("/ok")
+    def ok():
+        return "ok"
+
+    client = connect(start(server))
+    for path in ["/boom", "/aboom"]:
+        client.request("GET", path)
+        response, _ = client.response()
+        assert response.status == 500
+
+    # the connection survives the error
+    client.request("GET", "/ok")
+    response, body = client.response()
+    assert (response.status, body) == (200, b"ok")
+
+    log.close()
+    text = (tmp_path / "log.txt").read_text()
+    assert "[Error]: GET /boom failed" in text
+    assert "RuntimeError: view broke" in text
+    assert "RuntimeError: coroutine view broke" in text
+
+
+def add_letters(server):
+    @server.route("/a")
+    def a():
+        return "a"
+
+    @server.route("/b")
+    def b():
+        return "b"
+
+
+def test_pipelined_requests_are_answered_in_order(make_server, start, connect):
+    server = make_server()
+    add_letters(server)
+
+    client = connect(start(server))
+    client.send(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\nGET /b HTTP/1.1\r\nHost: x\r\n\r\n"
+                b"GET /a HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+
+    bodies = [client.response()[1] for _ in range(3)]
+    assert bodies == [b"a", b"b", b"a"]
+    assert client.rest() == b""
+
+
+def test_request_without_length_has_no_body(make_server, start, connect):
+    server = make_server()
+    add_letters(server)
+
+    # the start of the next request arrives with the first one
+    client = connect(start(server))
+    client.send(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\nGE")
+    response, body = client.response()
+    assert (response.status, body) == (200, b"a")
+    assert response.getheader("connection") == "keep-alive"
+
+    client.send(b"T /b HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+    response, body = client.response()
+    assert (response.status, body) == (200, b"b")
+    assert client.rest() == b""
+
+
+def test_error_responses_are_framed_on_kept_alive_connections(make_server, start, connect):
+    server = make_server()
+    add_letters(server)
+
+    @server.route("/forbidden")
+    def forbidden():
+        server.abort(403)
+
+    @server.route("/post-only", methods=["POST"])
+    def post_only():
+        return "posted"
+
+    client = connect(start(server))
+    requests = [("/missing", {}, 404), ("/forbidden", {}, 403), ("/post-only", {}, 405),
+                ("/test.html", {"Range": "bytes=99999-"}, 416)]
+
+    for path, headers, status in requests:
+        client.request("GET", path, headers)
+        response, body = client.response()
+        assert response.status == status
+        assert response.getheader("content-length") == "0"
+        assert response.getheader("connection") == "keep-alive"
+
+    # each error ended where its content-length said, so the connection is still in step
+    client.request("GET", "/a")
+    assert client.response()[1] == b"a"
+
+
+def test_responses_are_framed_from_construction():
+    assert HttpResponse(HttpStatus.Not_Found).headers["content-length"] == 0
+    assert "content-length" not in HttpResponse(HttpStatus.Not_Modified).headers
+
+
+def test_header_values_beyond_latin1_are_percent_encoded(make_server, start, connect):
+    server = make_server()
+    add_letters(server)
+
+    @server.route("/download")
+    def download():
+        response = HttpResponse(HttpStatus.OK)
+        response.headers = {"content-disposition": "attachment; filename=café-☃.txt"}
+        response.data = "snow"
+        return response
+
+    client = connect(start(server))
+    client.request("GET", "/download")
+    response, body = client.response()
+
+    assert (response.status, body) == (200, b"snow")
+    assert response.getheader("content-disposition") == "attachment; filename=café-%E2%98%83.txt"
+
+    client.request("GET", "/a")
+    assert client.response()[1] == b"a"
+
+
+def test_requests_past_the_deadline_are_logged_once(tmp_path, start, connect):
+    log = AccessLog(str(tmp_path / "log.txt"))
+    server = HttpServer(port=free_port(), access_log=log, handler_timeout=0.2)
+
+    @server.route("/slow")
+    def slow():
+        time.sleep(0.5)
+        return "late"
+
+    @server.route("/fast")
+    def fast():
+        return "fast"
+
+    port = start(server)
+    client = connect(port)
+    client.request("GET", "/fast")
+    assert client.response()[1] == b"fast"
+
+    client = connect(port)
+    client.request("GET", "/slow")
+    assert client.response()[0].status == 503
+
+    # the view still finishes, then its response is dropped
+    time.sleep(0.5)
+    log.close()
+    lines = (tmp_path / "log.txt").read_text().splitlines()
+
+    slow = [line for line in lines if "/slow" in line]
+    assert len([line for line in lines if "/fast" in line]) == 1
+    assert len(slow) == 1 and "503" in slow[0]
+
+
+def test_keep_alive_follows_the_request_version(make_server, start, connect):
+    server = make_server()
+    add_letters(server)
+    port = start(server)
+
+    client = connect(port)
+    client.send(b"GET /a HTTP/1.0\r\n\r\n")
+    response, body = client.response()
+    assert (body, response.getheader("connection")) == (b"a", "close")
+    assert client.rest() == b""
+
+    client = connect(port)
+    client.send(b"GET /a HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+    assert client.response()[0].getheader("connection") == "keep-alive"
+    client.send(b"GET /b HTTP/1.0\r\n\r\n")
+    assert client.response()[1] == b"b"
+
+
+def test_connection_closes_after_max_requests(make_server, start, connect):
+    server = make_server(max_requests=2)
+    add_letters(server)
+
+    client = connect(start(server))
+    client.send(b"GET /a HTTP/1.1\r\nHost: x\r\n\r\n" * 3)
+
+    assert client.response()[0].getheader("connection") == "keep-alive"
+    assert client.response()[0].getheader("connection") == "close"
+    assert client.rest() == b""
+
+
+@pytest.mark.parametrize("kind", ["file", "memory"])
+def test_slow_reader_outlasting_the_keep_alive_timeout_gets_everything(make_server, start, tmp_path, kind):
+    path = tmp_path / "big.bin"
+    path.write_bytes(os.urandom(4 * 1024 * 1024))
+    server = make_server(keep_alive_timeout=0.3)
+
+    @server.route("/big")
+    def big():
+        if kind == "file":
+            return HttpFileResponse(HttpStatus.OK, str(path))
+
+        return path.read_bytes()
+
+    port = start(server)
+
+    # a small receive window, so the body can't all sit in socket buffers
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32768)
+    sock.settimeout(5)
+    sock.connect(("127.0.0.1", port))
+    sock.sendall(b"GET /big HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+
+    # slower than the timeout end to end, but never still for that long
+    received = bytearray()
+    started = time.monotonic()
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+
+        received += data
+        time.sleep(0.01)
+
+    sock.close()
+    assert time.monotonic() - started > 0.3
+    assert len(received) > 4 * 1024 * 1024 and received.endswith(path.read_bytes())
+
+
+def test_reader_that_stops_is_cut_off(make_server, start, tmp_path):
+    path = tmp_path / "big.bin"
+    path.write_bytes(os.urandom(16 * 1024 * 1024))
+    server = make_server(keep_alive_timeout=0.3)
+
+    @server.route("/big")
+    def big():
+        return HttpFileResponse(HttpStatus.OK, str(path))
+
+    sock = socket.create_connection(("127.0.0.1", start(server)), timeout=5)
+    sock.sendall(b"GET /big HTTP/1.1\r\nHost: x\r\n\r\n")
+    time.sleep(1.5)
+
+    # what the kernel buffered arrives, then the connection ends well short of the body
+    received = 0
+    while True:
+        try:
+            data = sock.recv(1 << 20)
+        except ConnectionResetError:
+            break
+
+        if not data:
+            break
+
+        received += len(data)
+
+    sock.close()
+    assert received < 16 * 1024 * 1024
@@ -0,0 +1,80 @@
+import asyncio
+import socket
+from threading import Thread
+
+import pytest
+
+from SimpleHttpServer import HttpFileResponse, HttpStatus, HttpStreamResponse
+
+
+def send(response):
+    """ Sends response over a socketpair, returning everything the other end received """
+    ours, theirs = socket.socketpair()
+    with ours, theirs:
+        response.send(ours)
+        ours.shutdown(socket.SHUT_WR)
+        return b"".join(iter(lambda: theirs.recv(65536), b""))
+
+
+def send_async(response):
+    async def run():
+        ours, theirs = socket.socketpair()
+        with theirs:
+            reader, writer = await asyncio.open_connection(sock=ours)
+            await response.send_async(writer)
+            writer.close()
+            await writer.wait_closed()
+            return b"".join(iter(lambda: theirs.recv(65536), b""))
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("send", [send, send_async], ids=["threaded", "async"])
+def test_sent_counts_only_the_body(send):
+    chunked = HttpStreamResponse(HttpStatus.OK, iter([b"ab", "cd"]))
+    data = send(chunked)
+    assert data.endswith(b"\r\n\r\n2\r\nab\r\n2\r\ncd\r\n0\r\n\r\n")
+    assert chunked.sent == len(b"2\r\nab\r\n2\r\ncd\r\n0\r\n\r\n")
+
+    sized = HttpStreamResponse(HttpStatus.OK, iter([b"ab", b"cd"]), length=4)
+    assert send(sized).endswith(b"\r\n\r\nabcd")
+    assert sized.sent == 4
+
+
+@pytest.mark.parametrize("send", [send, send_async], ids=["threaded", "async"])
+def test_empty_file_sends_the_head_alone(send, tmp_path):
+    path = tmp_path / "empty"
+    path.write_bytes(b"")
+
+    response = HttpStreamResponse(HttpStatus.OK, open(path, "rb"))
+    data = send(response)
+
+    assert b"content-length: 0\r\n" in data
+    assert data.endswith(b"\r\n\r\n")
+    assert response.sent == 0
+
+
+def test_send_blocks_reuses_one_buffer_per_thread(tmp_path):
+    path = tmp_path / "body"
+    body = bytes(range(256)) * 600
+    path.write_bytes(body)
+
+    received = []
+    for offset, count in [(0, len(body)), (100, 1000)]:
+        ours, theirs = socket.socketpair()
+        with ours, theirs, open(path, "rb") as file:
+            Thread(target=lambda: (HttpFileResponse.send_blocks(ours, file, offset, count), ours.shutdown(socket.SHUT_WR))).start()
+            received.append(b"".join(iter(lambda: theirs.recv(65536), b"")))
+
+    assert received == [body, body[100:1100]]
+
+    views = []
+    for _ in range(2):
+        views.append(HttpFileResponse.block_buffer())
+    other = []
+    thread = Thread(target=lambda: other.append(HttpFileResponse.block_buffer()))
+    thread.start()
+    thread.join()
+
+    assert views[0] is views[1]
+    assert other[0] is not views[0]
@@ -0,0 +1,103 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import Client, free_port, wait_for_port
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="Supervisor needs os.fork")
+
+# the supervisor takes over signals and forks, so it gets a process of its own
+SUPERVISED = """
+import os, sys, time
+from SimpleHttpServer import AccessLog, HttpServer, Supervisor
+
+def create():
+    server = HttpServer(port=int(sys.argv[1]), access_log=AccessLog(os.devnull))
+
+    @server.route("/pid")
+    def pid():
+        return str(os.getpid())
+
+    @server.route("/slow")
+    def slow():
+        time.sleep(1)
+        return "done"
+
+    return server
+
+Supervisor(create, processes=2, reuse_port=sys.argv[2] == "reuse", drain_timeout=5).run()
+"""
+
+
+@pytest.fixture(params=["reuse", "shared"], ids=["reuse_port", "shared_listener"])
+def supervisor(request):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-c", SUPERVISED, str(port), request.param],
+                               stdout=subprocess.DEVNULL)
+    process.port = port
+    try:
+        wait_for_port(port)
+        yield process
+    finally:
+        # SIGTERM so the supervisor takes its workers down with it
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def get(port, path):
+    client = Client(port)
+    try:
+        client.request("GET", path, {"Connection": "close"})
+        response, body = client.response()
+        return response.status, body.decode()
+    finally:
+        client.close()
+
+
+def worker_pids(port, requests=20):
+    return set(get(port, "/pid")[1] for _ in range(requests))
+
+
+def in_background(func, *args):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(func(*args)))
+    thread.start()
+    return thread, results
+
+
+def test_sighup_replaces_workers_and_drains_the_old_ones(supervisor):
+    old = worker_pids(supervisor.port)
+    thread, results = in_background(get, supervisor.port, "/slow")
+    time.sleep(0.2)
+
+    supervisor.send_signal(signal.SIGHUP)
+
+    deadline = time.monotonic() + 10
+    while worker_pids(supervisor.port) & old:
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+    thread.join()
+    assert results == [(200, "done")]
+    assert supervisor.poll() is None
+
+
+def test_sigterm_lets_requests_in_flight_finish(supervisor):
+    thread, results = in_background(get, supervisor.port, "/slow")
+    time.sleep(0.2)
+
+    supervisor.send_signal(signal.SIGTERM)
+
+    thread.join()
+    assert results == [(200, "done")]
+    assert supervisor.wait(10) == 0
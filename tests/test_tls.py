@@ -0,0 +1,106 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+
+import pytest
+
+from SimpleHttpServer import AccessLog, HttpServer, ProxyServer, TlsConfig
+
+from conftest import free_port
+
+
+@pytest.fixture
+def cert(tmp_path):
+    """ A self-signed certificate for localhost, returned as (cert_file, key_file) """
+    if shutil.which("openssl") is None:
+        pytest.skip("needs the openssl command")
+
+    cert_file, key_file = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+                    "-keyout", key_file, "-out", cert_file], check=True, capture_output=True)
+    return cert_file, key_file
+
+
+@pytest.fixture
+def client_context(cert):
+    context = ssl.create_default_context(cafile=cert[0])
+    context.set_alpn_protocols(["http/1.1"])
+    return context
+
+
+def get(context, port, session=None):
+    """ GETs /test.html over a new TLS connection, returning its status line, session, and whether it resumed """
+    sock = context.wrap_socket(socket.create_connection(("127.0.0.1", port), timeout=5),
+                               server_hostname="localhost", session=session)
+    with sock:
+        sock.sendall(b"GET /test.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        data = b"".join(iter(lambda: sock.recv(65536), b""))
+
+        assert sock.selected_alpn_protocol() == "http/1.1"
+
+        # TLS 1.3 tickets arrive after the handshake, so the session is only there once a response is read
+        return data.split(b"\r\n", 1)[0], sock.session, sock.session_reused
+
+
+def test_https(make_server, start, cert, client_context):
+    port = start(make_server(tls=TlsConfig(*cert)))
+    status, _, _ = get(client_context, port)
+
+    assert status == b"HTTP/1.1 200 OK"
+
+
+def test_sessions_resume(make_server, start, cert, client_context):
+    tls = TlsConfig(*cert)
+    port = start(make_server(tls=tls))
+
+    _, session, reused = get(client_context, port)
+    assert not reused
+
+    status, _, reused = get(client_context, port, session)
+    assert status == b"HTTP/1.1 200 OK"
+    assert reused
+    assert tls.session_stats()["hits"] >= 1
+
+
+def test_plain_http_to_a_tls_listener_is_dropped(make_server, start, cert):
+    port = start(make_server(tls=TlsConfig(*cert)))
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(b"GET /test.html HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        try:
+            data = b"".join(iter(lambda: sock.recv(65536), b""))
+        except ConnectionResetError:
+            data = b""
+
+    assert b"200 OK" not in data
+
+
+def test_connect_tunnels_tls_through_the_proxy(start, cert, client_context):
+    origin = start(HttpServer(port=free_port(), tls=TlsConfig(*cert), access_log=AccessLog(os.devnull)))
+    proxy = start(ProxyServer(port=free_port(), tunnel_ports=[origin], access_log=AccessLog(os.devnull)))
+
+    with socket.create_connection(("127.0.0.1", proxy), timeout=5) as sock:
+        sock.sendall(f"CONNECT 127.0.0.1:{origin} HTTP/1.1\r\nHost: 127.0.0.1:{origin}\r\n\r\n".encode())
+        head = b""
+        while b"\r\n\r\n" not in head:
+            head += sock.recv(1)
+
+        assert head.startswith(b"HTTP/1.1 200")
+
+        with client_context.wrap_socket(sock, server_hostname="localhost") as tls:
+            tls.sendall(b"GET /test.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            data = b"".join(iter(lambda: tls.recv(65536), b""))
+
+    assert data.startswith(b"HTTP/1.1 200 OK")
+    assert data.endswith(open("resources/test.html", "rb").read())
+
+
+def test_connect_to_a_port_not_allowed_is_refused(start, connect):
+    proxy = start(ProxyServer(port=free_port(), access_log=AccessLog(os.devnull)))
+    client = connect(proxy)
+    client.request("CONNECT", f"127.0.0.1:{free_port()}")
+    response, _ = client.response()
+
+    assert response.status == 403
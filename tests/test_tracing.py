@@ -0,0 +1,123 @@
+import json
+import os
+import time
+
+from SimpleHttpServer import AccessLog, HttpException, HttpResponse, HttpStatus, Metrics, Tracer
+
+from conftest import wait_until
+
+
+def test_requests_answered_by_a_hook_are_labelled_hook(make_server, start, connect):
+    metrics = Metrics()
+    server = make_server(metrics=metrics, tracer=Tracer(threshold=None, log=AccessLog(os.devnull)))
+    routes = []
+
+    @server.route("/open")
+    def open_view():
+        return "open"
+
+    @server.before_request
+    def login(trace):
+        if trace.request.path.startswith("/private"):
+            return HttpResponse(HttpStatus.Forbidden)
+
+    @server.after_request
+    def record(trace):
+        routes.append(trace.route)
+
+    client = connect(start(server))
+    for path in ["/private/test.html", "/open", "/test.html"]:
+        client.request("GET", path)
+        client.response()
+
+    wait_until(lambda: len(routes) == 3)
+    assert routes == ["hook", "/open", "static"]
+    assert metrics.snapshot()["requests"][("hook", "GET", 403)] == 1
+
+
+def test_slow_requests_are_logged_with_the_view_stack(make_server, start, connect, tmp_path):
+    path = tmp_path / "trace.json"
+    log = AccessLog(str(path), format=AccessLog.FORMAT_JSON)
+    tracer = Tracer(threshold=0.2, log=log)
+    server = make_server(tracer=tracer)
+
+    @server.route("/slow")
+    def slow_view():
+        time.sleep(0.4)
+        return "slow"
+
+    @server.route("/fast")
+    def fast_view():
+        return "fast"
+
+    client = connect(start(server))
+    for path_ in ["/fast", "/slow"]:
+        client.request("GET", path_)
+        client.response()
+
+    wait_until(lambda: log.written == 1)
+    log.close()
+    trace = json.loads(path.read_text())["trace"]
+    assert tracer.logged == 1 # not the fast request
+
+    assert (trace["url"], trace["route"], trace["status"]) == ("/slow", "/slow", 200)
+    assert trace["duration_ms"] >= 400
+    assert list(trace["stages_ms"]) == ["parse", "dispatch", "view", "serialize", "send"]
+    assert trace["stages_ms"]["view"] >= 400
+    # the stack was caught while the view was still sleeping
+    assert any("slow_view" in frame for frame in trace["stack"])
+    assert 200 <= trace["stack_at_ms"] < 400
+
+
+def test_profiled_routes_log_their_top_functions(make_server, start, connect, tmp_path):
+    path = tmp_path / "trace.txt"
+    log = AccessLog(str(path))
+    tracer = Tracer(threshold=None, routes=["/profiled"], log=log)
+    server = make_server(tracer=tracer)
+
+    @server.route("/profiled")
+    def profiled_view():
+        return str(sum(range(1000)))
+
+    client = connect(start(server))
+    client.request("GET", "/profiled")
+    client.response()
+
+    wait_until(lambda: log.written == 1)
+    log.close()
+    text = path.read_text()
+
+    assert text.startswith("[Trace]: GET /profiled 200")
+    assert "profile:" in text and "profiled_view" in text
+
+
+def test_hooks_see_each_request_and_can_refuse_it(make_server, start, connect):
+    server = make_server(tracer=Tracer(threshold=None, log=AccessLog(os.devnull)))
+    traces = []
+
+    @server.route("/items")
+    def items():
+        return "items"
+
+    @server.before_request
+    def require_token(trace):
+        if trace.request.headers.get("x-token") != "secret":
+            raise HttpException(HttpStatus.Forbidden)
+
+    @server.after_request
+    def record(trace):
+        traces.append((trace.route, trace.status_code, [stage for stage, _, _ in trace.stages]))
+
+    @server.after_request
+    def broken(trace):
+        raise ValueError("an after hook failing doesn't affect the others")
+
+    client = connect(start(server))
+    client.request("GET", "/items")
+    assert client.response()[0].status == 403
+    client.request("GET", "/items", {"X-Token": "secret"})
+    assert client.response()[1] == b"items"
+
+    wait_until(lambda: len(traces) == 2)
+    assert traces == [("hook", 403, ["parse", "dispatch", "serialize", "send"]),
+                      ("/items", 200, ["parse", "dispatch", "view", "serialize", "send"])]
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from SimpleHttpServer import HttpResponse, HttpStatus, ViewCache
+
+from conftest import Client
+
+
+def get(port, path, headers=None):
+    client = Client(port)
+    try:
+        client.request("GET", path, headers)
+        return client.response()
+    finally:
+        client.close()
+
+
+def test_hits_are_served_with_their_age(make_server, start):
+    server = make_server()
+    cache = ViewCache(ttl=60, query=["page"], headers=["accept-language"])
+    calls = []
+
+    @server.route("/news", cache=cache)
+    def news(request):
+        calls.append(request.query)
+        return f"news {len(calls)}"
+
+    port = start(server)
+
+    response, body = get(port, "/news?page=1&utm=a")
+    assert body == b"news 1"
+    assert response.getheader("cache-control") == "public, max-age=60"
+    assert response.getheader("vary") == "accept-language"
+    assert response.getheader("age") is None
+
+    time.sleep(1.1)
+    response, body = get(port, "/news?utm=b&page=1")
+    assert body == b"news 1"
+    assert int(response.getheader("age")) >= 1
+    assert int(response.getheader("cache-control").rpartition("=")[2]) <= 59
+
+    # a parameter or header in the key is its own entry
+    assert get(port, "/news?page=2")[1] == b"news 2"
+    assert get(port, "/news?page=1", {"Accept-Language": "fr"})[1] == b"news 3"
+    assert (cache.hits, len(calls)) == (1, 3)
+
+
+def test_concurrent_misses_run_the_view_once(make_server, start):
+    server = make_server()
+    cache = ViewCache()
+    calls = []
+
+    @server.route("/slow", cache=cache)
+    def slow():
+        calls.append(None)
+        time.sleep(0.3)
+        return "slow"
+
+    port = start(server)
+
+    bodies = []
+    threads = [threading.Thread(target=lambda: bodies.append(get(port, "/slow")[1])) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bodies == [b"slow"] * 4
+    assert len(calls) == 1
+
+
+def test_uncacheable_responses_are_not_kept(make_server, start):
+    server = make_server()
+    calls = []
+
+    @server.route("/private", cache=ViewCache())
+    def private():
+        calls.append(None)
+        response = HttpResponse(HttpStatus.OK)
+        response.headers = {"cache-control": "no-store"}
+        response.data = "mine"
+        return response
+
+    port = start(server)
+    for _ in range(2):
+        response, body = get(port, "/private")
+        assert (response.getheader("cache-control"), body) == ("no-store", b"mine")
+
+    assert len(calls) == 2